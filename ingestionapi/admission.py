@@ -0,0 +1,120 @@
+"""
+Admission control for the ingestion API.
+
+Two things can make us turn a request away before it reaches the broker:
+
+- The client has used up its token bucket (RATE_LIMIT requests per second
+  with bursts of up to RATE_LIMIT_BURST).
+- The backlog in front of the workers (queue depth, or for the stream
+  transport the age of the oldest unprocessed entry) is over its limit.
+
+Both are answered with 429 and a Retry-After header.
+"""
+import collections
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, n=1):
+        """
+        Take n tokens. Returns 0 if they were available, otherwise the number
+        of seconds until they will be.
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0
+        return (n - self.tokens) / self.rate
+
+
+class ClientLimiter(object):
+    """
+    A token bucket per client. Only the max_clients most recently seen
+    clients are tracked; a client that was forgotten starts with a full
+    bucket again.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client, n=1):
+        with self._lock:
+            now = self.clock()
+            bucket = self.buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets[client] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return bucket.take(now, n)
+
+
+class BacklogMonitor(object):
+    """
+    Keep track of the backlog in front of the workers.
+
+    sample is called at most once every interval seconds and returns a
+    (queue_depth, worker_lag) tuple, where worker_lag is the age in seconds
+    of the oldest unprocessed message or None if it isn't known. A limit of
+    0 disables that check. If sampling fails the backlog is treated as
+    unknown and nothing is shed; the circuit breaker deals with an
+    unavailable broker.
+    """
+
+    def __init__(self, sample, max_depth, max_lag, interval=1,
+                 errors=(Exception,), clock=time.monotonic):
+        self.sample = sample
+        self.max_depth = max_depth
+        self.max_lag = max_lag
+        self.interval = interval
+        self.errors = errors
+        self.clock = clock
+        self.depth = None
+        self.lag = None
+        self.sampled = None
+
+    @property
+    def enabled(self):
+        return bool(self.max_depth or self.max_lag)
+
+    def refresh(self):
+        now = self.clock()
+        if self.sampled is not None and now - self.sampled < self.interval:
+            return
+        self.sampled = now
+        try:
+            self.depth, self.lag = self.sample()
+        except self.errors:
+            self.depth, self.lag = None, None
+
+    def shedding(self):
+        if not self.enabled:
+            return False
+        self.refresh()
+        if self.max_depth and (self.depth or 0) > self.max_depth:
+            return True
+        if self.max_lag and (self.lag or 0) > self.max_lag:
+            return True
+        return False
+
+    def state(self):
+        return {
+            'shedding': self.shedding(),
+            'queue_depth': self.depth,
+            'worker_lag': self.lag,
+        }
@@ -0,0 +1,60 @@
+"""
+Collect items submitted from concurrent callers (e.g. Celery worker threads
+or greenlets) and hand them to a flush function in batches.
+"""
+import threading
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class Batcher(object):
+    """
+    Group submitted items into batches of up to max_size items, or whatever
+    arrived within max_wait seconds of the first item, whichever comes first.
+
+    submit() blocks until the batch containing the item has been flushed and
+    re-raises any exception the flush raised, so a caller that returns from
+    submit() knows its item was written. The first caller to add to a batch
+    is responsible for flushing it.
+    """
+
+    def __init__(self, max_size, max_wait, flush):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.flush = flush
+        self._lock = threading.Lock()
+        self._batch = _Batch()
+
+    def submit(self, item):
+        with self._lock:
+            batch = self._batch
+            batch.items.append(item)
+            leader = len(batch.items) == 1
+            if len(batch.items) >= self.max_size:
+                self._batch = _Batch()
+                batch.full.set()
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+
+        batch.full.wait(self.max_wait)
+        with self._lock:
+            if self._batch is batch:
+                self._batch = _Batch()
+        try:
+            self.flush(batch.items)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
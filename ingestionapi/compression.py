@@ -0,0 +1,112 @@
+"""
+Compression helpers for request bodies, stored records and responses.
+
+zlib/gzip come from the standard library; zstd needs the zstandard package
+and is only available when it is installed.
+"""
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TooLarge(ValueError):
+    """
+    Raised when data decompresses to more than the allowed size.
+    """
+
+
+def decompress_gzip(data, limit):
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.decompress(data, limit + 1)
+    if len(out) > limit:
+        raise TooLarge()
+    if not d.eof:
+        raise ValueError("Truncated gzip data")
+    return out
+
+
+def decompress_zstd(data, limit):
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+    out = reader.read(limit + 1)
+    if len(out) > limit:
+        raise TooLarge()
+    return out
+
+
+content_decoders = {'gzip': decompress_gzip, 'x-gzip': decompress_gzip}
+if zstandard is not None:
+    content_decoders['zstd'] = decompress_zstd
+
+
+def decode_body(data, content_encoding, limit):
+    """
+    Undo a request's Content-Encoding without producing more than limit
+    bytes. Raises TooLarge if the body would be bigger, KeyError for
+    unsupported encodings and ValueError for corrupt data.
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return data
+    try:
+        return content_decoders[encoding](data, limit)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ValueError(str(e))
+        raise
+
+
+# Stored records start with a byte saying how they were compressed.
+ZLIB = b'\x01'
+ZSTD = b'\x02'
+
+
+def pack(txt, codec='zlib', level=6):
+    data = txt.encode('utf-8')
+    if codec == 'zstd':
+        return ZSTD + zstandard.ZstdCompressor(level=level).compress(data)
+    return ZLIB + zlib.compress(data, level)
+
+
+def unpack(blob):
+    blob = bytes(blob)
+    codec, data = blob[:1], blob[1:]
+    if codec == ZSTD:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == ZLIB:
+        data = zlib.decompress(data)
+    else:
+        raise ValueError("Unknown record compression")
+    return data.decode('utf-8')
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Whether an Accept-Encoding header allows a gzip response.
+    """
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0')
+    return False
+
+
+def gzip_body(data, level=6):
+    return gzip.compress(data, level)
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzip an iterable of byte strings, flushing after every chunk so the
+    client receives data as it is produced.
+    """
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+    yield z.flush()
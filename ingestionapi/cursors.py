@@ -0,0 +1,61 @@
+"""
+Opaque pagination tokens for the List API.
+
+A token is the URL-safe base64 of a JSON array starting with a format
+version. Version 2 holds the (timestamp, message_id) key of the last record
+returned, the sort order and the since/until range of the listing; the next
+page starts after that key. Version 1 tokens (key only, ascending) are still
+accepted, as are "<timestamp>_<message_id>" tokens handed out before tokens
+were versioned, which point at the first record of the next page.
+"""
+import base64
+import binascii
+import collections
+import json
+import re
+
+VERSION = 2
+LEGACY_TOKEN = re.compile(r'^(\d+)_(.*)$')
+
+Cursor = collections.namedtuple(
+    'Cursor', 'timestamp message_id inclusive desc since until')
+
+
+def _optional_int(value):
+    if value is not None and not isinstance(value, int):
+        raise ValueError("Unsupported token")
+    return value
+
+
+def encode(timestamp, message_id, desc=False, since=None, until=None):
+    data = json.dumps([VERSION, timestamp, message_id, int(desc), since,
+                       until], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode(token):
+    """
+    Return the Cursor for a token. inclusive says whether the record with
+    the cursor's key belongs to the page. Raises ValueError for tokens that
+    can't be decoded.
+    """
+    legacy = LEGACY_TOKEN.match(token)
+    if legacy:
+        return Cursor(int(legacy.group(1)), legacy.group(2), True, False,
+                      None, None)
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        fields = json.loads(data.decode('utf-8'))
+        version, timestamp, message_id = fields[:3]
+    except (binascii.Error, UnicodeDecodeError, TypeError, KeyError) as e:
+        raise ValueError(str(e))
+    if version == 1 and len(fields) == 3:
+        desc, since, until = False, None, None
+    elif version == VERSION and len(fields) == 6:
+        desc, since, until = bool(fields[3]), fields[4], fields[5]
+    else:
+        raise ValueError("Unsupported token")
+    if not isinstance(timestamp, int) or not isinstance(message_id, str):
+        raise ValueError("Unsupported token")
+    return Cursor(timestamp, message_id, False, desc, _optional_int(since),
+                  _optional_int(until))
@@ -1,20 +1,319 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import create_engine, event, exc, inspect
+from sqlalchemy.pool import QueuePool
 
+import compression
+import retention
+import rollups
+
+import click
 import os
+import time
+import zlib
 
 app = Flask(__name__)
 db_uri = os.environ.get('SQLALCHEMY_DATABASE_URI')
 db_uri = db_uri or 'mysql://root@mysql:3306/falcon'
 app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+# Reads from the List API go to SQLALCHEMY_READER_DATABASE_URI (a replica)
+# when it is set, writes always go to SQLALCHEMY_DATABASE_URI.
+app.config['SQLALCHEMY_READER_DATABASE_URI'] = os.environ.get(
+    'SQLALCHEMY_READER_DATABASE_URI')
+# A comma separated list of database URIs spreads records across those
+# databases by a hash of their message ID (see shard_index) instead of
+# keeping them in the main database.
+app.config['SHARD_DATABASE_URIS'] = [
+    uri for uri in (os.environ.get('SHARD_DATABASE_URIS') or '').split(',')
+    if uri]
+# Replicas of those shards, in the same order, for reads from the List API.
+# Without them the List API reads from the shards themselves.
+app.config['SHARD_READER_DATABASE_URIS'] = [
+    uri for uri in
+    (os.environ.get('SHARD_READER_DATABASE_URIS') or '').split(',') if uri]
+if app.config['SHARD_READER_DATABASE_URIS'] and (
+        len(app.config['SHARD_READER_DATABASE_URIS']) !=
+        len(app.config['SHARD_DATABASE_URIS'])):
+    raise ValueError("SHARD_READER_DATABASE_URIS needs one URI per shard")
+# Records older than RECORD_RETENTION seconds are removed by the
+# purge-records command; 0 keeps them forever. See retention.py.
+app.config['RECORD_RETENTION'] = int(
+    os.environ.get('RECORD_RETENTION') or 0)
+app.config['PARTITION_INTERVAL'] = int(
+    os.environ.get('PARTITION_INTERVAL') or 86400)
+app.config['PARTITION_AHEAD'] = int(
+    os.environ.get('PARTITION_AHEAD') or 7 * 86400)
+app.config['PURGE_BATCH_SIZE'] = int(
+    os.environ.get('PURGE_BATCH_SIZE') or 1000)
+app.config['PURGE_PAUSE'] = float(os.environ.get('PURGE_PAUSE') or 0.1)
+
+
+def pool_options(role):
+    """
+    Connection pool settings for "writer" or "reader", taken from
+    DB_<ROLE>_POOL_SIZE, _MAX_OVERFLOW, _POOL_RECYCLE and _POOL_TIMEOUT.
+    Unset values keep SQLAlchemy's defaults.
+    """
+    options = {}
+    for name in ('pool_size', 'max_overflow', 'pool_recycle', 'pool_timeout'):
+        value = os.environ.get('DB_%s_%s' % (role.upper(), name.upper()))
+        if value:
+            options[name] = int(value)
+    return options
+
+
+def pre_ping_enabled(role):
+    return os.environ.get('DB_%s_PRE_PING' % role.upper()) == '1'
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check a connection as it leaves the pool; the pool replaces connections
+    that fail (e.g. after a MySQL restart or wait_timeout) with new ones.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+for name, value in pool_options('writer').items():
+    app.config['SQLALCHEMY_%s' % name.upper()] = value
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+engines = {}
+
+
+def get_engine(role):
+    """
+    The engine for "writer" or "reader". The reader is the writer unless a
+    reader database is configured.
+    """
+    if role not in engines:
+        if role == 'writer':
+            engine = db.engine
+        elif app.config['SQLALCHEMY_READER_DATABASE_URI']:
+            engine = create_engine(
+                app.config['SQLALCHEMY_READER_DATABASE_URI'],
+                **pool_options(role))
+        else:
+            return get_engine('writer')
+        if pre_ping_enabled(role):
+            event.listen(engine.pool, 'checkout', ping_connection)
+        engines[role] = engine
+    return engines[role]
+
+
+def get_shard_engines(role='writer'):
+    """
+    The engines of the record shards for "writer" or "reader", in shard
+    order, or [] if records aren't sharded. The readers are the shards
+    themselves unless shard replicas are configured.
+    """
+    key = 'shards' if role == 'writer' else 'shard_readers'
+    if key not in engines:
+        uris = app.config['SHARD_DATABASE_URIS']
+        if role != 'writer':
+            if not app.config['SHARD_READER_DATABASE_URIS']:
+                return get_shard_engines('writer')
+            uris = app.config['SHARD_READER_DATABASE_URIS']
+        engines[key] = []
+        for uri in uris:
+            engine = create_engine(uri, **pool_options(role))
+            if pre_ping_enabled(role):
+                event.listen(engine.pool, 'checkout', ping_connection)
+            engines[key].append(engine)
+    return engines[key]
+
+
+def shard_index(message_id, count):
+    """
+    The shard a record belongs to. This must never change for a given
+    number of shards.
+    """
+    return zlib.crc32(message_id.encode('utf-8')) % count
+
+
+def record_engines():
+    """
+    The engines holding records: the shards, or just the writer.
+    """
+    return get_shard_engines() or [get_engine('writer')]
+
+
+def pool_stats(role):
+    """
+    How busy a role's connection pool is, for sizing it against the number
+    of gunicorn or Celery workers.
+    """
+    pool = get_engine(role).pool
+    if not isinstance(pool, QueuePool):
+        return {'status': pool.status()}
+    return {'size': pool.size(), 'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(), 'overflow': pool.overflow()}
+
 
 class Records(db.Model):
 
+    # Lets workers find the records of retried requests with an
+    # Idempotency-Key, which get a new timestamp (see tasks.drop_stored).
+    __table_args__ = (db.Index('ix_records_message_id', 'message_id'),)
+
     timestamp = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.String(32), primary_key=True)
     record = db.Column(db.Text)
+    # Compressed copy of the document (see compression.pack). Records are
+    # stored in either record or record_z.
+    record_z = db.Column(db.LargeBinary(2 ** 24 - 1))
+
+    @property
+    def data(self):
+        return record_data(self.record, self.record_z)
+
+
+class RecordStats(db.Model):
+    """
+    The number and stored size of the records written in each minute,
+    maintained by the workers (see rollups.py).
+    """
+
+    __tablename__ = 'record_stats'
+
+    minute = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Each minute is spread over several rows, see rollups.py.
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False,
+                     default=0)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+def record_data(record, record_z):
+    """
+    The document of a record, whichever column it's stored in.
+    """
+    if record is None and record_z is not None:
+        return compression.unpack(record_z)
+    return record
+
+
+def upgrade_records(engine):
+    """
+    Bring existing records and record_stats tables up to date with the
+    models, creating record_stats if it is missing. Returns a description
+    of each change made. record_stats needs a new primary key, which is
+    only changed in place on MySQL.
+    """
+    changes = []
+    columns = [column['name'] for column in
+               inspect(engine).get_columns('records')]
+    if 'record_z' not in columns:
+        engine.execute(
+            'ALTER TABLE records ADD COLUMN record_z MEDIUMBLOB NULL')
+        changes.append("added column record_z")
+    if 'record_stats' not in inspect(engine).get_table_names():
+        RecordStats.__table__.create(engine, checkfirst=True)
+        changes.append("created table record_stats")
+    elif engine.dialect.name == 'mysql' and 'slot' not in [
+            column['name'] for column in
+            inspect(engine).get_columns('record_stats')]:
+        engine.execute(
+            'ALTER TABLE record_stats '
+            'ADD COLUMN slot SMALLINT NOT NULL DEFAULT 0 AFTER minute, '
+            'DROP PRIMARY KEY, ADD PRIMARY KEY (minute, slot)')
+        changes.append("added column record_stats.slot")
+    indexes = inspect(engine).get_indexes('records')
+    if not any(index['column_names'] == ['message_id'] for index in indexes):
+        for index in Records.__table__.indexes:
+            if index.name == 'ix_records_message_id':
+                index.create(engine)
+        changes.append("added index ix_records_message_id")
+    return changes
+
+
+@app.cli.command('upgrade-records')
+def upgrade_records_command():
+    """
+    Add what newer versions need to existing records tables. Run it before
+    upgrading the workers, which write to record_stats. This takes a while
+    on big tables, so run it in a maintenance window.
+    """
+    for engine in record_engines():
+        changes = upgrade_records(engine)
+        click.echo("Upgraded records: %s" % (', '.join(changes) or 'none'))
+
+
+@app.cli.command('partition-records')
+def partition_records():
+    """
+    Partition the records table by timestamp (MySQL only) and create
+    partitions PARTITION_AHEAD seconds ahead. Run this daily.
+    """
+    for engine in record_engines():
+        with engine.connect() as connection:
+            if not retention.supports_partitions(connection):
+                click.echo("Partitioning needs MySQL, skipping")
+                continue
+            created = retention.ensure_partitions(
+                connection, int(time.time()),
+                app.config['PARTITION_INTERVAL'],
+                app.config['PARTITION_AHEAD'])
+        click.echo("Created partitions: %s" % (', '.join(created) or 'none'))
+
+
+@app.cli.command('purge-records')
+def purge_records():
+    """
+    Remove records older than RECORD_RETENTION seconds. Run this daily.
+    """
+    if not app.config['RECORD_RETENTION']:
+        click.echo("RECORD_RETENTION isn't set, nothing to purge")
+        return
+    cutoff = int(time.time()) - app.config['RECORD_RETENTION']
+    for engine in record_engines():
+        with engine.connect() as connection:
+            removed = retention.purge(connection, cutoff,
+                                      app.config['PURGE_BATCH_SIZE'],
+                                      app.config['PURGE_PAUSE'])
+        click.echo("Purged %s" % removed)
+
+
+@app.cli.command('create-shards')
+def create_shards():
+    """
+    Create the records tables on every shard that doesn't have them yet.
+    """
+    for engine in get_shard_engines():
+        db.metadata.create_all(engine, tables=[Records.__table__,
+                                               RecordStats.__table__])
+    click.echo("Created tables on %d shards" % len(get_shard_engines()))
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--since', type=int, default=None,
+              help="First timestamp to rebuild, defaults to the oldest")
+@click.option('--until', type=int, default=None,
+              help="Timestamp to rebuild up to, defaults to the newest")
+def rebuild_rollups(since, until):
+    """
+    Recompute the per-minute rollups from the records, a day at a time.
+    """
+    for engine in record_engines():
+        with engine.connect() as connection:
+            first, last = connection.execute(db.text(
+                "SELECT MIN(timestamp), MAX(timestamp) FROM records")).first()
+            if first is None:
+                continue
+            start = first if since is None else since
+            end = last + 1 if until is None else until
+            start -= start % rollups.MINUTE
+            end += -end % rollups.MINUTE
+            while start < end:
+                rollups.rebuild(connection, start, min(start + 86400, end))
+                start += 86400
+    click.echo("Rebuilt rollups")
@@ -49,7 +49,9 @@ CREATE TABLE `records` (
   `timestamp` int(11) NOT NULL,
   `message_id` varchar(32) NOT NULL,
   `record` text,
-  PRIMARY KEY (`timestamp`,`message_id`)
+  `record_z` mediumblob,
+  PRIMARY KEY (`timestamp`,`message_id`),
+  KEY `ix_records_message_id` (`message_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -61,6 +63,22 @@ LOCK TABLES `records` WRITE;
 /*!40000 ALTER TABLE `records` DISABLE KEYS */;
 /*!40000 ALTER TABLE `records` ENABLE KEYS */;
 UNLOCK TABLES;
+
+--
+-- Table structure for table `record_stats`
+--
+
+DROP TABLE IF EXISTS `record_stats`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `record_stats` (
+  `minute` int(11) NOT NULL,
+  `slot` smallint(6) NOT NULL DEFAULT '0',
+  `count` bigint(20) NOT NULL,
+  `bytes` bigint(20) NOT NULL,
+  PRIMARY KEY (`minute`,`slot`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
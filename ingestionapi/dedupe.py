@@ -0,0 +1,84 @@
+"""
+Remember recently seen keys (idempotency keys or message IDs) for a limited
+window so duplicates can be dropped before they reach the database.
+
+MemoryDeduper is local to the process; RedisDeduper is shared by every
+process talking to the same Redis server.
+"""
+import collections
+import threading
+import time
+
+
+class MemoryDeduper(object):
+    """
+    Keeps up to max_keys keys for window seconds each, forgetting the oldest
+    keys first when full.
+    """
+
+    def __init__(self, window, max_keys=100000, clock=time.monotonic):
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self.keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.keys:
+            key, expires = next(iter(self.keys.items()))
+            if expires > now and len(self.keys) <= self.max_keys:
+                break
+            self.keys.popitem(last=False)
+
+    def contains(self, key):
+        with self._lock:
+            self._expire(self.clock())
+            return key in self.keys
+
+    def add(self, key):
+        with self._lock:
+            now = self.clock()
+            self.keys.pop(key, None)
+            self.keys[key] = now + self.window
+            self._expire(now)
+
+    def check_and_add(self, key):
+        """
+        Add the key, returning True if it was already there.
+        """
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if key in self.keys:
+                return True
+            self.keys[key] = now + self.window
+            self._expire(now)
+            return False
+
+    def discard(self, key):
+        with self._lock:
+            self.keys.pop(key, None)
+
+
+class RedisDeduper(object):
+    """
+    Keeps keys in Redis with an expiry of window seconds.
+    """
+
+    def __init__(self, client, window, prefix='dedupe:'):
+        self.client = client
+        self.window = int(window)
+        self.prefix = prefix
+
+    def contains(self, key):
+        return bool(self.client.exists(self.prefix + key))
+
+    def add(self, key):
+        self.client.set(self.prefix + key, 1, ex=self.window)
+
+    def check_and_add(self, key):
+        return not self.client.set(self.prefix + key, 1, ex=self.window,
+                                   nx=True)
+
+    def discard(self, key):
+        self.client.delete(self.prefix + key)
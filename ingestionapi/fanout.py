@@ -0,0 +1,216 @@
+"""
+Fan-out of the live feed to websocket clients.
+
+Every message goes into one ring buffer shared by all clients, encoded once
+as a websocket frame. A client only keeps the sequence number of the next
+message it has to send, and sends everything it is behind by in a single
+write. What happens to clients that fall too far behind, either more than
+the size of the ring or more than their byte budget, is up to a policy:
+drop-oldest skips the oldest messages until the rest fit, keep-latest skips
+to the newest message and disconnect closes the connection.
+
+Every message also has an ID, and a second frame wrapping the message with
+it for clients that want IDs, e.g. to resume after a reconnect.
+"""
+import asyncio
+import json
+import struct
+
+DROP_OLDEST = 'drop-oldest'
+KEEP_LATEST = 'keep-latest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, KEEP_LATEST, DISCONNECT)
+
+
+class SlowClient(Exception):
+    pass
+
+
+def encode_frame(value):
+    """
+    An unmasked (server to client) websocket frame holding value: a text
+    frame for strings and a binary one for bytes.
+    """
+    if isinstance(value, str):
+        first, data = 0x81, value.encode('utf-8')
+    else:
+        first, data = 0x82, value
+    length = len(data)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length < 2 ** 16:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + data
+
+
+def envelope(message_id, value):
+    """
+    A message wrapped with its ID. Messages are JSON documents and are
+    embedded as they are.
+    """
+    return '{"id":%s,"data":%s}' % (json.dumps(message_id), value)
+
+
+def _slice(items, start, end):
+    size = len(items)
+    first, last = start % size, end % size
+    if end - start == size or first > last:
+        return items[first:] + items[:last]
+    return items[first:last]
+
+
+class Ring(object):
+    """
+    Holds the last size messages and their frames. Messages are numbered
+    from 0 in the order they were published.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = [None] * size
+        self.frames = [None] * size
+        self.ids = [None] * size
+        self.id_frames = [None] * size
+        # The sequence number of each message ID still in the ring.
+        self.positions = {}
+        # The total size of the frames, plain and with IDs, published before
+        # each message.
+        self.starts = [0] * size
+        self.id_starts = [0] * size
+        self.total_bytes = 0
+        self.total_id_bytes = 0
+        self.next_seq = 0
+        self._waiter = None
+
+    @property
+    def first_seq(self):
+        """
+        The sequence number of the oldest message still in the ring.
+        """
+        return max(0, self.next_seq - self.size)
+
+    def publish(self, value, message_id=None, frames=None):
+        """
+        Add a message with an ID, its sequence number by default. Its
+        frames, plain and with the ID, are encoded unless they are given.
+        Returns the frames.
+        """
+        if message_id is None:
+            message_id = str(self.next_seq)
+        if frames is None:
+            frames = (encode_frame(value),
+                      encode_frame(envelope(message_id, value)))
+        index = self.next_seq % self.size
+        if self.next_seq >= self.size:
+            self.positions.pop(self.ids[index], None)
+        self.values[index] = value
+        self.ids[index] = message_id
+        self.frames[index], self.id_frames[index] = frames
+        self.positions[message_id] = self.next_seq
+        self.starts[index] = self.total_bytes
+        self.id_starts[index] = self.total_id_bytes
+        self.total_bytes += len(frames[0])
+        self.total_id_bytes += len(frames[1])
+        self.next_seq += 1
+        if self._waiter is not None:
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+            self._waiter = None
+        return frames
+
+    def lag_bytes(self, seq, with_ids=False):
+        """
+        The size of the frames from message seq (still in the ring) on, the
+        frames with IDs if with_ids is set.
+        """
+        if seq >= self.next_seq:
+            return 0
+        if with_ids:
+            return self.total_id_bytes - self.id_starts[seq % self.size]
+        return self.total_bytes - self.starts[seq % self.size]
+
+    async def wait(self, seq):
+        """
+        Wait until message seq has been published.
+        """
+        while seq >= self.next_seq:
+            if self._waiter is None:
+                self._waiter = asyncio.get_event_loop().create_future()
+            # Shielded so a cancelled client doesn't cancel the others.
+            await asyncio.shield(self._waiter)
+
+    def get_values(self, start, end):
+        return _slice(self.values, start, end)
+
+    def get_frames(self, start, end):
+        return _slice(self.frames, start, end)
+
+    def get_ids(self, start, end):
+        return _slice(self.ids, start, end)
+
+    def get_id_frames(self, start, end):
+        return _slice(self.id_frames, start, end)
+
+
+def catch_up(ring, seq, max_bytes, policy=DROP_OLDEST, with_ids=False):
+    """
+    The message a client that has sent everything before seq continues
+    from. That's seq unless it has been overwritten or the client is more
+    than max_bytes behind, counted in the frames it is sent (with IDs if
+    with_ids is set), in which case policy decides. Raises SlowClient if
+    the policy is to disconnect.
+    """
+    if seq >= ring.first_seq and ring.lag_bytes(seq, with_ids) <= max_bytes:
+        return seq
+    if policy == DISCONNECT:
+        raise SlowClient()
+    if policy == KEEP_LATEST:
+        return max(seq, ring.next_seq - 1)
+    # The oldest message from which on the frames fit in max_bytes, but at
+    # least the newest one.
+    low, high = max(seq, ring.first_seq), ring.next_seq - 1
+    while low < high:
+        middle = (low + high) // 2
+        if ring.lag_bytes(middle, with_ids) <= max_bytes:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+async def send(websocket, ring, start, end, with_ids=False):
+    """
+    Send messages start to end of the ring to a client, with their IDs if
+    with_ids is set. Returns False if the connection is already closed.
+    """
+    if getattr(websocket, 'writer', None) is not None:
+        if with_ids:
+            return await send_encoded(websocket,
+                                      ring.get_id_frames(start, end))
+        return await send_encoded(websocket, ring.get_frames(start, end))
+    values = ring.get_values(start, end)
+    if with_ids:
+        values = [envelope(message_id, value) for message_id, value
+                  in zip(ring.get_ids(start, end), values)]
+    return await send_encoded(websocket, None, values)
+
+
+async def send_encoded(websocket, frames, values=None):
+    """
+    Send messages to a client. The frames are written straight to the
+    connection's stream in one go when it has one (older releases of the
+    websockets library, like the one we pin), otherwise the values are sent
+    one at a time. Returns False if the connection is already closed.
+    """
+    writer = getattr(websocket, 'writer', None)
+    if writer is not None:
+        if not websocket.open:
+            return False
+        writer.writelines(frames)
+        await writer.drain()
+    else:
+        for value in values:
+            await websocket.send(value)
+    return True
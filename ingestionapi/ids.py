@@ -0,0 +1,89 @@
+"""
+Message ID schemes.
+
+"uuid4" IDs are random. "uuid7" (UUIDv7 as 32 hex digits) and "ulid" (a
+lowercase 26 character ULID) IDs start with the time in milliseconds, so
+records within a second sort in the order they were accepted and new
+records are appended to the end of the (timestamp, message_id) primary key
+instead of landing at random places in it. IDs made by one process in the
+same millisecond are still increasing.
+"""
+import os
+import threading
+import time
+import uuid
+
+CROCKFORD = '0123456789abcdefghjkmnpqrstvwxyz'
+
+
+def uuid4_id(now=None):
+    return uuid.uuid4().hex
+
+
+class MonotonicIds(object):
+    """
+    Makes IDs from a millisecond timestamp and random bits. When called
+    again within the same millisecond the random part of the previous ID is
+    incremented instead, moving on to the next millisecond if it overflows.
+    """
+
+    def __init__(self, random_bits, encode):
+        self.random_bits = random_bits
+        self.encode = encode
+        self.last_ms = 0
+        self.last_random = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, now=None):
+        ms = int((time.time() if now is None else now) * 1000)
+        with self._lock:
+            if ms <= self.last_ms:
+                ms = self.last_ms
+                rand = self.last_random + 1
+                if rand >> self.random_bits:
+                    ms += 1
+                    rand = self._random()
+            else:
+                rand = self._random()
+            self.last_ms, self.last_random = ms, rand
+        return self.encode(ms, rand)
+
+    def _random(self):
+        # Leave headroom so increments rarely overflow.
+        return int.from_bytes(os.urandom(16), 'big') >> (
+            128 - self.random_bits + 1)
+
+
+def encode_uuid7(ms, rand):
+    """
+    48 bits of milliseconds, version 7, the top 12 random bits, the RFC 4122
+    variant and the remaining 62 random bits.
+    """
+    value = ((ms & (2 ** 48 - 1)) << 80 | 0x7 << 76 |
+             (rand >> 62) << 64 | 0b10 << 62 | rand & (2 ** 62 - 1))
+    return '%032x' % value
+
+
+def encode_ulid(ms, rand):
+    value = (ms & (2 ** 48 - 1)) << 80 | rand
+    return ''.join(CROCKFORD[(value >> shift) & 31]
+                   for shift in range(125, -1, -5))
+
+
+schemes = {
+    'uuid4': uuid4_id,
+    'uuid7': MonotonicIds(74, encode_uuid7),
+    'ulid': MonotonicIds(80, encode_ulid),
+}
+
+
+def get_generator(name):
+    """
+    The ID generator of a scheme, uuid4 if name is empty. Raises ValueError
+    for unknown schemes.
+    """
+    try:
+        return schemes[name or 'uuid4']
+    except KeyError:
+        raise ValueError("Unknown message ID scheme %r, expected one of %s"
+                         % (name, ', '.join(sorted(schemes))))
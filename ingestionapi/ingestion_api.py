@@ -1,5 +1,6 @@
 from flask import Flask, request, make_response
 from flask_autodoc import Autodoc
+from werkzeug.exceptions import RequestEntityTooLarge
 import kombu
 import redis
 
@@ -8,12 +9,27 @@ import structlog
 
 from circuitbreaker import circuit, CircuitBreakerMonitor
 
-from tasks import add
+import tasks
+from tasks import add, add_batch
 
+import admission
+import compression
+import dedupe
+import ids
+import jsoncheck
+import spool
+import streams
+
+import hashlib
+import io
 import json
+import math
 import os
+import threading
 import time
 
+from urllib.parse import urlparse
+
 app = Flask(__name__)
 auto = Autodoc(app)
 
@@ -27,41 +43,371 @@ class DefaultSettings(object):
     REDIS_TOPIC = os.environ.get('REDIS_TOPIC') or "blah"
     REDIS_HOST = os.environ.get('REDIS_HOST') or 'redis'
     REDIS_PORT = os.environ.get('REDIS_PORT') or 6379
-    MAX_DUMMY_MSG_LENGTH = os.environ.get('MAX_DUMMY_MSG_LENGTH') or 1000
+    MAX_DUMMY_MSG_LENGTH = int(os.environ.get('MAX_DUMMY_MSG_LENGTH') or 1000)
+    MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE') or 1000)
+    # Request bodies larger than these are rejected before they are read.
+    # Form encoding can take up to three bytes per character of a document.
+    MAX_DUMMY_BODY_LENGTH = int(os.environ.get('MAX_DUMMY_BODY_LENGTH') or
+                                3 * MAX_DUMMY_MSG_LENGTH + 1024)
+    MAX_BATCH_BODY_LENGTH = int(os.environ.get('MAX_BATCH_BODY_LENGTH') or
+                                MAX_BATCH_SIZE * (MAX_DUMMY_MSG_LENGTH + 2))
+    # "celery" queues a task and publishes to REDIS_TOPIC, "stream" appends
+    # to REDIS_STREAM once, which both the stream worker and the websocket
+    # server read from.
+    INGEST_TRANSPORT = os.environ.get('INGEST_TRANSPORT') or 'celery'
+    REDIS_STREAM = os.environ.get('REDIS_STREAM') or 'incoming'
+    REDIS_STREAM_MAXLEN = int(os.environ.get('REDIS_STREAM_MAXLEN') or
+                              1000000)
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS') or 50)
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT') or 5)
+    REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT') or 1)
+    # Queue the Celery task and publish to REDIS_TOPIC in one pipelined
+    # round-trip over the broker connection. Only valid when the pubsub topic
+    # lives on the same Redis server as the broker.
+    PIPELINE_ENQUEUE = os.environ.get('PIPELINE_ENQUEUE') == '1'
+    STREAM_GROUP = os.environ.get('STREAM_GROUP') or 'persist'
+
+    # Requests with an Idempotency-Key header seen in the last DEDUPE_WINDOW
+    # seconds are dropped as duplicates. DEDUPE_BACKEND is "memory" (per
+    # process) or "redis" (shared between processes). 0 disables it.
+    DEDUPE_BACKEND = os.environ.get('DEDUPE_BACKEND') or 'memory'
+    DEDUPE_WINDOW = int(os.environ.get('DEDUPE_WINDOW') or 300)
+    DEDUPE_MAX_KEYS = int(os.environ.get('DEDUPE_MAX_KEYS') or 100000)
+
+    # Admission control, see admission.py. 0 disables a limit.
+    RATE_LIMIT = float(os.environ.get('RATE_LIMIT') or 0)
+    RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST') or
+                             max(1, 2 * RATE_LIMIT))
+    MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH') or 0)
+    MAX_WORKER_LAG = float(os.environ.get('MAX_WORKER_LAG') or 0)
+    BACKLOG_SAMPLE_INTERVAL = float(
+        os.environ.get('BACKLOG_SAMPLE_INTERVAL') or 1)
+    SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER') or 1)
+    BREAKER_FAILURE_THRESHOLD = int(
+        os.environ.get('BREAKER_FAILURE_THRESHOLD') or 5)
+    BREAKER_RECOVERY_TIMEOUT = int(
+        os.environ.get('BREAKER_RECOVERY_TIMEOUT') or 30)
+
+    # Documents that can't be queued are written to a spool in SPOOL_DIR and
+    # replayed once the broker is back, see spool.py. Empty disables it.
+    SPOOL_DIR = os.environ.get('SPOOL_DIR') or ''
+    SPOOL_SEGMENT_SIZE = int(os.environ.get('SPOOL_SEGMENT_SIZE') or
+                             16 * 2 ** 20)
+    SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES') or 2 ** 30)
+    SPOOL_FSYNC = os.environ.get('SPOOL_FSYNC') == '1'
+    SPOOL_DRAIN_INTERVAL = float(os.environ.get('SPOOL_DRAIN_INTERVAL') or 5)
+
+    # Set a last_write cookie on accepted writes so the List API reads from
+    # the writer for this many seconds afterwards. 0 disables it.
+    READ_AFTER_WRITE_WINDOW = int(
+        os.environ.get('READ_AFTER_WRITE_WINDOW') or 0)
+
+    # How message IDs without an idempotency key are made: uuid4 (random),
+    # or uuid7 or ulid, which sort by the millisecond they were made in.
+    # See ids.py.
+    MESSAGE_ID_SCHEME = os.environ.get('MESSAGE_ID_SCHEME') or 'uuid4'
 
 app.config.from_object('ingestion_api.DefaultSettings')
+# Fail at startup rather than on the first request.
+ids.get_generator(app.config['MESSAGE_ID_SCHEME'])
 
-redis_clients = []
+redis_clients = {}
 
 
-def make_redis_client():
+def make_redis_client(host, port, db=0):
     """
+    Make a client backed by its own bounded connection pool. Requests
+    block for up to REDIS_SOCKET_TIMEOUT waiting for a free connection
+    rather than opening an unbounded number of them.
     """
-    r = redis.StrictRedis(host=app.config['REDIS_HOST'],
-                          port=app.config['REDIS_PORT'])
-    p = r.pubsub()
-    p.subscribe(app.config['REDIS_TOPIC'])
-    return r
+    pool = redis.BlockingConnectionPool(
+        host=host, port=int(port), db=int(db),
+        max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+        timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+        socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+        socket_connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'])
+    return redis.StrictRedis(connection_pool=pool)
 
 
 def get_redis_client():
-    if len(redis_clients) == 0:
-        redis_clients.append(make_redis_client())
-    return redis_clients[0]
+    """
+    The client for the pubsub topic (and the ingest stream).
+    """
+    if 'pubsub' not in redis_clients:
+        redis_clients['pubsub'] = make_redis_client(
+            app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+    return redis_clients['pubsub']
 
 
-@circuit(failure_threshold=1, name='redis-task-queue')
-def enqueue_task(txt):
-    add.delay(txt)
+def get_broker_client():
+    """
+    A client for the Celery broker, used for pipelined enqueues.
+    """
+    if 'broker' not in redis_clients:
+        url = urlparse(tasks.broker)
+        redis_clients['broker'] = make_redis_client(
+            url.hostname, url.port or 6379, url.path.strip('/') or 0)
+    return redis_clients['broker']
+
+
+task_queue_circuit = circuit(
+    failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+    recovery_timeout=app.config['BREAKER_RECOVERY_TIMEOUT'],
+    name='redis-task-queue')
+
+
+def uses_stream():
+    return app.config['INGEST_TRANSPORT'] == 'stream'
+
+
+def publishes_separately():
+    """
+    Whether documents still need publishing after they have been queued.
+    """
+    return not uses_stream() and not app.config['PIPELINE_ENQUEUE']
+
+
+def enqueue_and_publish(task, args, kwargs, txts):
+    """
+    Queue a Celery task and publish documents to the pubsub topic in one
+    pipelined round-trip. Only a failure to queue the task is raised,
+    publishing stays best-effort.
+    """
+    queue, message = tasks.make_task_message(task, args, kwargs)
+    pipe = get_broker_client().pipeline(transaction=False)
+    pipe.lpush(queue, message)
+    for txt in txts:
+        pipe.publish(app.config['REDIS_TOPIC'], txt)
+    result = pipe.execute(raise_on_error=False)[0]
+    if isinstance(result, Exception):
+        raise result
+
+
+def append_to_stream(txts):
+    return streams.append(get_redis_client(), app.config['REDIS_STREAM'],
+                          txts, app.config['REDIS_STREAM_MAXLEN'])
+
+
+@task_queue_circuit
+def enqueue_task(txt, message_id, timestamp, keyed=False):
+    """
+    Queue a document for persisting and return its message ID. With the
+    stream transport the stream entry ID is the message ID. keyed says the
+    message ID may already be stored, see tasks.drop_stored.
+    """
+    if uses_stream():
+        return append_to_stream([txt])[0]
+    kwargs = {'message_id': message_id, 'timestamp': timestamp}
+    if keyed:
+        kwargs['keyed'] = True
+    if app.config['PIPELINE_ENQUEUE']:
+        enqueue_and_publish(add, (txt,), kwargs, [txt])
+    else:
+        add.delay(txt, **kwargs)
+    return message_id
+
+
+@task_queue_circuit
+def enqueue_batch(txts, message_ids, timestamp, keyed=False):
+    if uses_stream():
+        return append_to_stream(txts)
+    kwargs = {'message_ids': message_ids, 'timestamp': timestamp}
+    if keyed:
+        kwargs['keyed'] = True
+    if app.config['PIPELINE_ENQUEUE']:
+        enqueue_and_publish(add_batch, (txts,), kwargs, txts)
+    else:
+        add_batch.delay(txts, **kwargs)
+    return message_ids
+
+
+def make_message_id(key=None, index=None, now=None):
+    """
+    Assign a message ID at ingest time. IDs derived from an idempotency key
+    are the same for every retry of a request; other IDs follow
+    MESSAGE_ID_SCHEME, time ordered ones using now as the time.
+    """
+    if key is None:
+        return ids.get_generator(app.config['MESSAGE_ID_SCHEME'])(now)
+    if index is not None:
+        key = '%s/%d' % (key, index)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def scope_idempotency_key(key, client):
+    """
+    An Idempotency-Key scoped to the address of the client that sent it,
+    the same one rate limits go by, so that clients choosing the same key
+    don't have each other's documents dropped as duplicates.
+    """
+    if key is None:
+        return None
+    return '%s %s' % (client, key)
+
+
+dedupers = []
+
+
+def get_deduper():
+    if not app.config['DEDUPE_WINDOW']:
+        return None
+    if len(dedupers) == 0:
+        if app.config['DEDUPE_BACKEND'] == 'redis':
+            dedupers.append(dedupe.RedisDeduper(
+                get_redis_client(), app.config['DEDUPE_WINDOW'],
+                prefix='idempotency:'))
+        else:
+            dedupers.append(dedupe.MemoryDeduper(
+                app.config['DEDUPE_WINDOW'], app.config['DEDUPE_MAX_KEYS']))
+    return dedupers[0]
+
+
+def seen_idempotency_key(key):
+    """
+    Record an idempotency key, returning True if it was seen recently. If the
+    cache is unavailable the request is let through; the worker then drops
+    the duplicate when it finds the message ID already stored.
+    """
+    deduper = get_deduper()
+    if key is None or deduper is None:
+        return False
+    try:
+        return deduper.check_and_add(make_message_id(key))
+    except redis.exceptions.RedisError:
+        return False
+
+
+def forget_idempotency_key(key):
+    """
+    Forget a key whose request failed, so the client can retry it.
+    """
+    deduper = get_deduper()
+    if key is None or deduper is None:
+        return
+    try:
+        deduper.discard(make_message_id(key))
+    except redis.exceptions.RedisError:
+        pass
+
+
+spools = []
+
+
+def get_spool():
+    if not app.config['SPOOL_DIR']:
+        return None
+    if len(spools) == 0:
+        spools.append(spool.Spool(
+            app.config['SPOOL_DIR'], app.config['SPOOL_SEGMENT_SIZE'],
+            app.config['SPOOL_MAX_BYTES'], app.config['SPOOL_FSYNC']))
+    return spools[0]
+
+
+def spool_documents(txts, message_ids, timestamp):
+    """
+    Keep documents that couldn't be queued on local disk. Returns False if
+    there is no spool or it can't take them.
+    """
+    local_spool = get_spool()
+    if local_spool is None:
+        return False
+    try:
+        local_spool.append([(txt, message_id, timestamp) for txt, message_id
+                            in zip(txts, message_ids)])
+    except (spool.SpoolFull, OSError) as e:
+        logger.error("Spool unavailable", spool_failed=len(txts),
+                     exception=repr(e))
+        return False
+    logger.warning("Spooled documents", spooled=len(txts))
+    return True
+
+
+def replay_spooled(entries):
+    """
+    Queue and publish spooled entries, keeping their message IDs and
+    timestamps.
+    """
+    start = 0
+    while start < len(entries):
+        timestamp = entries[start][2]
+        end = start
+        while end < len(entries) and entries[end][2] == timestamp:
+            end += 1
+        txts = [txt for txt, _, _ in entries[start:end]]
+        # Spooled IDs may come from idempotency keys.
+        enqueue_batch(txts, [message_id for _, message_id, _ in
+                             entries[start:end]], timestamp, keyed=True)
+        try:
+            if publishes_separately():
+                publish_batch(txts)
+        except redis.exceptions.RedisError:
+            pass
+        start = end
+
+
+def drain_spool():
+    """
+    Replay the spool unless the task queue circuit is open. Returns the
+    number of documents replayed.
+    """
+    local_spool = get_spool()
+    if local_spool is None or task_queue_circuit.opened:
+        return 0
+    count = local_spool.drain(replay_spooled)
+    if count:
+        logger.info("Drained spool", replayed=count)
+    return count
+
+
+def run_spool_drainer():
+    while True:
+        time.sleep(app.config['SPOOL_DRAIN_INTERVAL'])
+        try:
+            drain_spool()
+        except BROKER_ERRORS + (OSError, ValueError) as e:
+            logger.warning("Spool drain failed", exception=repr(e))
+
+
+@app.before_first_request
+def start_spool_drainer():
+    if get_spool() is not None:
+        threading.Thread(target=run_spool_drainer, daemon=True).start()
+
+
+def make_accepted_response(**kwargs):
+    response = make_response(
+            json.dumps(dict(success=True, **kwargs)), 202,
+            {'Content-Type': 'application/json'})
+    if app.config['READ_AFTER_WRITE_WINDOW']:
+        response.set_cookie('last_write', str(int(time.time())),
+                            max_age=app.config['READ_AFTER_WRITE_WINDOW'])
+    return response
+
+
+def publish_batch(txts):
+    """
+    Publish a batch of documents to the pubsub topic in one round-trip.
+    """
+    pipe = get_redis_client().pipeline(transaction=False)
+    for txt in txts:
+        pipe.publish(app.config['REDIS_TOPIC'], txt)
+    pipe.execute()
 
 
 # Client Errors
 MISSING_FIELD = 1000
 INVALID_JSON = 1001
 MAX_DATA_SIZE = 1002
+RATE_LIMITED = 1003
+INVALID_ENCODING = 1004
 
 # Server Errors
 SERVICE_UNAVAILABLE = 2000
+OVERLOADED = 2001
+
+BROKER_ERRORS = (circuitbreaker.CircuitBreakerError,
+                 kombu.exceptions.KombuError,
+                 redis.exceptions.RedisError)
 
 
 def make_error_response(msg, code, status):
@@ -71,6 +417,146 @@ def make_error_response(msg, code, status):
         {'Content-Type': 'application/json'})
 
 
+class CappedStream(object):
+    """
+    Wrap a WSGI input stream and raise RequestEntityTooLarge as soon as more
+    than limit bytes have been read from it.
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.read_bytes = 0
+
+    def _size(self, size):
+        remaining = self.limit - self.read_bytes + 1
+        if size is None or size < 0:
+            return remaining
+        return min(size, remaining)
+
+    def _count(self, data):
+        self.read_bytes += len(data)
+        if self.read_bytes > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+    def read(self, size=-1):
+        return self._count(self.stream.read(self._size(size)))
+
+    def readline(self, size=-1):
+        return self._count(self.stream.readline(self._size(size)))
+
+
+body_limits = {
+    'create_dummy': 'MAX_DUMMY_BODY_LENGTH',
+    'create_dummy_batch': 'MAX_BATCH_BODY_LENGTH',
+}
+
+
+def sample_backlog():
+    """
+    Return the (queue_depth, worker_lag) in front of the workers. Worker lag
+    is only known for the stream transport.
+    """
+    if uses_stream():
+        return streams.backlog(get_redis_client(), app.config['REDIS_STREAM'],
+                               app.config['STREAM_GROUP'])
+    return get_broker_client().llen(tasks.app.conf.task_default_queue), None
+
+
+client_limiter = admission.ClientLimiter(app.config['RATE_LIMIT'],
+                                         app.config['RATE_LIMIT_BURST'])
+backlog_monitor = admission.BacklogMonitor(
+    sample_backlog, app.config['MAX_QUEUE_DEPTH'],
+    app.config['MAX_WORKER_LAG'], app.config['BACKLOG_SAMPLE_INTERVAL'],
+    errors=(redis.exceptions.RedisError,))
+
+admitted_endpoints = {'create_dummy', 'create_dummy_batch'}
+
+
+def make_retry_response(msg, code, retry_after):
+    response = make_error_response(msg, code, 429)
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+@app.before_request
+def admit_request():
+    """
+    Turn requests away with 429 when the client is over its rate limit or
+    the workers are too far behind.
+    """
+    if request.endpoint not in admitted_endpoints:
+        return
+    if client_limiter.rate:
+        wait = client_limiter.take(request.remote_addr)
+        if wait:
+            return make_retry_response(
+                    "Too many requests", RATE_LIMITED, wait
+            )
+    if backlog_monitor.shedding():
+        logger.warning("Shedding load", shed=1,
+                       queue_depth=backlog_monitor.depth,
+                       worker_lag=backlog_monitor.lag)
+        return make_retry_response(
+                "Overloaded", OVERLOADED, app.config['SHED_RETRY_AFTER']
+        )
+
+
+@app.before_request
+def limit_body_length():
+    """
+    Reject oversized bodies from their Content-Length before reading any of
+    them, and cap the input stream for bodies sent without one.
+    """
+    setting = body_limits.get(request.endpoint)
+    if setting is None:
+        return
+    limit = app.config[setting]
+    if request.content_length is not None and request.content_length > limit:
+        return make_error_response(
+                "Data too large", MAX_DATA_SIZE, 400
+        )
+    request.environ['wsgi.input'] = CappedStream(
+        request.environ['wsgi.input'], limit)
+    if request.headers.get('Content-Encoding'):
+        return decode_request_body(limit)
+
+
+def decode_request_body(limit):
+    """
+    Decompress a gzip or zstd encoded body up front, so the rest of the
+    request handling sees the plain body. The decompressed body is subject
+    to the same limit as the compressed one.
+    """
+    try:
+        body = compression.decode_body(request.stream.read(),
+                                       request.headers['Content-Encoding'],
+                                       limit)
+    except compression.TooLarge:
+        return make_error_response(
+                "Data too large", MAX_DATA_SIZE, 400
+        )
+    except KeyError:
+        return make_error_response(
+                "Unsupported Content-Encoding", INVALID_ENCODING, 415
+        )
+    except ValueError:
+        return make_error_response(
+                "Invalid compressed data", INVALID_ENCODING, 400
+        )
+    # Replace the (cached) stream and length werkzeug parses the body from.
+    request.__dict__['stream'] = io.BytesIO(body)
+    request.__dict__['content_length'] = len(body)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def data_too_large(e):
+    return make_error_response(
+            "Data too large", MAX_DATA_SIZE, 400
+    )
+
+
 @app.route('/dummy', methods=['POST'])
 @auto.doc()
 def create_dummy():
@@ -83,27 +569,61 @@ def create_dummy():
 
     create_api = 'http://127.0.0.1:6000/dummy'
     requests.post(create_api, data={'data': json.dumps({'testdatum': 'a'})})
+
+    Clients that retry can send an Idempotency-Key header. Repeats of a key
+    from the same client address within the deduplication window are
+    accepted but not stored again. The response contains the message ID
+    assigned to the document.
+
+    If the broker is unavailable and a spool is configured, the document is
+    kept on local disk, queued later and the response has "spooled": true.
     """
     _t_start = time.time()
     try:
-        data = json.loads(request.form['data'])
-        enqueue_task(request.form['data'])
+        data = request.form['data']
     except KeyError:
         return make_error_response(
                 "Missing data field", MISSING_FIELD, 400
         )
+    if len(data) > app.config['MAX_DUMMY_MSG_LENGTH']:
+        return make_error_response(
+                "Data too large", MAX_DATA_SIZE, 400
+        )
+
+    try:
+        jsoncheck.validate(data)
     except ValueError:
         return make_error_response(
                 "Invalid JSON", INVALID_JSON, 400
         )
-    except (circuitbreaker.CircuitBreakerError, kombu.exceptions.KombuError):
+
+    key = scope_idempotency_key(request.headers.get('Idempotency-Key'),
+                                request.remote_addr)
+    if seen_idempotency_key(key):
+        logger.info("create_dummy.duplicate", duplicate=1)
+        if uses_stream():
+            return make_accepted_response(duplicate=True)
+        return make_accepted_response(message_id=make_message_id(key),
+                                      duplicate=True)
+
+    now = time.time()
+    message_id = make_message_id(key, now=now)
+    timestamp = int(now)
+    try:
+        message_id = enqueue_task(data, message_id, timestamp,
+                                  keyed=key is not None)
+    except BROKER_ERRORS:
+        if spool_documents([data], [message_id], timestamp):
+            return make_accepted_response(message_id=message_id,
+                                          spooled=True)
+        forget_idempotency_key(key)
         return make_error_response(
                 "Service Unavailable", SERVICE_UNAVAILABLE, 503
         )
 
     try:
-        get_redis_client().publish(app.config['REDIS_TOPIC'],
-                                   request.form['data'])
+        if publishes_separately():
+            get_redis_client().publish(app.config['REDIS_TOPIC'], data)
     except redis.exceptions.RedisError:
         # TODO: output a log here.
         # We don't care about pubsub exceptions,
@@ -111,10 +631,129 @@ def create_dummy():
         pass
 
     logger.info("create_dummy", duration=time.time()-_t_start)
-    return make_response(
-            json.dumps({'success': True}), 202,
+    return make_accepted_response(message_id=message_id)
+
+
+def split_batch(body):
+    """
+    Split a batch request body into individual documents.
+
+    The body is either a JSON array of documents or newline delimited JSON
+    with one document per line. Returns a list of (text, error) tuples where
+    error is None for valid documents. Raises ValueError if the body is a
+    JSON array that can't be decoded.
+    """
+    max_length = app.config['MAX_DUMMY_MSG_LENGTH']
+    too_large = (None, ("Data too large", MAX_DATA_SIZE))
+
+    stripped = body.lstrip()
+    if stripped.startswith('['):
+        items = [json.dumps(item) for item in json.loads(stripped)]
+        return [too_large if len(txt) > max_length else (txt, None)
+                for txt in items]
+
+    results = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        if len(line) > max_length:
+            results.append(too_large)
+            continue
+        try:
+            jsoncheck.validate(line)
+        except ValueError:
+            results.append((None, ("Invalid JSON", INVALID_JSON)))
+        else:
+            results.append((line, None))
+    return results
+
+
+@app.route('/dummy/batch', methods=['POST'])
+@auto.doc()
+def create_dummy_batch():
+    """
+    Create many dummy documents at once. The request body is either a JSON
+    array of documents or newline delimited JSON (one document per line).
+
+    Every document is validated individually. Valid documents are queued
+    together as a single task and 202 is returned along with the number of
+    accepted documents and an "errors" list with the index, message and code
+    of each rejected document. If no document is valid 400 is returned.
+    An Idempotency-Key header applies to the batch as a whole.
+    Example request:
+
+    batch_api = 'http://127.0.0.1:6000/dummy/batch'
+    requests.post(batch_api, data='{"testdatum": "a"}\n{"testdatum": "b"}')
+    """
+    _t_start = time.time()
+    body = request.get_data(as_text=True)
+    if not body.strip():
+        return make_error_response(
+                "Missing data", MISSING_FIELD, 400
+        )
+    try:
+        items = split_batch(body)
+    except ValueError:
+        return make_error_response(
+                "Invalid JSON", INVALID_JSON, 400
+        )
+    if len(items) > app.config['MAX_BATCH_SIZE']:
+        return make_error_response(
+                "Too many documents", MAX_DATA_SIZE, 400
+        )
+
+    key = scope_idempotency_key(request.headers.get('Idempotency-Key'),
+                                request.remote_addr)
+    accepted = [txt for txt, error in items if error is None]
+    now = time.time()
+    message_ids = [make_message_id(key, i, now)
+                   for i, (txt, error) in enumerate(items) if error is None]
+    errors = [
+        {'index': i, 'error': error[0], 'code': error[1]}
+        for i, (txt, error) in enumerate(items) if error is not None
+    ]
+    if not accepted:
+        return make_response(json.dumps(
+            {'error': "No valid documents",
+             'code': INVALID_JSON,
+             'errors': errors}), 400,
             {'Content-Type': 'application/json'})
 
+    if seen_idempotency_key(key):
+        logger.info("create_dummy_batch.duplicate", duplicate=1)
+        if uses_stream():
+            return make_accepted_response(duplicate=True)
+        return make_accepted_response(accepted=len(accepted),
+                                      message_ids=message_ids,
+                                      errors=errors, duplicate=True)
+
+    timestamp = int(now)
+    try:
+        message_ids = enqueue_batch(accepted, message_ids, timestamp,
+                                    keyed=key is not None)
+    except BROKER_ERRORS:
+        if spool_documents(accepted, message_ids, timestamp):
+            return make_accepted_response(accepted=len(accepted),
+                                          message_ids=message_ids,
+                                          errors=errors, spooled=True)
+        forget_idempotency_key(key)
+        return make_error_response(
+                "Service Unavailable", SERVICE_UNAVAILABLE, 503
+        )
+
+    try:
+        if publishes_separately():
+            publish_batch(accepted)
+    except redis.exceptions.RedisError:
+        # Best-effort, as with single documents.
+        pass
+
+    logger.info("create_dummy_batch", duration=time.time()-_t_start,
+                count=len(accepted))
+    return make_accepted_response(accepted=len(accepted),
+                                  message_ids=message_ids,
+                                  errors=errors)
+
 
 @app.route('/documentation', methods=['GET'])
 @auto.doc()
@@ -126,7 +765,17 @@ def documentation():
 @app.route('/health', methods=['GET'])
 @auto.doc()
 def health():
-    """Return some health information. For now just open circuit breakers"""
-    return json.dumps(
-        {x.name: 'open' for x in CircuitBreakerMonitor.get_open()}
+    """
+    Return some health information: the open circuit breakers, plus the
+    admission control state under "admission" and the local spool under
+    "spool".
+    """
+    status = {x.name: 'open' for x in CircuitBreakerMonitor.get_open()}
+    status['admission'] = dict(
+        backlog_monitor.state(),
+        rate_limit=client_limiter.rate,
+        tracked_clients=len(client_limiter.buckets),
     )
+    if get_spool() is not None:
+        status['spool'] = get_spool().state()
+    return json.dumps(status)
@@ -0,0 +1,307 @@
+"""
+Asyncio (ASGI) variant of the ingestion API.
+
+This serves the same /dummy, /health and /documentation endpoints as
+ingestion_api.py, but talks to the task broker and the pubsub service with
+non-blocking Redis clients, so a single process can have many requests in
+flight at once. Run it with any ASGI server, e.g.:
+
+    uvicorn ingestion_asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import functools
+import html
+import json
+import os
+import time
+import urllib.parse
+
+import asyncio_redis
+import structlog
+
+from circuitbreaker import CircuitBreakerError, CircuitBreakerMonitor
+
+import compression
+import jsoncheck
+import tasks
+from ingestion_api import (app as flask_app, task_queue_circuit,
+                           make_message_id, scope_idempotency_key,
+                           MISSING_FIELD, INVALID_JSON,
+                           MAX_DATA_SIZE, INVALID_ENCODING,
+                           SERVICE_UNAVAILABLE)
+
+logger = structlog.get_logger()
+
+config = flask_app.config
+POOL_SIZE = int(os.environ.get('ASYNC_REDIS_POOL_SIZE') or 10)
+
+BROKER_ERRORS = (CircuitBreakerError, asyncio_redis.Error, OSError)
+PUBSUB_ERRORS = (asyncio_redis.Error, OSError)
+
+redis_pools = {}
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+def async_circuit(breaker):
+    """
+    Apply a circuit breaker to a coroutine function.
+
+    Failures and successes are recorded through the breaker's call() method
+    so the breaker behaves exactly as it does for the decorated functions
+    in ingestion_api (and shows up in the same CircuitBreakerMonitor).
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if breaker.opened:
+                raise CircuitBreakerError(breaker)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                def reraise():
+                    raise e
+                breaker.call(reraise)
+                raise
+            breaker.call(lambda: None)
+            return result
+        return wrapper
+    return decorate
+
+
+async def get_redis_pool(host, port, db=0):
+    """
+    Return a connection pool for the given server, creating it on first use.
+    Concurrent callers share the pool that is being created.
+    """
+    key = (host, int(port), int(db))
+    if key not in redis_pools:
+        redis_pools[key] = asyncio.ensure_future(asyncio_redis.Pool.create(
+            host=key[0], port=key[1], db=key[2], poolsize=POOL_SIZE))
+    try:
+        return await redis_pools[key]
+    except Exception:
+        # Let the next caller try to connect again.
+        redis_pools.pop(key, None)
+        raise
+
+
+def get_broker_pool():
+    url = urllib.parse.urlparse(tasks.broker)
+    db = url.path.strip('/') or 0
+    return get_redis_pool(url.hostname, url.port or 6379, db)
+
+
+def get_pubsub_pool():
+    return get_redis_pool(config['REDIS_HOST'], config['REDIS_PORT'])
+
+
+@async_circuit(task_queue_circuit)
+async def enqueue_task(txt, message_id, timestamp, keyed=False):
+    kwargs = {'message_id': message_id, 'timestamp': timestamp}
+    if keyed:
+        kwargs['keyed'] = True
+    queue, message = tasks.make_task_message(tasks.add, (txt,), kwargs)
+    pool = await get_broker_pool()
+    await pool.lpush(queue, [message])
+
+
+def make_response(content, status=200, content_type='application/json'):
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return status, content_type, content
+
+
+def make_error_response(msg, code, status):
+    return make_response(json.dumps({'error': msg, 'code': code}), status)
+
+
+def get_header(scope, header):
+    for name, value in scope.get('headers', []):
+        if name.lower() == header:
+            return value.decode('latin-1')
+
+
+async def create_dummy(scope, body):
+    """
+    Create a dummy document. On success this will return 202 to
+    indicate that the document has been accepted for processing.
+
+    This endpoint takes a form encoded POST data field called "data",
+    which is a JSON encoded document. Example request:
+
+    create_api = 'http://127.0.0.1:6000/dummy'
+    requests.post(create_api, data={'data': json.dumps({'testdatum': 'a'})})
+
+    An Idempotency-Key header makes retries of a request use the same message
+    ID, and the worker skips documents whose message ID is already stored,
+    so the document is only stored once. The response contains the message
+    ID assigned to the document.
+    """
+    _t_start = time.time()
+    try:
+        form = urllib.parse.parse_qs(body.decode('utf-8'),
+                                     keep_blank_values=True)
+        txt = form['data'][0]
+    except KeyError:
+        return make_error_response(
+                "Missing data field", MISSING_FIELD, 400
+        )
+    except ValueError:
+        return make_error_response(
+                "Invalid JSON", INVALID_JSON, 400
+        )
+    if len(txt) > config['MAX_DUMMY_MSG_LENGTH']:
+        return make_error_response(
+                "Data too large", MAX_DATA_SIZE, 400
+        )
+
+    now = time.time()
+    key = scope_idempotency_key(get_header(scope, b'idempotency-key'),
+                                (scope.get('client') or [None])[0])
+    message_id = make_message_id(key, now=now)
+    try:
+        jsoncheck.validate(txt)
+        await enqueue_task(txt, message_id, int(now), keyed=key is not None)
+    except ValueError:
+        return make_error_response(
+                "Invalid JSON", INVALID_JSON, 400
+        )
+    except BROKER_ERRORS:
+        return make_error_response(
+                "Service Unavailable", SERVICE_UNAVAILABLE, 503
+        )
+
+    try:
+        pool = await get_pubsub_pool()
+        await pool.publish(config['REDIS_TOPIC'], txt)
+    except PUBSUB_ERRORS:
+        # Best-effort, as in ingestion_api.
+        pass
+
+    logger.info("create_dummy", duration=time.time()-_t_start)
+    return make_response(
+        json.dumps({'success': True, 'message_id': message_id}), 202)
+
+
+async def documentation(scope, body):
+    """This documentation ;)"""
+    sections = [
+        '<h2>%s %s</h2><pre>%s</pre>' % (
+            method, html.escape(path), html.escape(handler.__doc__ or ''))
+        for (path, method), handler in sorted(routes.items())
+    ]
+    return make_response('<html><body>%s</body></html>' % ''.join(sections),
+                         content_type='text/html')
+
+
+async def health(scope, body):
+    """Return some health information. For now just open circuit breakers"""
+    return make_response(json.dumps(
+        {x.name: 'open' for x in CircuitBreakerMonitor.get_open()}
+    ))
+
+
+routes = {
+    ('/dummy', 'POST'): create_dummy,
+    ('/documentation', 'GET'): documentation,
+    ('/health', 'GET'): health,
+}
+
+body_limits = {
+    '/dummy': 'MAX_DUMMY_BODY_LENGTH',
+}
+
+
+def get_content_length(scope):
+    try:
+        return int(get_header(scope, b'content-length'))
+    except (TypeError, ValueError):
+        return None
+
+
+async def read_body(receive, limit=None):
+    """
+    Read the request body, raising PayloadTooLarge as soon as more than
+    limit bytes have arrived.
+    """
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise PayloadTooLarge()
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def handle(handler, scope, receive):
+    limit = None
+    if scope['path'] in body_limits:
+        limit = config[body_limits[scope['path']]]
+    try:
+        content_length = get_content_length(scope)
+        if limit is not None and (content_length or 0) > limit:
+            raise PayloadTooLarge()
+        body = await read_body(receive, limit)
+        encoding = get_header(scope, b'content-encoding')
+        if encoding is not None and limit is not None:
+            body = compression.decode_body(body, encoding, limit)
+    except (PayloadTooLarge, compression.TooLarge):
+        return make_error_response(
+                "Data too large", MAX_DATA_SIZE, 400
+        )
+    except KeyError:
+        return make_error_response(
+                "Unsupported Content-Encoding", INVALID_ENCODING, 415
+        )
+    except ValueError:
+        return make_error_response(
+                "Invalid compressed data", INVALID_ENCODING, 400
+        )
+    return await handler(scope, body)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for pool in redis_pools.values():
+                if pool.done() and not pool.exception():
+                    pool.result().close()
+            redis_pools.clear()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    handler = routes.get((scope['path'], scope['method']))
+    if handler is None:
+        if any(path == scope['path'] for path, _ in routes):
+            status, content_type, content = make_response(
+                'Method Not Allowed', 405, 'text/plain')
+        else:
+            status, content_type, content = make_response(
+                'Not Found', 404, 'text/plain')
+    else:
+        status, content_type, content = await handle(handler, scope,
+                                                     receive)
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('ascii')),
+                    (b'content-length', str(len(content)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': content})
@@ -0,0 +1,88 @@
+"""
+Check that a document is valid JSON without keeping the decoded result.
+
+The ingestion APIs only need to know whether a document is valid, so when
+pysimdjson is installed its lazy parser is used, which validates without
+building Python objects. Otherwise orjson is used if available, falling
+back to the standard library. Set JSON_VALIDATOR to "simdjson", "orjson" or
+"json" to pick a backend explicitly.
+
+The standard library accepts NaN, Infinity and -Infinity, which aren't
+JSON. validate_strict rejects them, for documents that are embedded in
+responses as they are.
+"""
+import json
+import os
+import threading
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_local = threading.local()
+
+
+def _to_bytes(txt):
+    if isinstance(txt, str):
+        return txt.encode('utf-8')
+    return txt
+
+
+def validate_simdjson(txt):
+    # Parsers are reusable but not thread-safe, so keep one per thread.
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = simdjson.Parser()
+    doc = parser.parse(_to_bytes(txt))
+    del doc
+
+
+def validate_orjson(txt):
+    orjson.loads(txt)
+
+
+def validate_json(txt):
+    if isinstance(txt, bytes):
+        txt = txt.decode('utf-8')
+    json.loads(txt)
+
+
+def reject_constant(name):
+    raise ValueError("%s is not valid JSON" % name)
+
+
+def validate_json_strict(txt):
+    if isinstance(txt, bytes):
+        txt = txt.decode('utf-8')
+    json.loads(txt, parse_constant=reject_constant)
+
+
+backends = {'json': validate_json}
+if orjson is not None:
+    backends['orjson'] = validate_orjson
+if simdjson is not None:
+    backends['simdjson'] = validate_simdjson
+
+
+def get_validator(name=None):
+    """
+    Return the validator called name, or the fastest one installed.
+    """
+    if name:
+        return backends[name]
+    for name in ('simdjson', 'orjson', 'json'):
+        if name in backends:
+            return backends[name]
+
+
+validate = get_validator(os.environ.get('JSON_VALIDATOR'))
+# orjson follows the RFC, so it is strict as it is.
+validate_strict = validate_orjson if orjson is not None else \
+    validate_json_strict
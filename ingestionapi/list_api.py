@@ -1,10 +1,23 @@
+import hashlib
+import heapq
+import itertools
 import json
 import os
 import time
 
-from flask import request, make_response
-from db import app, db, Records
+from concurrent.futures import ThreadPoolExecutor
 
+from flask import request, make_response, Response
+from db import (app, db, Records, record_data, get_engine,
+                get_shard_engines, pool_stats)
+
+import compression
+import cursors
+import jsoncheck
+import pagecache
+import rollups
+
+import redis
 import structlog
 
 
@@ -12,6 +25,294 @@ logger = structlog.get_logger()
 
 
 COUNT_VALUE = int(os.environ.get('COUNT_VALUE', 10))
+# Accepting this media type (or passing data=raw) gets documents embedded in
+# /records responses as JSON rather than as JSON encoded strings.
+RAW_MEDIA_TYPE = 'application/vnd.records.raw+json'
+# Responses at least this big are gzipped for clients that accept it.
+GZIP_MIN_LENGTH = int(os.environ.get('GZIP_MIN_LENGTH', 512))
+# Rows fetched from the server-side cursor at a time by /records/export.
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+
+# Clients whose last_write cookie (or X-Last-Write header), set by the
+# Ingestion API, is less than READ_AFTER_WRITE_WINDOW seconds old read from
+# the writer, so they see their own writes despite replication lag.
+READ_AFTER_WRITE_WINDOW = int(os.environ.get('READ_AFTER_WRITE_WINDOW', 0))
+
+# Queries against sharded records run on up to this many shards at once.
+SCATTER_THREADS = int(os.environ.get('SCATTER_THREADS', 16))
+scatter_pool = ThreadPoolExecutor(max_workers=SCATTER_THREADS)
+
+# Pages whose records are all older than PAGE_CACHE_LAG seconds can't gain
+# new records and are cached: up to PAGE_CACHE_BYTES in each process (0
+# disables the cache) and, if PAGE_CACHE_REDIS_URL is set, in Redis. Entries
+# expire after PAGE_CACHE_TTL seconds, or sooner when retention would purge
+# a record on the page first. PAGE_CACHE_LAG must cover the longest delay
+# between a document being accepted and written.
+PAGE_CACHE_LAG = int(os.environ.get('PAGE_CACHE_LAG', 300))
+PAGE_CACHE_BYTES = int(os.environ.get('PAGE_CACHE_BYTES', 64 * 2 ** 20))
+PAGE_CACHE_REDIS_URL = os.environ.get('PAGE_CACHE_REDIS_URL')
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 86400))
+
+
+def make_page_cache():
+    if not PAGE_CACHE_BYTES:
+        return None
+    shared = None
+    if PAGE_CACHE_REDIS_URL:
+        shared = pagecache.RedisCache(
+            redis.StrictRedis.from_url(PAGE_CACHE_REDIS_URL,
+                                       socket_timeout=1),
+            PAGE_CACHE_TTL)
+    return pagecache.PageCache(
+        pagecache.LRUCache(PAGE_CACHE_BYTES, PAGE_CACHE_TTL), shared,
+        errors=(redis.exceptions.RedisError,))
+
+
+page_cache = make_page_cache()
+
+
+@app.after_request
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if (response.is_streamed or
+            'Content-Encoding' in response.headers or
+            not compression.accepts_gzip(
+                request.headers.get('Accept-Encoding'))):
+        return response
+    data = response.get_data()
+    if len(data) >= GZIP_MIN_LENGTH:
+        response.set_data(compression.gzip_body(data))
+        response.headers['Content-Encoding'] = 'gzip'
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(etag + '-gzip', weak)
+    return response
+
+
+# Client Errors
+INVALID_TOKEN = 1100
+INVALID_PARAMETER = 1101
+
+
+def make_error_response(msg, code, status):
+    return make_response(json.dumps(
+        {'error': msg,
+         'code': code}), status,
+        {'Content-Type': 'application/json'})
+
+
+def optional_int(name):
+    value = request.args.get(name)
+    return None if value in (None, '') else int(value)
+
+
+def get_listing():
+    """
+    Return the Cursor for a request: decoded from the next token, or for the
+    first page from the since, until and order parameters. Raises ValueError
+    (with the error code as its second argument) for invalid parameters.
+    """
+    token = request.args.get('next')
+    if token is not None:
+        try:
+            return cursors.decode(token)
+        except ValueError:
+            raise ValueError("Invalid next token", INVALID_TOKEN)
+    try:
+        since = optional_int('since')
+        until = optional_int('until')
+    except ValueError:
+        raise ValueError("Invalid since or until", INVALID_PARAMETER)
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("Invalid order", INVALID_PARAMETER)
+    return cursors.Cursor(None, None, False, order == 'desc', since, until)
+
+
+def range_conditions(cursor, params):
+    conditions = []
+    if cursor.since is not None:
+        conditions.append("timestamp >= :since")
+        params['since'] = cursor.since
+    if cursor.until is not None:
+        conditions.append("timestamp < :until")
+        params['until'] = cursor.until
+    return conditions
+
+
+def page_query(cursor, count):
+    """
+    Build the SQL for a page of records after cursor, or for all of them
+    if count is None.
+
+    The keyset predicate is written out so that the leading timestamp range
+    lets the database seek straight to the cursor on the primary key instead
+    of scanning everything before it, in either direction.
+    """
+    query = "SELECT timestamp, message_id, record, record_z FROM records "
+    params = {}
+    conditions = range_conditions(cursor, params)
+    if cursor.timestamp is not None:
+        if cursor.desc:
+            conditions.append(
+                "timestamp <= :timestamp AND "
+                "(timestamp < :timestamp OR message_id < :message_id)")
+        else:
+            conditions.append(
+                "timestamp >= :timestamp AND "
+                "(timestamp > :timestamp OR message_id %s :message_id)"
+                % ('>=' if cursor.inclusive else '>'))
+        params.update(timestamp=cursor.timestamp,
+                      message_id=cursor.message_id)
+    if conditions:
+        query += "WHERE %s " % " AND ".join(conditions)
+    if cursor.desc:
+        query += "ORDER BY timestamp DESC, message_id DESC"
+    else:
+        query += "ORDER BY timestamp, message_id"
+    if count is not None:
+        query += " LIMIT :count"
+        params['count'] = count
+    return query, params
+
+
+def read_role():
+    """
+    The role to read as for this request.
+    """
+    if READ_AFTER_WRITE_WINDOW:
+        last_write = (request.cookies.get('last_write') or
+                      request.headers.get('X-Last-Write'))
+        try:
+            if time.time() - int(last_write) < READ_AFTER_WRITE_WINDOW:
+                return 'writer'
+        except (TypeError, ValueError):
+            pass
+    return 'reader'
+
+
+def read_engines():
+    """
+    The engines to read records from for this request: every shard, or the
+    one database.
+    """
+    role = read_role()
+    return get_shard_engines(role) or [get_engine(role)]
+
+
+def fetch_from(engine, query, params):
+    with engine.connect() as connection:
+        return connection.execute(db.text(query), params).fetchall()
+
+
+def scatter(query, params):
+    """
+    Run a query on every engine holding records, in parallel. Returns a list
+    of the rows from each.
+    """
+    engines = read_engines()
+    if len(engines) == 1:
+        return [fetch_from(engines[0], query, params)]
+    return list(scatter_pool.map(
+        lambda engine: fetch_from(engine, query, params), engines))
+
+
+def row_key(row):
+    return row[0], row[1]
+
+
+def fetch_rows(query, params, desc=False, limit=None):
+    """
+    Run a query ordered by (timestamp, message_id) on every engine and merge
+    the results in that order, keeping the first limit rows.
+    """
+    rows = heapq.merge(*scatter(query, params), key=row_key, reverse=desc)
+    return list(itertools.islice(rows, limit))
+
+
+def estimate_count(cursor):
+    """
+    Estimate the number of records in the cursor's range. MySQL's row
+    estimate for the primary key range is used where available, which
+    doesn't touch the rows themselves; other databases count exactly.
+    Returns (count, estimated).
+    """
+    params = {}
+    conditions = range_conditions(cursor, params)
+    where = "WHERE %s" % " AND ".join(conditions) if conditions else ""
+    if read_engines()[0].dialect.name == 'mysql':
+        plans = scatter("EXPLAIN SELECT timestamp FROM records %s" % where,
+                        params)
+        return sum(int(row['rows'] or 0)
+                   for plan in plans for row in plan), True
+    counts = scatter("SELECT COUNT(*) FROM records %s" % where, params)
+    return sum(rows[0][0] for rows in counts), False
+
+
+def page_key(cursor, count, raw):
+    # Versioned as the values went from bare bodies to "<expires> <body>".
+    return ':'.join(str(field) for field in ('v2',) + cursor + (count, raw))
+
+
+def page_is_immutable(cursor, rows, count, now):
+    """
+    Whether no record can be added to the page any more: the newest
+    timestamp the page could hold is older than the ingest lag window. The
+    first page never is, as purging old records moves its start.
+    """
+    if cursor.timestamp is None:
+        return False
+    newest = None
+    if cursor.until is not None:
+        newest = cursor.until - 1
+    if cursor.desc:
+        if cursor.timestamp is not None:
+            newest = cursor.timestamp
+    elif len(rows) == count:
+        newest = rows[-1][0]
+    return newest is not None and newest < now - PAGE_CACHE_LAG
+
+
+def page_expiry(cursor, rows, count, now):
+    """
+    Until when a page can be cached: PAGE_CACHE_TTL seconds, but no longer
+    than until its oldest record is due to be purged. None if the page can
+    still change.
+    """
+    if not page_is_immutable(cursor, rows, count, now):
+        return None
+    expires = int(now) + PAGE_CACHE_TTL
+    retention = app.config['RECORD_RETENTION']
+    if retention and rows:
+        expires = min(expires, min(row[0] for row in rows) + retention)
+    return expires if expires > now else None
+
+
+def wants_raw_data():
+    """
+    Whether the client asked for documents embedded as JSON, with data=raw
+    or by accepting RAW_MEDIA_TYPE.
+    """
+    if 'data' in request.args:
+        return request.args['data'] == 'raw'
+    return any(value == RAW_MEDIA_TYPE and quality > 0
+               for value, quality in request.accept_mimetypes)
+
+
+def not_modified(etag):
+    return etag in request.if_none_match or (
+        etag + '-gzip' in request.if_none_match)
+
+
+def gzip_etag(etag, body):
+    """
+    The ETag a 200 with body gets for this client: compress_response adds
+    "-gzip" when it compresses the body.
+    """
+    if len(body) >= GZIP_MIN_LENGTH and compression.accepts_gzip(
+            request.headers.get('Accept-Encoding')):
+        return etag + '-gzip'
+    return etag
 
 
 @app.route('/records', methods=['GET'])
@@ -19,69 +320,254 @@ def list_dummy_records():
     """
     List dummy records by paging through them.
 
+    Optional URL parameters:
+    - since: Only records with a timestamp at or after this
+    - until: Only records with a timestamp before this
+    - order: "asc" (oldest first, the default) or "desc"
+    The next token carries these, so later pages only need "next".
+
+    Responses have a strong ETag, so clients can revalidate with
+    If-None-Match. Pages that can no longer change are served from a cache
+    and marked immutable until their oldest record is due to be purged.
+
     The return value is a dictionary containing:
     - results: A list of result dictionaries
-    - next: A token to use to retrieve the next page
-            via the "next" URL parameter
+    - next: An opaque token to use to retrieve the next page
+            via the "next" URL parameter, or null after the
+            last page
     - count: The number of results
 
     A result dictionary consists of:
     - timestamp: Corresponds to (roughly) when the record
                  was written to the DB
     - message_id: A UUID to uniquely identify the message
-    - data: The JSON encoded message.
+    - data: The JSON encoded message. With data=raw (or an Accept
+            header of application/vnd.records.raw+json) the
+            message itself (still a string if it isn't valid JSON),
+            null if there is none.
     """
     _t_start = time.time()
-    timestamp = None
-    message_id = None
     try:
-        next_token = request.args.get('next')
-        if next_token is not None:
-            timestamp, message_id = request.args.get('next').split('_')
-            timestamp = int(timestamp)
-    except ValueError:
-        return make_response(json.dumps(
-            {"error": "Invalid next token", "code": 1100}), 400,
-            {"Content-Type": 'application/json'})
+        cursor = get_listing()
+    except ValueError as e:
+        return make_error_response(e.args[0], e.args[1], 400)
 
-    _t_start2 = time.time()
-    if timestamp is not None and message_id is not None:
-        records = db.session.query(Records).from_statement(
-            db.text(
-                "SELECT * FROM records WHERE timestamp >= :timestamp and "
-                "message_id >= :message_id "
-                "ORDER BY timestamp, message_id LIMIT :count"
-            ).params(timestamp=timestamp, message_id=message_id,
-                     count=COUNT_VALUE+1))
+    raw = wants_raw_data()
+    key = page_key(cursor, COUNT_VALUE, raw)
+    cached = page_cache.get(key) if page_cache is not None else None
+    now = int(time.time())
+    body = None
+    if cached is not None:
+        # Cached bodies are prefixed with the time they expire.
+        expires, body = cached.split(b' ', 1)
+        expires = int(expires)
+        if expires <= now:
+            cached = body = None
+    if body is None:
+        body, expires = render_page(cursor, raw)
+        if expires is not None and page_cache is not None:
+            page_cache.set(key, b'%d %s' % (expires, body), expires - now)
+
+    etag = hashlib.sha1(body).hexdigest()
+    if expires is not None and expires > now:
+        cache_control = 'public, max-age=%d, immutable' % (expires - now)
+    else:
+        cache_control = 'no-cache'
+    # For want of a better way, output a metric.
+    logger.info("records.duration", duration=time.time()-_t_start, count=1,
+                cached=int(cached is not None))
+    if not_modified(etag):
+        # The same validator as the 200, which compress_response won't
+        # adjust for an empty body.
+        response = make_response(b'', 304)
+        response.set_etag(gzip_etag(etag, body))
     else:
-        records = db.session.query(Records).from_statement(
-            db.text(
-                "SELECT * FROM records ORDER BY "
-                "timestamp, message_id LIMIT :count"
-                ).params(count=COUNT_VALUE+1))
-
-    result_set = [
-            {'timestamp': r.timestamp, 'message_id': r.message_id,
-             'data': r.record}
-            for r in records
-    ]
+        response = make_response(
+                body, 200,
+                {'Content-Type': 'application/json'})
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept')
+    return response
+
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+def encode_data(data, raw=False):
+    """
+    A stored document as JSON: null if there is none, otherwise a string,
+    or with raw the document itself as long as it is valid JSON.
+    """
+    if data is None:
+        return 'null'
+    if raw:
+        try:
+            jsoncheck.validate_strict(data)
+        except ValueError:
+            pass
+        else:
+            return data
+    return encode_string(data)
+
+
+def render_page(cursor, raw=False):
+    """
+    Query and serialise a page of records. Returns the body and until when
+    it can be cached (see page_expiry).
+
+    Rows are fetched as plain tuples and written straight into the output
+    rather than going through ORM instances and a dict per record. With raw
+    the stored documents are embedded as they are instead of as escaped
+    strings, unless they aren't valid JSON.
+    """
+    _t_start2 = time.time()
+    query, params = page_query(cursor, COUNT_VALUE)
+    rows = fetch_rows(query, params, cursor.desc, COUNT_VALUE)
     logger.info("records.sql.duration", duration=time.time()-_t_start2)
 
+    parts = []
+    for timestamp, message_id, record, record_z in rows:
+        data = record_data(record, record_z)
+        parts.append('{"timestamp": %d, "message_id": %s, "data": %s}' % (
+            timestamp, encode_string(message_id), encode_data(data, raw)))
+
+    # A short page means we've reached the end; a full one may be followed
+    # by an empty page.
+    next_token = None
+    if len(rows) == COUNT_VALUE:
+        next_token = cursors.encode(rows[-1][0], rows[-1][1], cursor.desc,
+                                    cursor.since, cursor.until)
+    body = '{"results": [%s], "count": %d, "next": %s}' % (
+        ', '.join(parts), len(rows), json.dumps(next_token))
+    expires = page_expiry(cursor, rows, COUNT_VALUE, time.time())
+    return body.encode('utf-8'), expires
+
+
+@app.route('/records/count', methods=['GET'])
+def count_dummy_records():
+    """
+    Return {"count": n, "estimated": bool}: the number of records in the
+    since/until range (see /records), estimated where the database can do
+    so cheaply.
+    """
     try:
-        next_token = "_".join([str(result_set[-1]['timestamp']),
-                               result_set[-1]['message_id']])
-    except (IndexError, KeyError):
-        next_token = None
-
-    # Drop the last result from here since that's only used to compute the next
-    # token.
-    result_set = result_set[0:COUNT_VALUE]
-    count = len(result_set)
-    results = {
-        'results': result_set, 'count': count, 'next': next_token
-    }
-    # For want of a better way, output a metric.
-    logger.info("records.duration", duration=time.time()-_t_start, count=1)
+        cursor = get_listing()
+    except ValueError as e:
+        return make_error_response(e.args[0], e.args[1], 400)
+    count, estimated = estimate_count(cursor)
+    return make_response(
+            json.dumps({'count': count, 'estimated': estimated}), 200,
+            {'Content-Type': 'application/json'})
+
+
+def stream_rows(engine, query, params):
+    """
+    Yield the rows of a query read through a server-side cursor,
+    EXPORT_FETCH_SIZE at a time.
+    """
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(db.text(query), params)
+        while True:
+            rows = result.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        connection.close()
+
+
+def export_records(engines, cursor):
+    """
+    Yield NDJSON chunks of the records after cursor, read through
+    server-side cursors (merged across shards) so memory use doesn't depend
+    on the size of the export. Each line has the fields of a /records
+    result plus the "next" token to resume the export after that record.
+    """
+    query, params = page_query(cursor, None)
+    merged = heapq.merge(*[stream_rows(engine, query, params)
+                           for engine in engines],
+                         key=row_key, reverse=cursor.desc)
+    while True:
+        rows = list(itertools.islice(merged, EXPORT_FETCH_SIZE))
+        if not rows:
+            break
+        yield ''.join(
+            json.dumps({
+                'timestamp': r.timestamp, 'message_id': r.message_id,
+                'data': record_data(r.record, r.record_z),
+                'next': cursors.encode(r.timestamp, r.message_id,
+                                       cursor.desc, cursor.since,
+                                       cursor.until)}) + '\n'
+            for r in rows).encode('utf-8')
+
+
+@app.route('/records/export', methods=['GET'])
+def export_dummy_records():
+    """
+    Stream every record in a range as newline delimited JSON, one
+    /records result per line. Takes the same since, until, order and next
+    parameters as /records. Every line also has a "next" token; pass the
+    last one received as "next" to resume an interrupted export. The
+    response is gzipped for clients that accept it.
+    """
+    try:
+        cursor = get_listing()
+    except ValueError as e:
+        return make_error_response(e.args[0], e.args[1], 400)
+    chunks = export_records(read_engines(), cursor)
+    headers = {'Vary': 'Accept-Encoding'}
+    if compression.accepts_gzip(request.headers.get('Accept-Encoding')):
+        chunks = compression.gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    logger.info("records.export", count=1)
+    return Response(chunks, 200, headers, mimetype='application/x-ndjson')
+
+
+@app.route('/records/stats', methods=['GET'])
+def record_stats():
+    """
+    Return the number of records and their stored size in bytes per time
+    bucket, from the per-minute rollups.
+
+    Optional URL parameters:
+    - since: Only records with a timestamp at or after this (rounded
+             down to the minute)
+    - until: Only records with a timestamp before this
+    - bucket: Bucket length in seconds, a multiple of 60 (the default)
+
+    The return value is a dictionary containing:
+    - bucket: The bucket length
+    - results: A list of {"timestamp", "count", "bytes"} dictionaries
+               for the buckets that have records, oldest first,
+               where timestamp is the start of the bucket
+    """
+    try:
+        cursor = get_listing()
+        bucket = optional_int('bucket') or rollups.MINUTE
+    except ValueError as e:
+        return make_error_response(e.args[0], INVALID_PARAMETER, 400)
+    if bucket <= 0 or bucket % rollups.MINUTE:
+        return make_error_response(
+                "Invalid bucket", INVALID_PARAMETER, 400
+        )
+    results = rollups.merge(scatter(*rollups.stats_query(
+        cursor.since, cursor.until, bucket)))
+    return make_response(
+            json.dumps({'bucket': bucket, 'results': [
+                {'timestamp': start, 'count': count, 'bytes': size}
+                for start, count, size in results]}), 200,
+            {'Content-Type': 'application/json'})
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Return the state of the writer and reader connection pools.
+    """
     return make_response(
-            json.dumps(results), 200,
+            json.dumps({role: pool_stats(role)
+                        for role in ('writer', 'reader')}), 200,
             {'Content-Type': 'application/json'})
@@ -0,0 +1,114 @@
+"""
+A cache for serialised List API pages that can no longer change.
+
+Pages are looked up in an in-process LRU first and then, if configured, in
+Redis, which is shared by every List API process. Values are bytes and may
+be given a shorter time to live than the cache's.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Keeps up to max_bytes of values for ttl seconds each, dropping the least
+    recently used first.
+    """
+
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        expires, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (self.clock() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+
+class RedisCache(object):
+    """
+    Keeps values in Redis for ttl seconds.
+    """
+
+    def __init__(self, client, ttl, prefix='page:'):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """
+        A value and the seconds it has left, (None, None) if there is none.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(self.prefix + key)
+        pipeline.pttl(self.prefix + key)
+        value, pttl = pipeline.execute()
+        if value is None or pttl is None or pttl <= 0:
+            return None, None
+        return value, pttl / 1000.0
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(int(ttl), self.ttl)
+        self.client.set(self.prefix + key, value, ex=max(ttl, 1))
+
+
+class PageCache(object):
+    """
+    Reads through the local cache to the shared one (if any), copying hits
+    from the shared cache locally for as long as they have left there.
+    errors are the exceptions of the shared cache to treat as misses.
+    """
+
+    def __init__(self, local, shared=None, errors=()):
+        self.local = local
+        self.shared = shared
+        self.errors = errors
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value, ttl = self.shared.get_with_ttl(key)
+            except self.errors:
+                return None
+            if value is not None:
+                self.local.set(key, value, ttl)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl)
+            except self.errors:
+                pass
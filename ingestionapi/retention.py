@@ -0,0 +1,143 @@
+"""
+Time partitioning and retention for the records table.
+
+On MySQL the table is range partitioned by timestamp, one partition per
+interval (a day by default) plus a catch-all "pmax" partition. Partitions
+are created ahead of time and expired ones are dropped whole, which takes
+no row locks and doesn't write a binlog event per deleted record. Other
+databases fall back to deleting expired records in small batches.
+"""
+import time
+
+from sqlalchemy import text
+
+import rollups
+
+MAX_PARTITION = 'pmax'
+
+
+def supports_partitions(connection):
+    return connection.dialect.name == 'mysql'
+
+
+def partition_name(start):
+    return 'p' + time.strftime('%Y%m%d%H%M', time.gmtime(start))
+
+
+def partition_bounds(start, end, interval):
+    """
+    The upper bounds of the interval aligned partitions needed to hold
+    timestamps from start up to and including end.
+    """
+    first = start - start % interval + interval
+    return list(range(first, end + interval + 1, interval))
+
+
+def partition_clauses(bounds, interval):
+    return ', '.join('PARTITION %s VALUES LESS THAN (%d)'
+                     % (partition_name(bound - interval), bound)
+                     for bound in bounds)
+
+
+def get_partitions(connection, table='records'):
+    """
+    Return [(name, upper_bound)] for the table's partitions in order, with
+    None as the bound of the MAXVALUE partition. Empty if the table isn't
+    partitioned.
+    """
+    rows = connection.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+        "FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table "
+        "AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"), table=table)
+    return [(name, None if bound == 'MAXVALUE' else int(bound))
+            for name, bound in rows]
+
+
+def ensure_partitions(connection, now, interval, ahead):
+    """
+    Partition the records table if it isn't yet, and create partitions up to
+    now + ahead. Returns the names of the partitions created.
+
+    Partitioning an existing table rebuilds it, so do that in a maintenance
+    window. Later calls only split the empty pmax partition, which is cheap.
+    """
+    partitions = get_partitions(connection)
+    if not partitions:
+        oldest = connection.execute(
+            text("SELECT MIN(timestamp) FROM records")).scalar()
+        start = now if oldest is None else min(oldest, now)
+        bounds = partition_bounds(start, now + ahead, interval)
+        connection.execute(text(
+            "ALTER TABLE records PARTITION BY RANGE (timestamp) (%s, "
+            "PARTITION %s VALUES LESS THAN MAXVALUE)"
+            % (partition_clauses(bounds, interval), MAX_PARTITION)))
+    else:
+        last = max([bound for _, bound in partitions if bound is not None] or
+                   [now - now % interval])
+        bounds = [bound for bound in
+                  partition_bounds(last, now + ahead, interval)
+                  if bound > last]
+        if not bounds:
+            return []
+        connection.execute(text(
+            "ALTER TABLE records REORGANIZE PARTITION %s INTO (%s, "
+            "PARTITION %s VALUES LESS THAN MAXVALUE)"
+            % (MAX_PARTITION, partition_clauses(bounds, interval),
+               MAX_PARTITION)))
+    return [partition_name(bound - interval) for bound in bounds]
+
+
+def drop_expired_partitions(connection, cutoff):
+    """
+    Drop the partitions holding only records older than cutoff. Returns
+    their names.
+    """
+    expired = [name for name, bound in get_partitions(connection)
+               if bound is not None and bound <= cutoff]
+    if expired:
+        connection.execute(text("ALTER TABLE records DROP PARTITION %s"
+                                % ', '.join(expired)))
+    return expired
+
+
+def purge_batches(connection, cutoff, batch_size=1000, pause=0.1):
+    """
+    Delete records older than cutoff batch_size at a time, one short
+    transaction per batch, pausing between batches so replicas keep up.
+    Returns the number of records deleted.
+    """
+    deleted = 0
+    while True:
+        keys = connection.execute(text(
+            "SELECT timestamp, message_id FROM records "
+            "WHERE timestamp < :cutoff ORDER BY timestamp LIMIT :count"),
+            cutoff=cutoff, count=batch_size).fetchall()
+        if not keys:
+            return deleted
+        with connection.begin():
+            connection.execute(text(
+                "DELETE FROM records WHERE timestamp = :timestamp AND "
+                "message_id = :message_id"),
+                [{'timestamp': t, 'message_id': m} for t, m in keys])
+        deleted += len(keys)
+        if len(keys) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def purge(connection, cutoff, batch_size=1000, pause=0.1):
+    """
+    Remove expired records: whole partitions on a partitioned table,
+    otherwise batched deletes. Records in a partition that hasn't fully
+    expired yet are kept until it has. The per-minute totals of the removed
+    records go too. Returns a description of what was removed.
+    """
+    if supports_partitions(connection) and get_partitions(connection):
+        removed = {'partitions': drop_expired_partitions(connection, cutoff)}
+    else:
+        removed = {'records': purge_batches(connection, cutoff, batch_size,
+                                            pause)}
+    rollups.purge(connection, cutoff)
+    return removed
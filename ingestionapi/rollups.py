@@ -0,0 +1,133 @@
+"""
+Per-minute record counts and sizes, kept in the record_stats table.
+
+Workers add the rows they write to the totals of each minute in the same
+transaction, with one upsert per minute touched by a batch. So that
+concurrent transactions don't all queue up on the current minute's row,
+each minute is spread over several rows ("slots"), each transaction adding
+to a random one, and reads sum them. purge() drops the totals of minutes
+whose records have been purged, so outside the minute retention is
+currently cutting through (and while RECORD_ROLLUPS is off) the totals
+match the records table. rebuild() recomputes them from the records
+themselves. bytes are the stored size of the records, compressed or not.
+"""
+import random
+
+from sqlalchemy import text
+
+MINUTE = 60
+
+UPSERT = {
+    'mysql': (
+        "INSERT INTO record_stats (minute, slot, count, bytes) "
+        "VALUES (:minute, :slot, :count, :bytes) ON DUPLICATE KEY UPDATE "
+        "count = count + VALUES(count), bytes = bytes + VALUES(bytes)"),
+    'default': (
+        "INSERT INTO record_stats (minute, slot, count, bytes) "
+        "VALUES (:minute, :slot, :count, :bytes) "
+        "ON CONFLICT (minute, slot) DO UPDATE "
+        "SET count = record_stats.count + excluded.count, "
+        "bytes = record_stats.bytes + excluded.bytes"),
+}
+
+
+def row_bytes(row):
+    if row.get('record') is not None:
+        return len(row['record'].encode('utf-8'))
+    return len(row.get('record_z') or b'')
+
+
+def minute_totals(rows):
+    totals = {}
+    for row in rows:
+        minute = row['timestamp'] - row['timestamp'] % MINUTE
+        count, size = totals.get(minute, (0, 0))
+        totals[minute] = (count + 1, size + row_bytes(row))
+    return [{'minute': minute, 'count': count, 'bytes': size}
+            for minute, (count, size) in sorted(totals.items())]
+
+
+def add(connection, dialect, rows, slots=1):
+    """
+    Add rows to the totals of their minutes, in one of slots rows per
+    minute. connection can be a connection or a session of a database with
+    the given dialect name; the caller commits.
+    """
+    totals = minute_totals(rows)
+    if totals:
+        slot = random.randrange(slots)
+        for total in totals:
+            total['slot'] = slot
+        connection.execute(text(UPSERT.get(dialect, UPSERT['default'])),
+                           totals)
+
+
+def range_conditions(since, until, params):
+    conditions = []
+    if since is not None:
+        conditions.append("minute >= :since")
+        params['since'] = since - since % MINUTE
+    if until is not None:
+        conditions.append("minute < :until")
+        params['until'] = until
+    return conditions
+
+
+def stats_query(since, until, bucket):
+    """
+    The SQL and parameters for the (bucket_start, count, bytes) totals of
+    bucket second long buckets (a multiple of a minute) between since and
+    until.
+    """
+    params = {'bucket': bucket}
+    conditions = range_conditions(since, until, params)
+    where = "WHERE %s " % " AND ".join(conditions) if conditions else ""
+    return ("SELECT minute - minute %% :bucket AS start, SUM(count), "
+            "SUM(bytes) FROM record_stats %sGROUP BY start ORDER BY start"
+            % where), params
+
+
+def merge(results):
+    """
+    Add up the totals of the same buckets from several databases.
+    """
+    totals = {}
+    for rows in results:
+        for start, count, size in rows:
+            old = totals.get(start, (0, 0))
+            totals[start] = (old[0] + int(count), old[1] + int(size))
+    return [(start, count, size)
+            for start, (count, size) in sorted(totals.items())]
+
+
+def rebuild(connection, since, until):
+    """
+    Recompute the totals of the minutes from since up to until from the
+    records table, in one transaction.
+    """
+    params = {}
+    conditions = range_conditions(since, until, params)
+    where = "WHERE %s " % " AND ".join(conditions) if conditions else ""
+    record_where = where.replace('minute', 'timestamp')
+    with connection.begin():
+        connection.execute(text("DELETE FROM record_stats %s" % where),
+                           params)
+        connection.execute(text(
+            "INSERT INTO record_stats (minute, slot, count, bytes) "
+            "SELECT timestamp - timestamp %% 60 AS minute, 0, COUNT(*), "
+            "SUM(COALESCE(LENGTH(record), LENGTH(record_z), 0)) "
+            "FROM records %sGROUP BY minute" % record_where), params)
+
+
+def purge(connection, cutoff):
+    """
+    Remove the totals of the minutes before cutoff that no longer have any
+    records, after the records table has been purged up to cutoff.
+    """
+    oldest = connection.execute(
+        text("SELECT MIN(timestamp) FROM records")).scalar()
+    before = cutoff if oldest is None else min(cutoff, oldest)
+    with connection.begin():
+        connection.execute(
+            text("DELETE FROM record_stats WHERE minute < :before"),
+            before=before - before % MINUTE)
@@ -0,0 +1,35 @@
+"""
+Move existing records into the compressed record_z column, a thousand at a
+time in primary key order. Run with the same RECORD_COMPRESSION setting as
+the workers (zlib if it isn't set), after ``flask upgrade-records`` has
+added the column. Safe to stop and run again.
+"""
+import os
+
+from sqlalchemy import and_, or_
+
+from db import db, Records
+import compression
+
+codec = os.environ.get('RECORD_COMPRESSION') or 'zlib'
+
+last = None
+while True:
+    query = Records.query.filter(Records.record.isnot(None))
+    if last is not None:
+        # Carry on after the last row of the previous batch rather than
+        # scanning the already compressed rows again.
+        query = query.filter(or_(
+            Records.timestamp > last[0],
+            and_(Records.timestamp == last[0],
+                 Records.message_id > last[1])))
+    rows = (query.order_by(Records.timestamp, Records.message_id)
+            .limit(1000).all())
+    if not rows:
+        break
+    last = rows[-1].timestamp, rows[-1].message_id
+    for r in rows:
+        r.record_z = compression.pack(r.record, codec)
+        r.record = None
+    db.session.commit()
+    print("Compressed %d records" % len(rows))
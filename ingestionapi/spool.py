@@ -0,0 +1,244 @@
+"""
+An append-only spool on local disk for documents accepted while the broker
+is unavailable.
+
+The spool is a directory of segment files. Every segment starts with a fixed
+16 byte header (magic, format version and creation time) followed by
+records, each a 4 byte length and 4 byte CRC32 of a JSON encoded
+[text, message_id, timestamp] payload. Segments are written with plain
+appends and read back through mmap.
+
+A process appends to its own segment ("<created>-<pid>.open") and renames it
+to ".ready" once it is full or about to be drained. Drainers claim ready
+segments by renaming them, so several processes can share one directory.
+Segments left behind by processes that have died are picked up again.
+
+Each process keeps counts of the segments, bytes and documents in the
+directory rather than listing and reading it whenever they are needed. They
+are taken when the spool is opened and kept up to date by its own appends
+and drains, so appends by other processes sharing the directory only show
+up (and count towards max_bytes) once this process drains again.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'FIPSPOOL'
+VERSION = 1
+HEADER = struct.Struct('!8sHxxI')
+RECORD = struct.Struct('!II')
+
+OPEN = '.open'
+READY = '.ready'
+DRAINING = '.draining-'
+
+
+class SpoolFull(Exception):
+    """
+    Raised when an append would take the spool over its disk budget.
+    """
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def encode_record(txt, message_id, timestamp):
+    payload = json.dumps([txt, message_id, timestamp]).encode('utf-8')
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_segment(path):
+    """
+    Return the (text, message_id, timestamp) entries in a segment. Reading
+    stops at the first torn or corrupt record, which can only be the last one
+    written before a crash.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= HEADER.size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, version, created = HEADER.unpack_from(m, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a spool segment: %s" % path)
+            entries = []
+            offset = HEADER.size
+            while offset + RECORD.size <= len(m):
+                length, crc = RECORD.unpack_from(m, offset)
+                start = offset + RECORD.size
+                payload = m[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                entries.append(tuple(json.loads(payload.decode('utf-8'))))
+                offset = start + length
+            return entries
+
+
+class Spool(object):
+    """
+    Appends go to the current segment until it reaches segment_size bytes.
+    Appends that would take the directory over max_bytes raise SpoolFull.
+    """
+
+    def __init__(self, directory, segment_size=16 * 2 ** 20,
+                 max_bytes=2 ** 30, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.segment = None
+        self.segment_path = None
+        self.segments = 0
+        self.bytes = 0
+        self.documents = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def _paths(self, suffix=''):
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if suffix in name)
+
+    def recover(self):
+        """
+        Make segments of processes that are no longer running drainable
+        and count what is in the spool.
+        """
+        for path in self._paths():
+            if path.endswith(OPEN):
+                pid = int(path[:-len(OPEN)].rsplit('-', 1)[1])
+                base = path[:-len(OPEN)]
+            elif DRAINING in path:
+                base, pid = path.rsplit(DRAINING, 1)
+                pid = int(pid)
+            else:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                try:
+                    os.rename(path, base + READY)
+                except FileNotFoundError:
+                    pass
+        self._count()
+
+    def _count(self):
+        segments = size = documents = 0
+        for path in self._paths():
+            try:
+                documents += len(read_segment(path))
+                size += os.path.getsize(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            segments += 1
+        with self._lock:
+            self.segments, self.bytes, self.documents = (segments, size,
+                                                         documents)
+
+    def size(self):
+        return self.bytes
+
+    def append(self, entries):
+        """
+        Durably add (text, message_id, timestamp) entries to the spool.
+        """
+        data = b''.join(encode_record(*entry) for entry in entries)
+        with self._lock:
+            if self.bytes + len(data) + HEADER.size > self.max_bytes:
+                raise SpoolFull()
+            if (self.segment is not None and
+                    self.segment.tell() + len(data) > self.segment_size):
+                self._seal()
+            if self.segment is None:
+                self._open_segment()
+            self.segment.write(data)
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            self.bytes += len(data)
+            self.documents += len(entries)
+
+    def _open_segment(self):
+        created = time.time()
+        self.segment_path = os.path.join(
+            self.directory, '%020d-%d%s' % (created * 10 ** 6, os.getpid(),
+                                            OPEN))
+        self.segment = open(self.segment_path, 'ab')
+        self.segment.write(HEADER.pack(MAGIC, VERSION, int(created)))
+        self.segments += 1
+        self.bytes += HEADER.size
+
+    def _seal(self):
+        self.segment.close()
+        os.rename(self.segment_path,
+                  self.segment_path[:-len(OPEN)] + READY)
+        self.segment = None
+        self.segment_path = None
+
+    def seal(self):
+        """
+        Close the current segment so it can be drained.
+        """
+        with self._lock:
+            if self.segment is not None:
+                self._seal()
+
+    def claim(self):
+        """
+        Take the oldest ready segment for draining, or return None.
+        """
+        for path in self._paths(READY):
+            claimed = '%s%s%d' % (path[:-len(READY)], DRAINING, os.getpid())
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            return claimed
+        return None
+
+    def release(self, path):
+        os.rename(path, path.rsplit(DRAINING, 1)[0] + READY)
+
+    def drain(self, replay, batch_size=500):
+        """
+        Pass every spooled entry to replay, in batches, oldest first. A
+        segment is deleted once all its entries have been replayed; if replay
+        raises, the segment is put back and replayed again in full later.
+        """
+        self.seal()
+        count = 0
+        while True:
+            path = self.claim()
+            if path is None:
+                break
+            try:
+                entries = read_segment(path)
+                for i in range(0, len(entries), batch_size):
+                    replay(entries[i:i + batch_size])
+                size = os.path.getsize(path)
+            except Exception:
+                self.release(path)
+                raise
+            os.remove(path)
+            count += len(entries)
+            with self._lock:
+                self.segments = max(0, self.segments - 1)
+                self.bytes = max(0, self.bytes - size)
+                self.documents = max(0, self.documents - len(entries))
+        if self.documents:
+            # Whatever is left was spooled or drained by other processes.
+            self._count()
+        return count
+
+    def state(self):
+        return {'segments': self.segments, 'bytes': self.bytes,
+                'documents': self.documents}
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Persist documents from the ingest stream (INGEST_TRANSPORT=stream).
+
+Entries are read in batches through a consumer group, written with a single
+multi-row INSERT and only acknowledged once the commit has succeeded. The
+stream entry ID doubles as the message ID, so an entry that is delivered
+again after a crash is recognised as a duplicate and skipped.
+"""
+import os
+import time
+
+import redis
+import structlog
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import streams
+from tasks import record_columns, write_records, hostname
+
+logger = structlog.get_logger()
+
+
+def get_settings():
+    """
+    Take config from the environment
+    """
+    return {
+        'host': os.environ.get('REDIS_HOST', 'redis'),
+        'port': int(os.environ.get('REDIS_PORT', 6379)),
+        'stream': os.environ.get('REDIS_STREAM', 'incoming'),
+        'group': os.environ.get('STREAM_GROUP', 'persist'),
+        'consumer': os.environ.get('STREAM_CONSUMER', hostname),
+        'count': int(os.environ.get('STREAM_BATCH_SIZE', 500)),
+        'block': int(os.environ.get('STREAM_BLOCK_MS', 1000)),
+    }
+
+
+def make_rows(entries):
+    return [dict(record_columns(txt),
+                 timestamp=streams.entry_timestamp(entry_id),
+                 message_id=entry_id)
+            for entry_id, txt in entries]
+
+
+def process_batch(client, stream, group, consumer, count, block,
+                  pending=False):
+    """
+    Read, persist and acknowledge one batch. Returns the number of entries
+    read. Entries stay pending if the write fails.
+    """
+    entries = streams.read_group(client, stream, group, consumer, count,
+                                 block, pending=pending)
+    if not entries:
+        return 0
+    write_records(make_rows(entries))
+    streams.ack(client, stream, group, [entry_id for entry_id, _ in entries])
+    logger.info("Completed stream batch", task_completed=len(entries),
+                hostname=hostname)
+    return len(entries)
+
+
+def run(host, port, stream, group, consumer, count, block):
+    client = redis.StrictRedis(host=host, port=port)
+    streams.create_group(client, stream, group)
+    # Start with anything delivered to us before a restart but never acked.
+    pending = True
+    while True:
+        try:
+            read = process_batch(client, stream, group, consumer, count,
+                                 block, pending=pending)
+        except (SQLAlchemyError, redis.exceptions.RedisError) as e:
+            logger.info(task_failed=1, hostname=hostname, exception=str(e))
+            pending = True
+            time.sleep(1)
+            continue
+        if pending and read == 0:
+            pending = False
+
+
+if __name__ == '__main__':
+    run(**get_settings())
@@ -0,0 +1,167 @@
+"""
+Helpers for using a Redis Stream as the ingest log (INGEST_TRANSPORT=stream).
+
+The ingestion API appends each accepted document to the stream once, the
+stream worker persists it through a consumer group and the websocket server
+tails the same stream for the live feed.
+
+Stream commands are sent with execute_command so they work with redis-py
+versions that predate stream support. Replies are accepted both raw and as
+parsed by newer redis-py versions.
+"""
+
+import time
+
+DATA_FIELD = 'data'
+
+
+def _str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _fields(reply):
+    """
+    Turn a flat [key, value, ...] reply (or an already parsed dict) into a
+    dict with str keys.
+    """
+    if not isinstance(reply, dict):
+        reply = dict(zip(reply[::2], reply[1::2]))
+    return {_str(k): v for k, v in reply.items()}
+
+
+def parse_entries(entries):
+    """
+    Turn a list of stream entries into (entry_id, document) tuples.
+    """
+    results = []
+    for entry_id, fields in entries or []:
+        fields = _fields(fields)
+        results.append((_str(entry_id), _str(fields.get(DATA_FIELD))))
+    return results
+
+
+def parse_read_reply(reply):
+    """
+    Parse an XREAD/XREADGROUP reply for a single stream.
+    """
+    if not reply:
+        return []
+    if isinstance(reply, dict):
+        reply = list(reply.items())
+    stream, entries = reply[0]
+    return parse_entries(entries)
+
+
+def entry_timestamp(entry_id):
+    """
+    The time, in whole seconds, Redis assigned to a stream entry ID.
+    """
+    return int(entry_id.split('-')[0]) // 1000
+
+
+def append(client, stream, txts, maxlen=None):
+    """
+    Append documents to the stream in one round-trip. If maxlen is given the
+    stream is trimmed to approximately that many entries.
+    """
+    pipe = client.pipeline(transaction=False)
+    for txt in txts:
+        args = ['XADD', stream]
+        if maxlen:
+            args += ['MAXLEN', '~', maxlen]
+        args += ['*', DATA_FIELD, txt]
+        pipe.execute_command(*args)
+    return [_str(entry_id) for entry_id in pipe.execute()]
+
+
+def create_group(client, stream, group):
+    """
+    Create a consumer group reading the stream from the start, unless it
+    already exists.
+    """
+    try:
+        client.execute_command('XGROUP', 'CREATE', stream, group, '0',
+                               'MKSTREAM')
+    except Exception as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def read_group(client, stream, group, consumer, count, block,
+               pending=False):
+    """
+    Read up to count new entries for this consumer, waiting up to block
+    milliseconds. With pending=True read the entries that were delivered to
+    this consumer but never acknowledged instead.
+    """
+    reply = client.execute_command(
+        'XREADGROUP', 'GROUP', group, consumer, 'COUNT', count,
+        'BLOCK', block, 'STREAMS', stream, '0' if pending else '>')
+    return parse_read_reply(reply)
+
+
+def ack(client, stream, group, entry_ids):
+    if entry_ids:
+        client.execute_command('XACK', stream, group, *entry_ids)
+
+
+def read(client, stream, last_id, count, block):
+    """
+    Read up to count entries after last_id, waiting up to block milliseconds.
+    """
+    reply = client.execute_command('XREAD', 'COUNT', count, 'BLOCK', block,
+                                   'STREAMS', stream, last_id)
+    return parse_read_reply(reply)
+
+
+def last_id(client, stream):
+    """
+    The ID of the newest entry in the stream, or '0-0' if it's empty.
+    """
+    entries = parse_entries(
+        client.execute_command('XREVRANGE', stream, '+', '-', 'COUNT', 1))
+    if not entries:
+        return '0-0'
+    return entries[0][0]
+
+
+def backlog(client, stream, group, now=None):
+    """
+    How far behind the consumer group is: the number of entries that are
+    pending or not yet delivered, and the age in seconds of the oldest of
+    them (None if there are none).
+    """
+    now = time.time() if now is None else now
+    groups = [_fields(g) for g in
+              client.execute_command('XINFO', 'GROUPS', stream)]
+    info = [g for g in groups if _str(g['name']) == group]
+    if not info:
+        return 0, None
+    info = info[0]
+    pending = int(info.get('pending') or 0)
+    # lag is only reported by Redis 7 and later.
+    undelivered = int(info.get('lag') or 0)
+
+    oldest = None
+    if pending:
+        summary = client.execute_command('XPENDING', stream, group)
+        if isinstance(summary, dict):
+            oldest = summary['min']
+        else:
+            oldest = summary[1]
+    else:
+        entries = parse_entries(client.execute_command(
+            'XRANGE', stream, _str(info['last-delivered-id']), '+',
+            'COUNT', 2))
+        entries = [e for e in entries
+                   if e[0] != _str(info['last-delivered-id'])]
+        if entries:
+            oldest = entries[0][0]
+            undelivered = max(undelivered, 1)
+
+    lag = None
+    if oldest is not None:
+        lag = max(0, now - entry_timestamp(_str(oldest)))
+    return pending + undelivered, lag
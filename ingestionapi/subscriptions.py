@@ -0,0 +1,100 @@
+"""
+Server side filters for the live feed.
+
+A filter is a JSON object such as
+
+    {"equals": {"level": "error"}, "prefix": {"host": "web-"}}
+
+matching documents that are objects whose "level" key is "error" and whose
+"host" key is a string starting with "web-". Clients with the same filter
+share it: every distinct filter has one ring buffer of the messages it
+matches, filled as messages are published, so each message is parsed once
+and checked once per distinct filter however many clients use it. The
+rings hold the frames already encoded for the main ring.
+"""
+import json
+
+import fanout
+
+
+def compile_filter(spec):
+    """
+    Return (key, match) for a filter, where key is the same for equivalent
+    filters and match tells whether a decoded document passes. Both are
+    None for an empty filter, which matches everything. Raises ValueError
+    for invalid filters.
+    """
+    if not isinstance(spec, dict) or set(spec) - {'equals', 'prefix'}:
+        raise ValueError("Unsupported filter")
+    equals = spec.get('equals', {})
+    prefix = spec.get('prefix', {})
+    if not isinstance(equals, dict) or not isinstance(prefix, dict) or \
+            not all(isinstance(value, str) for value in prefix.values()):
+        raise ValueError("Unsupported filter")
+    if not equals and not prefix:
+        return None, None
+    key = json.dumps([equals, prefix], sort_keys=True)
+    equals = list(equals.items())
+    prefix = list(prefix.items())
+
+    def match(document):
+        if not isinstance(document, dict):
+            return False
+        for field, value in equals:
+            if field not in document or document[field] != value:
+                return False
+        for field, start in prefix:
+            value = document.get(field)
+            if not isinstance(value, str) or not value.startswith(start):
+                return False
+        return True
+
+    return key, match
+
+
+def decode(value):
+    """
+    The document in a message, or None if it isn't JSON.
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+class FilterIndex(object):
+    """
+    The filters in use, with a ring of size messages and a count of
+    subscribers each.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.filters = {}
+
+    def subscribe(self, key, match):
+        """
+        Return the ring of a filter, adding the filter if it is new.
+        """
+        entry = self.filters.get(key)
+        if entry is None:
+            entry = self.filters[key] = [match, fanout.Ring(self.size), 0]
+        entry[2] += 1
+        return entry[1]
+
+    def unsubscribe(self, key):
+        entry = self.filters[key]
+        entry[2] -= 1
+        if not entry[2]:
+            del self.filters[key]
+
+    def publish(self, value, message_id, frames):
+        """
+        Add a message to the ring of every filter it matches.
+        """
+        if not self.filters:
+            return
+        document = decode(value)
+        for match, ring, count in self.filters.values():
+            if match(document):
+                ring.publish(value, message_id, frames)
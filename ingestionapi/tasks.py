@@ -1,40 +1,301 @@
 from celery import Celery
-from db import Records, db
+from kombu import compression as kombu_compression
+from db import (Records, db, get_engine, get_shard_engines, pool_stats,
+                shard_index)
+from batcher import Batcher
+from dedupe import RedisDeduper
+import compression
+import ids
+import rollups
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
+import base64
 import json
 import uuid
 import os
 import time
 import socket
 
+import redis
 import structlog
 
 broker = os.environ.get('TASK_BROKER', 'redis://redis:6379/0')
 app = Celery('tasks', broker=broker)
+app.conf.broker_pool_limit = int(os.environ.get('BROKER_POOL_LIMIT', 10))
+# Compress task messages on the broker, e.g. TASK_COMPRESSION=gzip.
+app.conf.task_compression = os.environ.get('TASK_COMPRESSION') or None
+
+# RECORD_COMPRESSION=zlib (or zstd, if zstandard is installed) stores new
+# records compressed in Records.record_z instead of Records.record.
+RECORD_COMPRESSION = os.environ.get('RECORD_COMPRESSION')
+
+# Keep the per-minute totals in record_stats up to date as records are
+# written (see rollups.py). RECORD_ROLLUPS=0 turns this off. Databases set
+# up before record_stats existed need ``flask upgrade-records`` first, or
+# every write fails.
+RECORD_ROLLUPS = os.environ.get('RECORD_ROLLUPS') != '0'
+# Rows each minute's totals are spread over, so that concurrent writers
+# don't all wait on the same row.
+ROLLUP_SLOTS = int(os.environ.get('ROLLUP_SLOTS', 16))
+
+# The scheme of message IDs made here for tasks queued without one, see
+# ids.py and the ingestion API's MESSAGE_ID_SCHEME.
+new_message_id = ids.get_generator(os.environ.get('MESSAGE_ID_SCHEME'))
+
+# When TASK_BATCH_SIZE is greater than 1, records from concurrently running
+# add tasks are written together, up to TASK_BATCH_SIZE rows or whatever
+# arrived within TASK_BATCH_WINDOW seconds. This needs a worker pool that
+# runs tasks concurrently within a process (-P threads or -P eventlet).
+BATCH_SIZE = int(os.environ.get('TASK_BATCH_SIZE', 1))
+BATCH_WINDOW = float(os.environ.get('TASK_BATCH_WINDOW', 0.05))
+
+# With TASK_DEDUPE_WINDOW set, message IDs written in the last that many
+# seconds are remembered in the broker's Redis, so redelivered tasks are
+# dropped without a round-trip to the DB.
+DEDUPE_WINDOW = int(os.environ.get('TASK_DEDUPE_WINDOW', 0))
 
 logger = structlog.get_logger()
 hostname = socket.gethostname()
 
 
-@app.task(ignore_result=True, task_acks_late=True)
-def add(txt, timefunc=time.time, uuidfunc=lambda: uuid.uuid4().hex):
+def make_task_message(task, args, kwargs=None):
+    """
+    Build a Celery task message the way kombu's Redis transport stores it,
+    so it can be pushed onto the queue without going through kombu.
+    """
+    task_id = str(uuid.uuid4())
+    queue = app.conf.task_default_queue
+    message = app.amqp.as_task_v2(task_id, task.name, args=args,
+                                  kwargs=kwargs or {})
+    body = json.dumps(message.body).encode('utf-8')
+    headers = dict(message.headers)
+    if app.conf.task_compression:
+        body, headers['compression'] = kombu_compression.compress(
+            body, app.conf.task_compression)
+    properties = dict(message.properties)
+    properties.update(
+        body_encoding='base64',
+        delivery_mode=2,
+        delivery_tag=str(uuid.uuid4()),
+        delivery_info={'exchange': '', 'routing_key': queue},
+        priority=0,
+    )
+    return queue, json.dumps({
+        'body': base64.b64encode(body).decode('ascii'),
+        'content-encoding': 'utf-8',
+        'content-type': 'application/json',
+        'headers': headers,
+        'properties': properties,
+    })
+
+
+def record_columns(txt):
+    if RECORD_COMPRESSION:
+        return {'record': None,
+                'record_z': compression.pack(txt, RECORD_COMPRESSION)}
+    return {'record': txt, 'record_z': None}
+
+
+def make_row(txt, timefunc, uuidfunc, message_id=None, timestamp=None):
+    """
+    Rows use the message ID and timestamp assigned by the ingestion API when
+    there are any, so a redelivered task writes the same primary key again.
+    """
+    if timestamp is None:
+        timestamp = int(timefunc())
+    return dict(record_columns(txt),
+                timestamp=timestamp,
+                message_id=message_id or uuidfunc())
+
+
+deduper = None
+if DEDUPE_WINDOW:
+    deduper = RedisDeduper(redis.StrictRedis.from_url(broker), DEDUPE_WINDOW,
+                           prefix='written:')
+
+
+def drop_written(rows):
+    """
+    Drop the rows that were recently written already. The deduper is only an
+    optimisation, the primary key still catches anything it misses.
+    """
+    if deduper is None:
+        return rows
+    try:
+        return [row for row in rows
+                if not deduper.contains(row['message_id'])]
+    except redis.exceptions.RedisError:
+        return rows
+
+
+def remember_written(rows):
+    if deduper is None:
+        return
+    try:
+        for row in rows:
+            deduper.add(row['message_id'])
+    except redis.exceptions.RedisError:
+        pass
+
+
+def drop_stored(rows):
+    """
+    Drop the rows whose message ID is already stored, under any timestamp.
+    Retries of a request with an Idempotency-Key get the same message ID but
+    a later timestamp, so the primary key doesn't catch them. Uses the index
+    on message_id (see db.upgrade_records).
+    """
+    shards = get_shard_engines()
+    by_engine = {}
+    for row in rows:
+        if shards:
+            engine = shards[shard_index(row['message_id'], len(shards))]
+        else:
+            engine = get_engine('writer')
+        by_engine.setdefault(engine, []).append(row['message_id'])
+    column = Records.__table__.c.message_id
+    stored = set()
+    for engine, message_ids in by_engine.items():
+        with engine.connect() as connection:
+            stored.update(message_id for message_id, in connection.execute(
+                select([column]).where(column.in_(message_ids))))
+    return [row for row in rows if row['message_id'] not in stored]
+
+
+def write_records(rows):
+    """
+    Write rows with a single multi-row INSERT and one commit.
+
+    If any row already exists (a task was maybe retried after it had already
+    succeeded) fall back to inserting the rows one at a time, skipping the
+    ones that are already there.
+    """
+    shards = get_shard_engines()
+    if shards:
+        return write_sharded(shards, rows)
+    table = Records.__table__
+    # The first call also sets up the writer's pool, with pre-ping if
+    # enabled, so processes that only queue tasks never connect.
+    dialect = get_engine('writer').dialect.name
     try:
-        r = Records(
-            timestamp=int(timefunc()),
-            message_id=uuidfunc(),
-            record=txt
-        )
-        db.session.add(r)
+        db.session.execute(table.insert().values(rows))
+        add_rollups(db.session, dialect, rows)
         db.session.commit()
+        return
     except IntegrityError:
-        # Task was maybe retried and had already succeeded
-        # Rollback and allow the execution to succeed.
         db.session.rollback()
+
+    for row in rows:
+        try:
+            db.session.execute(table.insert().values(row))
+            add_rollups(db.session, dialect, [row])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+
+def add_rollups(connection, dialect, rows):
+    """
+    Count newly inserted rows in the rollups, in the same transaction.
+    """
+    if RECORD_ROLLUPS:
+        rollups.add(connection, dialect, rows, ROLLUP_SLOTS)
+
+
+def insert_rows(engine, rows):
+    table = Records.__table__
+    dialect = engine.dialect.name
+    with engine.connect() as connection:
+        try:
+            with connection.begin():
+                connection.execute(table.insert().values(rows))
+                add_rollups(connection, dialect, rows)
+            return
+        except IntegrityError:
+            pass
+        for row in rows:
+            try:
+                with connection.begin():
+                    connection.execute(table.insert().values(row))
+                    add_rollups(connection, dialect, [row])
+            except IntegrityError:
+                pass
+
+
+def write_sharded(shards, rows):
+    """
+    Write each row to its shard, one multi-row INSERT per shard. A retry
+    after a partial failure skips the rows already written.
+    """
+    by_shard = {}
+    for row in rows:
+        by_shard.setdefault(shard_index(row['message_id'], len(shards)),
+                            []).append(row)
+    for index, shard_rows in sorted(by_shard.items()):
+        insert_rows(shards[index], shard_rows)
+
+
+batcher = None
+if BATCH_SIZE > 1:
+    batcher = Batcher(BATCH_SIZE, BATCH_WINDOW, write_records)
+
+
+@app.task(ignore_result=True, task_acks_late=True)
+def add(txt, timefunc=time.time, uuidfunc=new_message_id,
+        message_id=None, timestamp=None, keyed=False):
+    """
+    Persist a document. keyed says its message ID comes from an idempotency
+    key, so it is skipped if that ID is already stored.
+    """
+    row = make_row(txt, timefunc, uuidfunc, message_id, timestamp)
+    rows = drop_written([row])
+    if rows and keyed:
+        rows = drop_stored(rows)
+    if not rows:
+        logger.info("Dropped duplicate task", task_duplicate=1,
+                    hostname=hostname)
+        return
+    try:
+        if batcher is not None:
+            # Blocks until the batch is committed so the task is still only
+            # acked once its record is safely in the DB.
+            batcher.submit(row)
+        else:
+            write_records([row])
     except SQLAlchemyError as e:
         logger.info(task_failed=1, hostname=hostname, exception=str(e))
         raise
 
-    logger.info("Completed task", task_completed=1, hostname=hostname)
+    remember_written([row])
+    logger.info("Completed task", task_completed=1, hostname=hostname,
+                db_pool=pool_stats('writer'))
     # Otherwise let the task fail and be retried on exception
     # Or succeed .
+
+
+@app.task(ignore_result=True, task_acks_late=True)
+def add_batch(txts, timefunc=time.time, uuidfunc=new_message_id,
+              message_ids=None, timestamp=None, keyed=False):
+    """
+    Persist a batch of documents accepted by the ingestion API in a single
+    transaction. keyed works as for add.
+    """
+    message_ids = message_ids or [None] * len(txts)
+    rows = drop_written([
+        make_row(txt, timefunc, uuidfunc, message_id, timestamp)
+        for txt, message_id in zip(txts, message_ids)
+    ])
+    if rows and keyed:
+        rows = drop_stored(rows)
+    try:
+        if rows:
+            write_records(rows)
+    except SQLAlchemyError as e:
+        logger.info(task_failed=1, hostname=hostname, exception=str(e))
+        raise
+
+    remember_written(rows)
+
+    logger.info("Completed batch task", task_completed=len(txts),
+                hostname=hostname, db_pool=pool_stats('writer'))
@@ -1,18 +1,46 @@
 import tempfile
 import os
 
+import admission
+import batcher
+import compression
+import cursors
+import db
+import dedupe
+import fanout
+import ids
 import ingestion_api
+import ingestion_asgi
+import jsoncheck
 import list_api
+import pagecache
+import retention
+import rollups
+import spool
+import stream_worker
+import streams
+import subscriptions
 import tasks
+import wsserver
 
 import circuitbreaker
+import click.testing
+import flask.cli
 import kombu
 import pep8
+import sqlalchemy
 
+import asyncio
+import base64
+import collections
 import glob
+import gzip
+import io
 import json
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 
 class BaseTests(unittest.TestCase):
@@ -25,11 +53,17 @@ class BaseTests(unittest.TestCase):
         self.mock_redis = self.patch_redis.start()
         self.patch_celery = patch('ingestion_api.enqueue_task')
         self.mock_celery = self.patch_celery.start()
+        self.mock_celery.side_effect = \
+            lambda txt, message_id, *args, **kw: message_id
+        self.patch_celery_batch = patch('ingestion_api.enqueue_batch')
+        self.mock_celery_batch = self.patch_celery_batch.start()
+        self.mock_celery_batch.side_effect = lambda txts, ids, *args, **kw: ids
         self.client = ingestion_api.app.test_client()
 
     def tearDown(self):
         self.patch_redis.stop()
         self.patch_celery.stop()
+        self.patch_celery_batch.stop()
 
     def assertJSON(self, response):
         try:
@@ -67,11 +101,85 @@ class CreateDummyFailureTests(BaseTests):
         self.assertHTTPErrorWithJSONResponse(actual, 400, 1001)
 
     def test_post_invalid_length(self):
-        return
         actual = self.client.post('/dummy', data={'data': 'a' * 5000})
         # MAX_DATA_SIZE
         self.assertHTTPErrorWithJSONResponse(actual, 400, 1002)
 
+    def test_post_document_too_long(self):
+        data = json.dumps('a' * 1500)
+        actual = self.client.post('/dummy', data={'data': data})
+        # MAX_DATA_SIZE
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1002)
+        self.mock_celery.assert_not_called()
+
+    def test_post_body_too_long_without_content_length(self):
+        body = b'data=' + b'1' * 5000
+        actual = self.client.post(
+            '/dummy', input_stream=io.BytesIO(body),
+            content_type='application/x-www-form-urlencoded',
+            environ_overrides={'wsgi.input_terminated': True})
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1002)
+        self.mock_celery.assert_not_called()
+
+
+class CappedStreamTests(unittest.TestCase):
+
+    def test_reads_up_to_limit(self):
+        stream = ingestion_api.CappedStream(io.BytesIO(b'abc'), 3)
+        self.assertEqual(stream.read(), b'abc')
+        self.assertEqual(stream.read(), b'')
+
+    def test_raises_past_limit(self):
+        stream = ingestion_api.CappedStream(io.BytesIO(b'abcd'), 3)
+        self.assertEqual(stream.read(2), b'ab')
+        with self.assertRaises(ingestion_api.RequestEntityTooLarge):
+            stream.read()
+
+
+class JSONCheckTests(unittest.TestCase):
+
+    def test_backends(self):
+        for name, validate in jsoncheck.backends.items():
+            validate('{"a": [1, 2]}')
+            validate(b'"x"')
+            with self.assertRaises(ValueError):
+                validate('{')
+
+    def test_get_validator(self):
+        self.assertIs(jsoncheck.get_validator('json'),
+                      jsoncheck.validate_json)
+        self.assertIn(jsoncheck.get_validator(),
+                      jsoncheck.backends.values())
+
+
+class CompressionTests(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        blob = compression.pack('{"a": 1}')
+        self.assertEqual(blob[:1], compression.ZLIB)
+        self.assertEqual(compression.unpack(blob), '{"a": 1}')
+        with self.assertRaises(ValueError):
+            compression.unpack(b'x')
+
+    def test_decode_body(self):
+        data = gzip.compress(b'data=%7B%7D')
+        self.assertEqual(compression.decode_body(data, 'gzip', 100),
+                         b'data=%7B%7D')
+        self.assertEqual(compression.decode_body(b'a', None, 100), b'a')
+        with self.assertRaises(KeyError):
+            compression.decode_body(data, 'br', 100)
+        with self.assertRaises(ValueError):
+            compression.decode_body(b'nope', 'gzip', 100)
+        with self.assertRaises(compression.TooLarge):
+            compression.decode_body(gzip.compress(b'0' * 10 ** 6), 'gzip',
+                                    100)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(compression.accepts_gzip('deflate, gzip;q=0.5'))
+        self.assertTrue(compression.accepts_gzip('*'))
+        self.assertFalse(compression.accepts_gzip('gzip;q=0'))
+        self.assertFalse(compression.accepts_gzip(None))
+
 
 class CreateDummySuccessTests(BaseTests):
 
@@ -80,6 +188,30 @@ class CreateDummySuccessTests(BaseTests):
         actual = self.client.post('/dummy', data={'data': dummy_data})
         self.assertHTTPErrorWithJSONResponse(actual, 202)
 
+    def test_post_gzip(self):
+        body = gzip.compress(b'data=%7B%22a%22%3A+1%7D')
+        actual = self.client.post(
+            '/dummy', data=body,
+            content_type='application/x-www-form-urlencoded',
+            headers={'Content-Encoding': 'gzip'})
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        self.assertEqual(self.mock_celery.call_args[0][0], '{"a": 1}')
+
+    def test_post_compressed_errors(self):
+        form = 'application/x-www-form-urlencoded'
+        bomb = gzip.compress(b'data=' + b'1' * 10 ** 6)
+        actual = self.client.post('/dummy', data=bomb, content_type=form,
+                                  headers={'Content-Encoding': 'gzip'})
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1002)
+        actual = self.client.post('/dummy', data=b'data=1',
+                                  content_type=form,
+                                  headers={'Content-Encoding': 'br'})
+        self.assertHTTPErrorWithJSONResponse(actual, 415, 1004)
+        actual = self.client.post('/dummy', data=b'data=1',
+                                  content_type=form,
+                                  headers={'Content-Encoding': 'gzip'})
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1004)
+
 
 class CreateDummyServerErrors(BaseTests):
 
@@ -98,6 +230,672 @@ class CreateDummyServerErrors(BaseTests):
         self.assertHTTPErrorWithJSONResponse(actual, 503, 2000)
 
 
+class CreateDummyBatchTests(BaseTests):
+
+    def test_batch_ndjson(self):
+        body = '{"a": 1}\n\n{"b": 2}\n'
+        actual = self.client.post('/dummy/batch', data=body)
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        content = self.assertJSON(actual)
+        self.assertEqual(content['accepted'], 2)
+        self.assertEqual(content['errors'], [])
+        txts, message_ids, timestamp = self.mock_celery_batch.call_args[0]
+        self.assertEqual(txts, ['{"a": 1}', '{"b": 2}'])
+        self.assertEqual(content['message_ids'], message_ids)
+
+    def test_batch_json_array(self):
+        actual = self.client.post('/dummy/batch', data='[{"a": 1}, 2]')
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        self.assertEqual(self.mock_celery_batch.call_args[0][0],
+                         ['{"a": 1}', '2'])
+
+    def test_batch_partial_errors(self):
+        actual = self.client.post('/dummy/batch', data='{"a": 1}\n{\n')
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        content = self.assertJSON(actual)
+        self.assertEqual(content['accepted'], 1)
+        self.assertEqual(content['errors'],
+                         [{'index': 1, 'error': 'Invalid JSON',
+                           'code': 1001}])
+
+    def test_batch_all_invalid(self):
+        actual = self.client.post('/dummy/batch', data='{\n{\n')
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1001)
+        self.mock_celery_batch.assert_not_called()
+
+    def test_batch_missing(self):
+        actual = self.client.post('/dummy/batch')
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1000)
+
+    def test_batch_invalid_array(self):
+        actual = self.client.post('/dummy/batch', data='[{"a": 1},')
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1001)
+
+    def test_batch_document_too_long(self):
+        body = '1\n' + json.dumps('a' * 1500)
+        actual = self.client.post('/dummy/batch', data=body)
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        content = self.assertJSON(actual)
+        self.assertEqual(content['errors'][0]['code'], 1002)
+
+    def test_batch_too_large(self):
+        body = '1\n' * (ingestion_api.app.config['MAX_BATCH_SIZE'] + 1)
+        actual = self.client.post('/dummy/batch', data=body)
+        self.assertHTTPErrorWithJSONResponse(actual, 400, 1002)
+
+    def test_batch_circuit_breaker(self):
+        self.mock_celery_batch.side_effect = \
+            circuitbreaker.CircuitBreakerError('blah')
+        actual = self.client.post('/dummy/batch', data='{}')
+        self.assertHTTPErrorWithJSONResponse(actual, 503, 2000)
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class FakeAsyncRedis(object):
+    """
+    Records the calls made through an asyncio_redis connection pool.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def lpush(self, key, values):
+        self.calls.append(('lpush', key, values))
+
+    async def publish(self, channel, message):
+        self.calls.append(('publish', channel, message))
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def test_client_limiter(self):
+        clock = FakeClock()
+        limiter = admission.ClientLimiter(1, 2, clock=clock)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('a'), 1)
+        # Other clients have their own bucket.
+        self.assertEqual(limiter.take('b'), 0)
+        clock.now = 1
+        self.assertEqual(limiter.take('a'), 0)
+
+    def test_client_limiter_forgets_old_clients(self):
+        limiter = admission.ClientLimiter(1, 1, max_clients=2)
+        for client in 'abc':
+            limiter.take(client)
+        self.assertEqual(list(limiter.buckets), ['b', 'c'])
+
+    def test_backlog_monitor(self):
+        clock = FakeClock()
+        samples = [(5, None), (20, None)]
+        monitor = admission.BacklogMonitor(lambda: samples.pop(0), 10, 0,
+                                           interval=1, clock=clock)
+        self.assertFalse(monitor.shedding())
+        # Not sampled again within the interval.
+        self.assertFalse(monitor.shedding())
+        clock.now = 1
+        self.assertTrue(monitor.shedding())
+        self.assertEqual(monitor.state()['queue_depth'], 20)
+
+    def test_backlog_monitor_lag(self):
+        monitor = admission.BacklogMonitor(lambda: (1, 30), 0, 10)
+        self.assertTrue(monitor.shedding())
+
+    def test_backlog_monitor_sample_errors(self):
+        def sample():
+            raise ValueError
+        monitor = admission.BacklogMonitor(sample, 10, 0, errors=ValueError)
+        self.assertFalse(monitor.shedding())
+        self.assertIsNone(monitor.depth)
+
+    def test_backlog_monitor_disabled(self):
+        monitor = admission.BacklogMonitor(None, 0, 0)
+        self.assertFalse(monitor.shedding())
+
+
+class AdmissionControlTests(BaseTests):
+
+    def test_rate_limited(self):
+        limiter = admission.ClientLimiter(1, 1, clock=FakeClock())
+        with patch('ingestion_api.client_limiter', limiter):
+            actual = self.client.post('/dummy', data={'data': '{}'})
+            self.assertHTTPErrorWithJSONResponse(actual, 202)
+            actual = self.client.post('/dummy', data={'data': '{}'})
+        # RATE_LIMITED
+        self.assertHTTPErrorWithJSONResponse(actual, 429, 1003)
+        self.assertEqual(actual.headers['Retry-After'], '1')
+        self.assertEqual(self.mock_celery.call_count, 1)
+
+    def test_overloaded(self):
+        monitor = admission.BacklogMonitor(lambda: (100, None), 10, 0)
+        with patch('ingestion_api.backlog_monitor', monitor):
+            actual = self.client.post('/dummy/batch', data='{}')
+            health = self.assertJSON(self.client.get('/health'))
+        # OVERLOADED
+        self.assertHTTPErrorWithJSONResponse(actual, 429, 2001)
+        self.assertIn('Retry-After', actual.headers)
+        self.mock_celery_batch.assert_not_called()
+        self.assertTrue(health['admission']['shedding'])
+        self.assertEqual(health['admission']['queue_depth'], 100)
+
+    def test_health_not_shedding(self):
+        health = self.assertJSON(self.client.get('/health'))
+        self.assertFalse(health['admission']['shedding'])
+
+
+class DedupeTests(unittest.TestCase):
+
+    def test_memory_deduper_window(self):
+        clock = FakeClock()
+        d = dedupe.MemoryDeduper(10, clock=clock)
+        self.assertFalse(d.check_and_add('a'))
+        self.assertTrue(d.check_and_add('a'))
+        clock.now = 11
+        self.assertFalse(d.contains('a'))
+
+    def test_memory_deduper_bounded(self):
+        d = dedupe.MemoryDeduper(10, max_keys=2)
+        for key in 'abc':
+            d.add(key)
+        self.assertEqual(list(d.keys), ['b', 'c'])
+
+    def test_memory_deduper_discard(self):
+        d = dedupe.MemoryDeduper(10)
+        d.add('a')
+        d.discard('a')
+        self.assertFalse(d.contains('a'))
+
+    def test_redis_deduper(self):
+        client = MagicMock()
+        client.set.return_value = None
+        d = dedupe.RedisDeduper(client, 10, prefix='p:')
+        self.assertTrue(d.check_and_add('a'))
+        client.set.assert_called_once_with('p:a', 1, ex=10, nx=True)
+
+
+class IdempotencyTests(BaseTests):
+
+    def setUp(self):
+        super().setUp()
+        ingestion_api.dedupers[:] = [dedupe.MemoryDeduper(10)]
+
+    def tearDown(self):
+        ingestion_api.dedupers[:] = []
+        super().tearDown()
+
+    def post(self, key, client='127.0.0.1'):
+        return self.client.post('/dummy', data={'data': '{}'},
+                                headers={'Idempotency-Key': key},
+                                environ_base={'REMOTE_ADDR': client})
+
+    def test_message_id_assigned_at_ingest(self):
+        actual = self.client.post('/dummy', data={'data': '{}'})
+        content = self.assertJSON(actual)
+        txt, message_id, timestamp = self.mock_celery.call_args[0]
+        self.assertEqual(content['message_id'], message_id)
+        self.assertEqual(len(message_id), 32)
+
+    def test_duplicate_key_dropped(self):
+        first = self.assertJSON(self.post('abc'))
+        second = self.assertJSON(self.post('abc'))
+        self.assertEqual(first['message_id'],
+                         ingestion_api.make_message_id('127.0.0.1 abc'))
+        self.assertTrue(second['duplicate'])
+        self.assertEqual(second['message_id'], first['message_id'])
+        self.assertEqual(self.mock_celery.call_count, 1)
+        self.assertTrue(self.mock_celery.call_args[1]['keyed'])
+
+    def test_keys_scoped_to_client(self):
+        first = self.assertJSON(self.post('1', client='10.0.0.1'))
+        other = self.assertJSON(self.post('1', client='10.0.0.2'))
+        self.assertNotIn('duplicate', other)
+        self.assertNotEqual(other['message_id'], first['message_id'])
+        self.assertEqual(self.mock_celery.call_count, 2)
+
+    def test_key_forgotten_when_enqueue_fails(self):
+        self.mock_celery.side_effect = kombu.exceptions.KombuError
+        self.assertHTTPErrorWithJSONResponse(self.post('abc'), 503, 2000)
+        self.mock_celery.side_effect = \
+            lambda txt, message_id, *args, **kw: message_id
+        retry = self.post('abc')
+        self.assertHTTPErrorWithJSONResponse(retry, 202)
+        self.assertNotIn('duplicate', self.assertJSON(retry))
+
+    def test_batch_ids_derived_from_key(self):
+        actual = self.client.post('/dummy/batch', data='1\n{\n3',
+                                  headers={'Idempotency-Key': 'k'})
+        content = self.assertJSON(actual)
+        self.assertEqual(content['message_ids'],
+                         [ingestion_api.make_message_id('127.0.0.1 k', 0),
+                          ingestion_api.make_message_id('127.0.0.1 k', 2)])
+        retry = self.assertJSON(self.client.post(
+            '/dummy/batch', data='1\n{\n3', headers={'Idempotency-Key': 'k'}))
+        self.assertTrue(retry['duplicate'])
+        self.assertEqual(retry['message_ids'], content['message_ids'])
+        self.assertEqual(retry['accepted'], 2)
+
+
+def timestamp_ms(message_id):
+    """
+    The time in milliseconds at the start of a uuid7 or ulid ID.
+    """
+    if len(message_id) == 32 and message_id[12] == '7':
+        return int(message_id[:12], 16)
+    if len(message_id) != 26:
+        raise ValueError("Not a uuid7 or ulid ID")
+    value = 0
+    for char in message_id[:10]:
+        value = value * 32 + ids.CROCKFORD.index(char)
+    return value
+
+
+class MessageIdTests(BaseTests):
+
+    def test_ordered_within_a_millisecond(self):
+        for name in ('uuid7', 'ulid'):
+            new_id = ids.MonotonicIds(ids.schemes[name].random_bits,
+                                      ids.schemes[name].encode)
+            made = [new_id(1500000000.0001) for _ in range(100)]
+            made.append(new_id(1500000000.002))
+            self.assertEqual(made, sorted(made))
+            self.assertEqual(len(set(made)), len(made))
+            self.assertEqual(timestamp_ms(made[0]), 1500000000000)
+            self.assertEqual(timestamp_ms(made[-1]), 1500000000002)
+
+    def test_uuid7_layout(self):
+        message_id = ids.schemes['uuid7'](1500000000.5)
+        self.assertEqual(len(message_id), 32)
+        self.assertEqual(message_id[12], '7')
+        self.assertIn(message_id[16], '89ab')
+
+    def test_ulid_layout(self):
+        message_id = ids.schemes['ulid'](1500000000.5)
+        self.assertEqual(len(message_id), 26)
+        self.assertTrue(set(message_id) <= set(ids.CROCKFORD))
+
+    def test_unknown_scheme(self):
+        with self.assertRaises(ValueError):
+            ids.get_generator('uuid9')
+
+    def test_ingest_uses_scheme(self):
+        with patch.dict(ingestion_api.app.config,
+                        {'MESSAGE_ID_SCHEME': 'ulid'}):
+            self.client.post('/dummy', data={'data': '{}'})
+            actual = self.client.post('/dummy/batch', data='1\n2')
+        content = self.assertJSON(actual)
+        txt, message_id, timestamp = self.mock_celery.call_args_list[0][0]
+        self.assertEqual(len(message_id), 26)
+        self.assertEqual(timestamp_ms(message_id) // 1000, timestamp)
+        self.assertEqual(len(content['message_ids']), 2)
+        self.assertLess(message_id, content['message_ids'][0])
+        self.assertLess(*content['message_ids'])
+
+
+class SpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = spool.Spool(self.tmp.name, segment_size=100)
+
+    def tearDown(self):
+        self.spool.seal()
+        self.tmp.cleanup()
+
+    def test_append_and_drain(self):
+        self.spool.append([('{"a": 1}', 'm1', 5), ('{}', 'm2', 5)])
+        self.spool.append([('{"b": 2}', 'm3', 6)])
+        self.assertEqual(self.spool.state()['documents'], 3)
+        # The segment size is small enough for the second append to roll over.
+        self.assertEqual(self.spool.state()['segments'], 2)
+        replayed = []
+        self.assertEqual(self.spool.drain(replayed.extend), 3)
+        self.assertEqual(replayed, [('{"a": 1}', 'm1', 5), ('{}', 'm2', 5),
+                                    ('{"b": 2}', 'm3', 6)])
+        self.assertEqual(self.spool.state(),
+                         {'segments': 0, 'bytes': 0, 'documents': 0})
+
+    def test_state_counted(self):
+        self.spool.append([('{}', 'm1', 5)])
+        with patch('spool.read_segment') as mock_read, \
+                patch('os.listdir') as mock_listdir:
+            self.spool.append([('{}', 'm2', 5)])
+            self.assertEqual(self.spool.state()['documents'], 2)
+        mock_read.assert_not_called()
+        mock_listdir.assert_not_called()
+        self.spool.seal()
+        other = spool.Spool(self.tmp.name)
+        self.assertEqual(other.state(), self.spool.state())
+        # Drains by other processes are picked up by the next drain.
+        other.drain(lambda entries: None)
+        self.spool.drain(lambda entries: None)
+        self.assertEqual(self.spool.state(),
+                         {'segments': 0, 'bytes': 0, 'documents': 0})
+
+    def test_failed_replay_kept(self):
+        self.spool.append([('{}', 'm1', 5)])
+
+        def fail(entries):
+            raise OSError
+        with self.assertRaises(OSError):
+            self.spool.drain(fail)
+        replayed = []
+        self.spool.drain(replayed.extend)
+        self.assertEqual(replayed, [('{}', 'm1', 5)])
+
+    def test_full(self):
+        small = spool.Spool(self.tmp.name, max_bytes=60)
+        small.append([('{}', 'm1', 5)])
+        with self.assertRaises(spool.SpoolFull):
+            small.append([('{}', 'm2', 5)])
+        small.seal()
+
+    def test_torn_record_ignored(self):
+        self.spool.append([('{}', 'm1', 5)])
+        self.spool.segment.write(b'\x00\x00\x00\x10abc')
+        self.spool.seal()
+        self.assertEqual(spool.read_segment(self.spool.claim()),
+                         [('{}', 'm1', 5)])
+
+    def test_recover_dead_process_segments(self):
+        self.spool.append([('{}', 'm1', 5)])
+        path = self.spool.segment_path
+        self.spool.segment.close()
+        self.spool.segment = None
+        os.rename(path, path.replace('-%d.' % os.getpid(), '-999999999.'))
+        self.assertIsNone(self.spool.claim())
+        spool.Spool(self.tmp.name)
+        self.assertEqual(len(spool.read_segment(self.spool.claim())), 1)
+
+
+class SpoolIngestTests(BaseTests):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        ingestion_api.app.config['SPOOL_DIR'] = self.tmp.name
+        ingestion_api.spools.clear()
+
+    def tearDown(self):
+        super().tearDown()
+        ingestion_api.get_spool().seal()
+        ingestion_api.app.config['SPOOL_DIR'] = ''
+        ingestion_api.spools.clear()
+        self.tmp.cleanup()
+
+    def test_spooled_while_broker_down(self):
+        self.mock_celery.side_effect = kombu.exceptions.KombuError
+        actual = self.client.post('/dummy', data={'data': '{}'})
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        message_id = self.assertJSON(actual)['message_id']
+        self.assertTrue(self.assertJSON(actual)['spooled'])
+        health = self.assertJSON(self.client.get('/health'))
+        self.assertEqual(health['spool']['documents'], 1)
+
+        self.assertEqual(ingestion_api.drain_spool(), 1)
+        txts, ids, timestamp = self.mock_celery_batch.call_args[0]
+        self.assertEqual((txts, ids), (['{}'], [message_id]))
+        health = self.assertJSON(self.client.get('/health'))
+        self.assertEqual(health['spool']['documents'], 0)
+
+    def test_not_drained_while_circuit_open(self):
+        ingestion_api.spool_documents(['{}'], ['m'], 5)
+        with patch('ingestion_api.task_queue_circuit') as mock_circuit:
+            mock_circuit.opened = True
+            self.assertEqual(ingestion_api.drain_spool(), 0)
+        self.mock_celery_batch.assert_not_called()
+
+    def test_spool_full(self):
+        ingestion_api.get_spool().max_bytes = 0
+        self.mock_celery_batch.side_effect = kombu.exceptions.KombuError
+        actual = self.client.post('/dummy/batch', data='{}\n{}')
+        self.assertHTTPErrorWithJSONResponse(actual, 503, 2000)
+
+
+class StreamTransportTests(BaseTests):
+
+    def setUp(self):
+        super().setUp()
+        ingestion_api.app.config['INGEST_TRANSPORT'] = 'stream'
+
+    def tearDown(self):
+        ingestion_api.app.config['INGEST_TRANSPORT'] = 'celery'
+        super().tearDown()
+
+    def test_post_does_not_publish(self):
+        actual = self.client.post('/dummy', data={'data': '{}'})
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        self.assertEqual(self.mock_celery.call_args[0][0], '{}')
+        self.mock_redis.return_value.publish.assert_not_called()
+
+    def test_batch_does_not_publish(self):
+        actual = self.client.post('/dummy/batch', data='1\n2')
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        self.mock_redis.return_value.pipeline.assert_not_called()
+
+    def test_append_to_stream(self):
+        pipe = self.mock_redis.return_value.pipeline.return_value
+        pipe.execute.return_value = [b'1000-0']
+        self.assertEqual(ingestion_api.append_to_stream(['{}']), ['1000-0'])
+        pipe.execute_command.assert_called_once_with(
+            'XADD', 'incoming', 'MAXLEN', '~', 1000000, '*', 'data', '{}')
+
+
+class RedisClientTests(unittest.TestCase):
+
+    def test_client_uses_bounded_pool(self):
+        client = ingestion_api.make_redis_client('localhost', '6379', '2')
+        pool = client.connection_pool
+        self.assertEqual(pool.max_connections,
+                         ingestion_api.app.config['REDIS_MAX_CONNECTIONS'])
+        self.assertEqual(pool.connection_kwargs['db'], 2)
+        # Making a client doesn't connect (or subscribe to anything).
+        self.assertEqual(pool._connections, [])
+
+    @patch('ingestion_api.get_broker_client')
+    def test_enqueue_and_publish_pipelines(self, mock_client):
+        pipe = mock_client.return_value.pipeline.return_value
+        pipe.execute.return_value = [1, 0]
+        ingestion_api.enqueue_and_publish(tasks.add, ('{}',),
+                                          {'message_id': 'a'}, ['{}'])
+        queue, message = pipe.lpush.call_args[0]
+        self.assertEqual(queue, 'celery')
+        message = json.loads(message)
+        self.assertEqual(message['headers']['task'], 'tasks.add')
+        args, kwargs, embed = json.loads(base64.b64decode(message['body']))
+        self.assertEqual(kwargs, {'message_id': 'a'})
+        pipe.publish.assert_called_once_with(
+            ingestion_api.app.config['REDIS_TOPIC'], '{}')
+
+    @patch('ingestion_api.get_broker_client')
+    def test_enqueue_and_publish_raises_enqueue_errors(self, mock_client):
+        pipe = mock_client.return_value.pipeline.return_value
+        pipe.execute.return_value = [ingestion_api.redis.RedisError(), 0]
+        with self.assertRaises(ingestion_api.redis.RedisError):
+            ingestion_api.enqueue_and_publish(tasks.add, ('{}',), {},
+                                              ['{}'])
+
+
+class PipelinedEnqueueTests(BaseTests):
+
+    def setUp(self):
+        super().setUp()
+        ingestion_api.app.config['PIPELINE_ENQUEUE'] = True
+
+    def tearDown(self):
+        ingestion_api.app.config['PIPELINE_ENQUEUE'] = False
+        super().tearDown()
+
+    def test_post_does_not_publish_separately(self):
+        actual = self.client.post('/dummy', data={'data': '{}'})
+        self.assertHTTPErrorWithJSONResponse(actual, 202)
+        self.mock_redis.return_value.publish.assert_not_called()
+
+
+class StreamsTests(unittest.TestCase):
+
+    def test_parse_raw_reply(self):
+        reply = [[b'incoming', [[b'1000-0', [b'data', b'{}']]]]]
+        self.assertEqual(streams.parse_read_reply(reply), [('1000-0', '{}')])
+
+    def test_parse_decoded_reply(self):
+        reply = [['incoming', [('1000-0', {b'data': b'{}'})]]]
+        self.assertEqual(streams.parse_read_reply(reply), [('1000-0', '{}')])
+
+    def test_parse_empty_reply(self):
+        self.assertEqual(streams.parse_read_reply(None), [])
+
+    def test_backlog_pending(self):
+        client = MagicMock()
+        client.execute_command.side_effect = [
+            [[b'name', b'persist', b'pending', 3,
+              b'last-delivered-id', b'5000-0']],
+            [3, b'2000-0', b'5000-0', []],
+        ]
+        self.assertEqual(streams.backlog(client, 'incoming', 'persist',
+                                         now=12),
+                         (3, 10))
+
+    def test_backlog_undelivered(self):
+        client = MagicMock()
+        client.execute_command.side_effect = [
+            [{'name': 'persist', 'pending': 0, 'lag': 2,
+              'last-delivered-id': '1000-0'}],
+            [[b'1000-0', [b'data', b'a']], [b'4000-0', [b'data', b'b']]],
+        ]
+        self.assertEqual(streams.backlog(client, 'incoming', 'persist',
+                                         now=5),
+                         (2, 1))
+
+    def test_backlog_unknown_group(self):
+        client = MagicMock()
+        client.execute_command.return_value = []
+        self.assertEqual(streams.backlog(client, 'incoming', 'persist'),
+                         (0, None))
+
+    def test_entry_timestamp(self):
+        self.assertEqual(streams.entry_timestamp('1526919030474-3'),
+                         1526919030)
+
+
+class AsyncIngestionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeAsyncRedis()
+
+        async def get_redis_pool(*args):
+            return self.pool
+        self.patch_pool = patch('ingestion_asgi.get_redis_pool',
+                                get_redis_pool)
+        self.patch_pool.start()
+
+    def tearDown(self):
+        self.patch_pool.stop()
+
+    def request(self, method, path, body=b'', headers=()):
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'headers': list(headers)}
+        run_async(ingestion_asgi.app(scope, receive, send))
+        return sent[0]['status'], sent[1]['body']
+
+    def assertError(self, response, status, code):
+        self.assertEqual(response[0], status)
+        self.assertEqual(json.loads(response[1])['code'], code)
+
+    def test_post_success(self):
+        status, body = self.request('POST', '/dummy', b'data=%7B%7D')
+        self.assertEqual(status, 202)
+        self.assertTrue(json.loads(body)['success'])
+        (_, queue, messages), publish = self.pool.calls
+        self.assertEqual(queue, 'celery')
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(publish, ('publish',
+                                   ingestion_api.app.config['REDIS_TOPIC'],
+                                   '{}'))
+
+    def test_post_missing(self):
+        self.assertError(self.request('POST', '/dummy'), 400, 1000)
+
+    def test_post_invalid_json(self):
+        self.assertError(self.request('POST', '/dummy', b'data=%7B'),
+                         400, 1001)
+
+    def test_post_invalid_length(self):
+        body = b'data=' + b'1' * 5000
+        self.assertError(self.request('POST', '/dummy', body), 400, 1002)
+
+    def test_post_gzip(self):
+        body = gzip.compress(b'data=%7B%7D')
+        status, _ = self.request('POST', '/dummy', body,
+                                 [(b'content-encoding', b'gzip')])
+        self.assertEqual(status, 202)
+        self.assertEqual(self.pool.calls[1][2], '{}')
+        self.assertError(self.request('POST', '/dummy', body,
+                                      [(b'content-encoding', b'br')]),
+                         415, 1004)
+
+    def test_post_broker_unavailable(self):
+        async def enqueue_task(txt, message_id, timestamp, keyed=False):
+            raise ConnectionRefusedError
+        with patch('ingestion_asgi.enqueue_task', enqueue_task):
+            self.assertError(self.request('POST', '/dummy', b'data=1'),
+                             503, 2000)
+
+    def test_health_and_documentation(self):
+        self.assertEqual(self.request('GET', '/health')[0], 200)
+        status, body = self.request('GET', '/documentation')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/dummy', body)
+
+    def test_unknown_route(self):
+        self.assertEqual(self.request('GET', '/nope')[0], 404)
+        self.assertEqual(self.request('GET', '/dummy')[0], 405)
+
+    def test_task_message(self):
+        queue, message = tasks.make_task_message(tasks.add, ('a',))
+        message = json.loads(message)
+        self.assertEqual(message['headers']['task'], 'tasks.add')
+        args, kwargs, embed = json.loads(
+            base64.b64decode(message['body']))
+        self.assertEqual((args, kwargs), (['a'], {}))
+
+    def test_async_circuit_opens(self):
+        breaker = circuitbreaker.CircuitBreaker(failure_threshold=1,
+                                                name='async-test')
+
+        @ingestion_asgi.async_circuit(breaker)
+        async def fail():
+            raise OSError
+
+        with self.assertRaises(OSError):
+            run_async(fail())
+        with self.assertRaises(circuitbreaker.CircuitBreakerError):
+            run_async(fail())
+
+
 class BaseListTests(unittest.TestCase):
 
     def setUp(self):
@@ -105,6 +903,7 @@ class BaseListTests(unittest.TestCase):
         with list_api.app.app_context():
             list_api.db.drop_all()
             list_api.db.create_all()
+        list_api.page_cache = list_api.make_page_cache()
         self.client = list_api.app.test_client()
 
     def make_record(self, timestamp, message_id, record):
@@ -185,6 +984,511 @@ class ListTestsEmpty(BaseListTests):
         self.assertEqual(seen, created)
 
 
+class PaginationTests(BaseListTests):
+
+    def list_all(self, **params):
+        seen = []
+        url = '/records'
+        while url:
+            actual = json.loads(self.client.get(url).data)
+            seen += [(r['timestamp'], r['message_id'])
+                     for r in actual['results']]
+            url = actual['next'] and '/records?next=%s' % actual['next']
+        return seen
+
+    def test_later_seconds_with_smaller_ids(self):
+        created = []
+        for i in range(25):
+            self.make_record(timestamp=i // 3, message_id='%02d' % (30 - i),
+                             record='foo')
+            created.append((i // 3, '%02d' % (30 - i)))
+        self.assertEqual(self.list_all(), sorted(created))
+
+    def test_exact_page_has_no_next_after_last(self):
+        for i in range(10):
+            self.make_record(timestamp=0, message_id='m%d' % i, record='foo')
+        actual = json.loads(self.client.get('/records').data)
+        actual = json.loads(self.client.get(
+            '/records?next=%s' % actual['next']).data)
+        self.assertEqual((actual['count'], actual['next']), (0, None))
+
+    def test_tokens(self):
+        token = cursors.encode(5, 'abc', True, 1, None)
+        self.assertEqual(cursors.decode(token),
+                         (5, 'abc', False, True, 1, None))
+        self.assertEqual(cursors.decode('WzEsNSwiYWJjIl0'),
+                         (5, 'abc', False, False, None, None))
+        # Unversioned tokens point at the first record of the next page.
+        self.assertEqual(cursors.decode('5_abc_d'),
+                         (5, 'abc_d', True, False, None, None))
+        for bad in ('x', 'WzMsNSwiYSJd', '%%'):
+            with self.assertRaises(ValueError):
+                cursors.decode(bad)
+        self.make_record(timestamp=5, message_id='abc', record='foo')
+        actual = json.loads(self.client.get('/records?next=5_abc').data)
+        self.assertEqual(actual['count'], 1)
+        response = self.client.get('/records?next=nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['code'], 1100)
+
+
+class RangeQueryTests(BaseListTests):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(30):
+            self.make_record(timestamp=i // 2, message_id='m%02d' % i,
+                             record='foo')
+
+    def list_all(self, query):
+        seen = []
+        actual = json.loads(self.client.get('/records?' + query).data)
+        while True:
+            seen += [r['message_id'] for r in actual['results']]
+            if not actual['next']:
+                return seen
+            actual = json.loads(self.client.get(
+                '/records?next=%s' % actual['next']).data)
+
+    def test_since_until(self):
+        self.assertEqual(self.list_all('since=3&until=12'),
+                         ['m%02d' % i for i in range(6, 24)])
+
+    def test_desc(self):
+        self.assertEqual(self.list_all('order=desc'),
+                         ['m%02d' % i for i in reversed(range(30))])
+        self.assertEqual(self.list_all('order=desc&since=10'),
+                         ['m%02d' % i for i in reversed(range(20, 30))])
+
+    def test_invalid_parameters(self):
+        for query in ('since=x', 'until=1.5', 'order=up'):
+            response = self.client.get('/records?' + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)['code'], 1101)
+
+    def test_count(self):
+        actual = json.loads(self.client.get('/records/count?since=5').data)
+        self.assertEqual(actual, {'count': 20, 'estimated': False})
+        actual = json.loads(self.client.get('/records/count').data)
+        self.assertEqual(actual['count'], 30)
+
+
+class EngineTests(BaseListTests):
+
+    def test_reader_defaults_to_writer(self):
+        self.assertIs(list_api.get_engine('reader'),
+                      list_api.get_engine('writer'))
+        health = json.loads(self.client.get('/health').data)
+        self.assertEqual(set(health), {'reader', 'writer'})
+
+    def test_pool_options(self):
+        with patch.dict(os.environ, {'DB_READER_POOL_SIZE': '3',
+                                     'DB_READER_POOL_RECYCLE': '60'}):
+            self.assertEqual(db.pool_options('reader'),
+                             {'pool_size': 3, 'pool_recycle': 60})
+        self.assertEqual(db.pool_options('writer'), {})
+
+    def test_separate_reader(self):
+        reader_db = tempfile.NamedTemporaryFile(suffix='.db')
+        self.addCleanup(reader_db.close)
+        uri = 'sqlite:///' + reader_db.name
+        with patch.dict(list_api.app.config,
+                        {'SQLALCHEMY_READER_DATABASE_URI': uri}), \
+                patch.dict(db.engines, clear=True), \
+                patch.dict(os.environ, {'DB_READER_PRE_PING': '1'}):
+            reader = list_api.get_engine('reader')
+            self.assertIsNot(reader, list_api.get_engine('writer'))
+            list_api.Records.__table__.create(reader)
+            self.make_record(timestamp=1, message_id='m', record='foo')
+            actual = json.loads(self.client.get('/records').data)
+            self.assertEqual(actual['count'], 0)
+            # Recent writers read from the writer.
+            with patch('list_api.READ_AFTER_WRITE_WINDOW', 10):
+                self.client.set_cookie('localhost', 'last_write',
+                                       str(int(time.time())))
+                actual = json.loads(self.client.get('/records').data)
+                self.assertEqual(actual['count'], 1)
+            self.assertIn('status', list_api.pool_stats('reader'))
+
+    def test_last_write_cookie(self):
+        with patch.dict(ingestion_api.app.config,
+                        {'READ_AFTER_WRITE_WINDOW': 5}), \
+                patch('ingestion_api.enqueue_task') as mock_enqueue:
+            mock_enqueue.return_value = 'm'
+            client = ingestion_api.app.test_client()
+            response = client.post('/dummy', data={'data': '{}'})
+        self.assertIn('last_write=', response.headers['Set-Cookie'])
+
+
+class RollupTests(BaseListTests):
+
+    def stats(self, query=''):
+        return json.loads(self.client.get('/records/stats?' + query).data)
+
+    def test_rollups_maintained(self):
+        with list_api.app.app_context():
+            tasks.add_batch(['{}', '{"a": 1}'], message_ids=['a', 'b'],
+                            timestamp=61)
+            tasks.add('{}', message_id='c', timestamp=170)
+            # Redelivered tasks aren't counted again.
+            tasks.add('{}', message_id='c', timestamp=170)
+            tasks.add_batch(['{}', '{}'], message_ids=['a', 'd'],
+                            timestamp=61)
+        self.assertEqual(self.stats()['results'], [
+            {'timestamp': 60, 'count': 3, 'bytes': 12},
+            {'timestamp': 120, 'count': 1, 'bytes': 2}])
+        self.assertEqual(self.stats('bucket=300')['results'], [
+            {'timestamp': 0, 'count': 4, 'bytes': 14}])
+        self.assertEqual(self.stats('since=120')['results'], [
+            {'timestamp': 120, 'count': 1, 'bytes': 2}])
+
+    def test_rollups_spread_over_slots(self):
+        with list_api.app.app_context(), \
+                patch('random.randrange', side_effect=[0, 1, 2]):
+            for message_id in 'abc':
+                tasks.add('{}', message_id=message_id, timestamp=61)
+            rows = tasks.db.session.query(db.RecordStats).count()
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.stats()['results'], [
+            {'timestamp': 60, 'count': 3, 'bytes': 6}])
+
+    def test_rollups_purged(self):
+        with list_api.app.app_context():
+            for i in range(5):
+                tasks.add('{}', message_id='m%d' % i, timestamp=i * 50)
+            with list_api.db.engine.connect() as connection:
+                retention.purge(connection, 130, pause=0)
+        self.assertEqual([(r['timestamp'], r['count'])
+                          for r in self.stats()['results']],
+                         [(120, 1), (180, 1)])
+
+    def test_invalid_bucket(self):
+        for query in ('bucket=90', 'bucket=-60', 'bucket=x'):
+            response = self.client.get('/records/stats?' + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)['code'], 1101)
+
+    def test_rebuild(self):
+        for i in range(5):
+            self.make_record(timestamp=i * 50, message_id='m%d' % i,
+                             record='foo')
+        self.assertEqual(self.stats()['results'], [])
+        result = click.testing.CliRunner().invoke(
+            db.rebuild_rollups, [],
+            obj=flask.cli.ScriptInfo(create_app=lambda *args: db.app))
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([(r['timestamp'], r['count'])
+                          for r in self.stats()['results']],
+                         [(0, 2), (60, 1), (120, 1), (180, 1)])
+        with list_api.app.app_context():
+            with list_api.db.engine.connect() as connection:
+                rollups.rebuild(connection, 0, 60)
+        self.assertEqual(self.stats('until=60')['results'][0]['count'], 2)
+
+
+class ShardTests(BaseListTests):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        uris = ['sqlite:///%s/shard%d.db' % (self.tmp.name, i)
+                for i in range(3)]
+        for p in (patch.dict(list_api.app.config,
+                             {'SHARD_DATABASE_URIS': uris}),
+                  patch.dict(db.engines, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+        for engine in db.get_shard_engines():
+            db.db.metadata.create_all(engine)
+        ids = ['m%02d' % i for i in range(25)]
+        with list_api.app.app_context():
+            tasks.add_batch(['{}'] * 12, message_ids=ids[:12], timestamp=1)
+            tasks.add_batch(['{}'] * 13, message_ids=ids[12:], timestamp=2)
+        self.created = [(1, m) for m in ids[:12]] + [(2, m) for m in ids[12:]]
+
+    def list_all(self, query=''):
+        seen = []
+        actual = json.loads(self.client.get('/records?' + query).data)
+        while True:
+            seen += [(r['timestamp'], r['message_id'])
+                     for r in actual['results']]
+            if not actual['next']:
+                return seen
+            actual = json.loads(self.client.get(
+                '/records?next=%s' % actual['next']).data)
+
+    def test_rows_routed_to_shards(self):
+        engines = db.get_shard_engines()
+        for index, engine in enumerate(engines):
+            ids = [m for m, in engine.execute(
+                'SELECT message_id FROM records')]
+            self.assertTrue(ids)
+            for message_id in ids:
+                self.assertEqual(db.shard_index(message_id, 3), index)
+        with list_api.app.app_context():
+            self.assertEqual(list_api.Records.query.count(), 0)
+
+    def test_scatter_gather(self):
+        self.assertEqual(self.list_all(), self.created)
+        self.assertEqual(self.list_all('order=desc'),
+                         list(reversed(self.created)))
+        self.assertEqual(self.list_all('since=2'), self.created[12:])
+        actual = json.loads(self.client.get('/records/count').data)
+        self.assertEqual(actual['count'], 25)
+        stats = json.loads(self.client.get('/records/stats').data)
+        self.assertEqual([r['count'] for r in stats['results']], [25])
+
+    def test_shard_replicas(self):
+        readers = ['sqlite:///%s/reader%d.db' % (self.tmp.name, i)
+                   for i in range(3)]
+        with patch.dict(list_api.app.config,
+                        {'SHARD_READER_DATABASE_URIS': readers}), \
+                patch('list_api.READ_AFTER_WRITE_WINDOW', 60):
+            for engine in db.get_shard_engines('reader'):
+                db.db.metadata.create_all(engine)
+            # The replicas haven't caught up, a recent writer still sees its
+            # records.
+            self.assertEqual(self.list_all(), [])
+            self.client.set_cookie('localhost', 'last_write',
+                                   str(int(time.time())))
+            self.assertEqual(self.list_all(), self.created)
+
+    def test_export(self):
+        lines = self.client.get('/records/export').data.splitlines()
+        self.assertEqual([(json.loads(l)['timestamp'],
+                           json.loads(l)['message_id']) for l in lines],
+                         self.created)
+
+
+class RetentionTests(BaseListTests):
+
+    def test_partition_bounds(self):
+        day = 86400
+        self.assertEqual(retention.partition_bounds(10, 2 * day, day),
+                         [day, 2 * day, 3 * day])
+        self.assertEqual(retention.partition_clauses([day], day),
+                         'PARTITION p197001010000 VALUES LESS THAN (86400)')
+
+    def test_ensure_partitions(self):
+        day = 86400
+        connection = MagicMock()
+        connection.execute.return_value = [('p197001010000', str(day)),
+                                           ('pmax', 'MAXVALUE')]
+        created = retention.ensure_partitions(connection, day + 5, day, day)
+        self.assertEqual(created, ['p197001020000', 'p197001030000'])
+        sql = str(connection.execute.call_args[0][0])
+        self.assertIn('REORGANIZE PARTITION pmax', sql)
+        self.assertIn('VALUES LESS THAN (259200)', sql)
+
+    def test_drop_expired_partitions(self):
+        connection = MagicMock()
+        connection.execute.return_value = [('p1', '100'), ('p2', '200'),
+                                           ('pmax', 'MAXVALUE')]
+        self.assertEqual(
+            retention.drop_expired_partitions(connection, 150), ['p1'])
+        self.assertIn('DROP PARTITION p1',
+                      str(connection.execute.call_args[0][0]))
+
+    def test_purge_batches(self):
+        for i in range(25):
+            self.make_record(timestamp=i, message_id='m%d' % i,
+                             record='foo')
+        with list_api.app.app_context():
+            with list_api.db.engine.connect() as connection:
+                removed = retention.purge(connection, 20, batch_size=7,
+                                          pause=0)
+            self.assertEqual(removed, {'records': 20})
+            self.assertEqual(list_api.Records.query.count(), 5)
+
+
+class RawDataTests(BaseListTests):
+
+    def test_raw_data(self):
+        self.make_record(timestamp=1, message_id='m"1', record='{"a": [1]}')
+        plain = json.loads(self.client.get('/records').data)
+        self.assertEqual(plain['results'][0],
+                         {'timestamp': 1, 'message_id': 'm"1',
+                          'data': '{"a": [1]}'})
+        raw = json.loads(self.client.get('/records?data=raw').data)
+        self.assertEqual(raw['results'][0]['data'], {'a': [1]})
+        raw = self.client.get('/records', headers={
+            'Accept': 'application/vnd.records.raw+json'})
+        self.assertEqual(json.loads(raw.data)['results'][0]['data'],
+                         {'a': [1]})
+        self.assertIn('Accept', raw.headers['Vary'])
+        browser = self.client.get('/records', headers={'Accept': '*/*'})
+        self.assertEqual(json.loads(browser.data), plain)
+
+    def test_null_and_invalid_records(self):
+        self.make_record(timestamp=1, message_id='m1', record=None)
+        self.make_record(timestamp=2, message_id='m2', record='foo')
+        self.make_record(timestamp=3, message_id='m3', record='None')
+        self.make_record(timestamp=4, message_id='m4', record='[NaN]')
+        for url in ('/records', '/records?data=raw'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            results = json.loads(response.data.decode('utf-8'),
+                                 parse_constant=jsoncheck.reject_constant)
+            self.assertEqual([r['data'] for r in results['results']],
+                             [None, 'foo', 'None', '[NaN]'])
+
+
+class PageCacheTests(BaseListTests):
+
+    def test_lru(self):
+        clock = FakeClock()
+        cache = pagecache.LRUCache(10, 5, clock=clock)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        cache.set('c', b'1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.set('d', b'x' * 11)
+        self.assertIsNone(cache.get('d'))
+        clock.now += 5
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 4)
+
+    def test_shared_tier(self):
+        shared = MagicMock()
+        shared.get_with_ttl.return_value = (b'page', 2)
+        clock = FakeClock()
+        cache = pagecache.PageCache(pagecache.LRUCache(100, 5, clock=clock),
+                                    shared)
+        self.assertEqual(cache.get('k'), b'page')
+        self.assertEqual(cache.get('k'), b'page')
+        self.assertEqual(shared.get_with_ttl.call_count, 1)
+        # The local copy expires with the shared entry.
+        clock.now += 2
+        cache.get('k')
+        self.assertEqual(shared.get_with_ttl.call_count, 2)
+        shared.get_with_ttl.side_effect = OSError
+        cache = pagecache.PageCache(pagecache.LRUCache(100, 5), shared,
+                                    errors=(OSError,))
+        self.assertIsNone(cache.get('k'))
+
+    def test_redis_ttl(self):
+        client = MagicMock()
+        client.pipeline.return_value.execute.return_value = [b'page', 1500]
+        cache = pagecache.RedisCache(client, 60)
+        self.assertEqual(cache.get_with_ttl('k'), (b'page', 1.5))
+        client.pipeline.return_value.execute.return_value = [None, -2]
+        self.assertIsNone(cache.get('k'))
+
+    def test_expired_entry_rendered_again(self):
+        for i in range(25):
+            self.make_record(timestamp=i, message_id='m%02d' % i,
+                             record='foo')
+        url = '/records?next=%s' % json.loads(
+            self.client.get('/records').data)['next']
+        key = list_api.page_key(cursors.decode(url.split('=', 1)[1]),
+                                list_api.COUNT_VALUE, False)
+        list_api.page_cache.local.set(key, b'1 {"results": []}')
+        response = self.client.get(url)
+        self.assertEqual(len(json.loads(response.data)['results']), 10)
+
+    def test_old_pages_cached(self):
+        for i in range(25):
+            self.make_record(timestamp=i, message_id='m%02d' % i,
+                             record='foo')
+        # Purging old records changes the first page.
+        start = self.client.get('/records')
+        self.assertEqual(start.headers['Cache-Control'], 'no-cache')
+        url = '/records?next=%s' % json.loads(start.data)['next']
+        first = self.client.get(url)
+        self.assertEqual(first.headers['Cache-Control'],
+                         'public, max-age=%d, immutable' %
+                         list_api.PAGE_CACHE_TTL)
+        with patch('list_api.render_page') as mock_render:
+            again = self.client.get(url)
+            mock_render.assert_not_called()
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(again.headers['ETag'], first.headers['ETag'])
+        self.assertIn('immutable', again.headers['Cache-Control'])
+
+        not_modified = self.client.get(
+            url, headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+
+        # The last page can still grow.
+        tail = self.client.get('/records?next=%s' %
+                               json.loads(first.data)['next'])
+        self.assertEqual(tail.headers['Cache-Control'], 'no-cache')
+
+    def test_cached_pages_expire_with_retention(self):
+        now = int(time.time())
+        cursor = cursors.Cursor(100, 'm', False, False, None, None)
+        rows = [(now - 1000 + i, 'm') for i in range(10)]
+        self.assertEqual(list_api.page_expiry(cursor, rows, 10, now),
+                         now + list_api.PAGE_CACHE_TTL)
+        with patch.dict(list_api.app.config, {'RECORD_RETENTION': 1500}):
+            self.assertEqual(list_api.page_expiry(cursor, rows, 10, now),
+                             now + 500)
+        with patch.dict(list_api.app.config, {'RECORD_RETENTION': 900}):
+            self.assertIsNone(list_api.page_expiry(cursor, rows, 10, now))
+
+    def test_gzip_etag(self):
+        for i in range(15):
+            self.make_record(timestamp=i, message_id='m%02d' % i,
+                             record='a' * 100)
+        zipped = self.client.get('/records',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(zipped.headers['ETag'].endswith('-gzip"'))
+        again = self.client.get('/records', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': zipped.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers['ETag'], zipped.headers['ETag'])
+        plain = self.client.get('/records', headers={
+            'If-None-Match': zipped.headers['ETag'].replace('-gzip', '')})
+        self.assertEqual(plain.status_code, 304)
+        self.assertFalse(plain.headers['ETag'].endswith('-gzip"'))
+
+    def test_recent_pages_not_cached(self):
+        now = int(time.time())
+        cursor = cursors.Cursor(None, None, False, False, None, None)
+        results = [(now, 'm')] * 10
+        self.assertFalse(list_api.page_is_immutable(cursor, results, 10, now))
+        self.assertFalse(list_api.page_is_immutable(cursor, results[:5], 10,
+                                                    0))
+        desc = cursor._replace(desc=True)
+        self.assertFalse(list_api.page_is_immutable(desc, results, 10,
+                                                    now + 10 ** 6))
+        self.assertTrue(list_api.page_is_immutable(
+            desc._replace(timestamp=now), results, 10, now + 10 ** 6))
+        self.assertFalse(list_api.page_is_immutable(
+            desc._replace(until=now), results, 10, now + 10 ** 6))
+
+
+class ExportTests(BaseListTests):
+
+    def test_export(self):
+        for i in range(25):
+            self.make_record(timestamp=i, message_id='m%02d' % i,
+                             record='{"i": %d}' % i)
+        with patch('list_api.EXPORT_FETCH_SIZE', 10):
+            response = self.client.get('/records/export?since=5')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = [json.loads(l) for l in response.data.splitlines()]
+            self.assertEqual([l['message_id'] for l in lines],
+                             ['m%02d' % i for i in range(5, 25)])
+            self.assertEqual(lines[0]['data'], '{"i": 5}')
+
+            resumed = self.client.get(
+                '/records/export?next=%s' % lines[9]['next'],
+                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resumed.headers['Content-Encoding'], 'gzip')
+            lines = gzip.decompress(resumed.data).splitlines()
+            self.assertEqual(json.loads(lines[0])['message_id'], 'm15')
+            self.assertEqual(len(lines), 10)
+
+    def test_export_invalid(self):
+        response = self.client.get('/records/export?order=sideways')
+        self.assertEqual(response.status_code, 400)
+
+
 def time_func():
     return 1
 
@@ -217,6 +1521,552 @@ class TasksTests(BaseListTests):
             self.assertEqual(len(results), 1)
 
 
+class CompressedRecordTests(BaseListTests):
+
+    def test_compressed_record_listed(self):
+        with patch('tasks.RECORD_COMPRESSION', 'zlib'):
+            with list_api.app.app_context():
+                tasks.add('{"a": 1}', message_id='m', timestamp=5)
+                r = tasks.db.session.query(tasks.Records).one()
+                self.assertIsNone(r.record)
+                self.assertEqual(compression.unpack(r.record_z), '{"a": 1}')
+        actual = json.loads(self.client.get('/records').data)
+        self.assertEqual(actual['results'][0]['data'], '{"a": 1}')
+
+    def test_gzip_response(self):
+        for i in range(20):
+            self.make_record(timestamp=i, message_id='m%d' % i,
+                             record='a' * 100)
+        plain = self.client.get('/records')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        zipped = self.client.get('/records',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', zipped.headers['Vary'])
+        self.assertEqual(gzip.decompress(zipped.data), plain.data)
+
+    def test_compressed_task_message(self):
+        tasks.app.conf.task_compression = 'zlib'
+        try:
+            queue, message = tasks.make_task_message(tasks.add, ('a',))
+        finally:
+            tasks.app.conf.task_compression = None
+        message = json.loads(message)
+        self.assertEqual(message['headers']['compression'],
+                         'application/x-gzip')
+        body = kombu.compression.decompress(
+            base64.b64decode(message['body']), 'application/x-gzip')
+        self.assertEqual(json.loads(body)[0], ['a'])
+
+
+class IngestIdTasksTests(BaseListTests):
+
+    def test_redelivered_task_stored_once(self):
+        with list_api.app.app_context():
+            for i in range(2):
+                tasks.add('foo', message_id='m', timestamp=5)
+            res = tasks.db.session.query(tasks.Records)
+            self.assertEqual([(r.timestamp, r.message_id) for r in res],
+                             [(5, 'm')])
+
+    def test_recently_written_skipped(self):
+        with patch('tasks.deduper', dedupe.MemoryDeduper(10)):
+            with list_api.app.app_context():
+                tasks.add('foo', message_id='m', timestamp=5)
+                with patch('tasks.write_records') as mock_write:
+                    tasks.add('foo', message_id='m', timestamp=5)
+                    tasks.add_batch(['foo'], message_ids=['m'], timestamp=5)
+                mock_write.assert_not_called()
+
+    def test_keyed_retry_stored_once(self):
+        with list_api.app.app_context():
+            tasks.add('foo', message_id='k', timestamp=5, keyed=True)
+            tasks.add('foo', message_id='k', timestamp=9, keyed=True)
+            tasks.add_batch(['foo', 'bar'], message_ids=['k', 'j'],
+                            timestamp=9, keyed=True)
+            res = tasks.db.session.query(tasks.Records)
+            self.assertEqual(sorted((r.timestamp, r.message_id)
+                                    for r in res),
+                             [(5, 'k'), (9, 'j')])
+
+    def test_upgrade_records_adds_index(self):
+        with list_api.app.app_context():
+            engine = db.get_engine('writer')
+            engine.execute('DROP INDEX ix_records_message_id')
+            self.assertEqual(db.upgrade_records(engine),
+                             ["added index ix_records_message_id"])
+            self.assertEqual(db.upgrade_records(engine), [])
+
+    def test_upgrade_records_adds_record_z(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        engine.execute('CREATE TABLE records (timestamp INTEGER, '
+                       'message_id VARCHAR(32), record TEXT, '
+                       'PRIMARY KEY (timestamp, message_id))')
+        engine.execute("INSERT INTO records VALUES (1, 'a', 'foo')")
+        self.assertEqual(db.upgrade_records(engine),
+                         ["added column record_z",
+                          "created table record_stats",
+                          "added index ix_records_message_id"])
+        self.assertEqual(list(engine.execute('SELECT * FROM records')),
+                         [(1, 'a', 'foo', None)])
+        self.assertEqual(db.upgrade_records(engine), [])
+
+    def test_add_after_upgrading_table_without_rollups(self):
+        with list_api.app.app_context():
+            engine = db.get_engine('writer')
+            db.RecordStats.__table__.drop(engine)
+            self.assertEqual(db.upgrade_records(engine),
+                             ["created table record_stats"])
+            tasks.add('foo', message_id='a', timestamp=61)
+            self.assertEqual(tasks.db.session.query(tasks.Records).count(),
+                             1)
+        self.assertEqual(
+            json.loads(self.client.get('/records/stats').data)['results'],
+            [{'timestamp': 60, 'count': 1, 'bytes': 3}])
+
+
+class BatchTasksTests(BaseListTests):
+
+    def test_add_batch_success(self):
+        with list_api.app.app_context():
+            self.assertIsNone(tasks.add_batch(['foo', 'bar']))
+            res = tasks.db.session.query(tasks.Records.record)
+            self.assertEqual(sorted(r.record for r in res.all()),
+                             ['bar', 'foo'])
+
+    def test_add_batch_retry_is_idempotent(self):
+        with list_api.app.app_context():
+            tasks.add('foo', timefunc=time_func, uuidfunc=uuid_func)
+            self.assertIsNone(tasks.add_batch(['foo'], timefunc=time_func,
+                                              uuidfunc=uuid_func))
+            res = tasks.db.session.query(tasks.Records.record)
+            self.assertEqual(len(res.all()), 1)
+
+
+class BatcherTests(unittest.TestCase):
+
+    def submit_concurrently(self, b, items):
+        errors = []
+
+        def submit(item):
+            try:
+                b.submit(item)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in items]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    def test_flushes_full_batch(self):
+        flushed = []
+        b = batcher.Batcher(3, 10, flushed.append)
+        self.assertEqual(self.submit_concurrently(b, [1, 2, 3]), [])
+        self.assertEqual([sorted(f) for f in flushed], [[1, 2, 3]])
+
+    def test_flushes_after_window(self):
+        flushed = []
+        b = batcher.Batcher(100, 0.01, flushed.append)
+        b.submit(1)
+        self.assertEqual(flushed, [[1]])
+
+    def test_flush_error_raised_to_every_submitter(self):
+        def flush(items):
+            raise ValueError(items)
+        b = batcher.Batcher(2, 10, flush)
+        errors = self.submit_concurrently(b, [1, 2])
+        self.assertEqual(len(errors), 2)
+        for e in errors:
+            self.assertIsInstance(e, ValueError)
+
+
+class BatchedAddTests(BaseListTests):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_batcher = patch(
+            'tasks.batcher', batcher.Batcher(2, 0.01, tasks.write_records))
+        self.patch_batcher.start()
+
+    def tearDown(self):
+        self.patch_batcher.stop()
+
+    def test_add_batched(self):
+        with list_api.app.app_context():
+            self.assertIsNone(tasks.add('foo'))
+            res = tasks.db.session.query(tasks.Records.record)
+            self.assertEqual([r.record for r in res.all()], ['foo'])
+
+    def test_write_records_skips_existing_rows(self):
+        with list_api.app.app_context():
+            tasks.add('foo', timefunc=time_func, uuidfunc=uuid_func)
+            tasks.write_records([
+                {'timestamp': 1, 'message_id': 'a', 'record': 'foo'},
+                {'timestamp': 1, 'message_id': 'b', 'record': 'bar'},
+            ])
+            res = tasks.db.session.query(tasks.Records.message_id)
+            self.assertEqual(sorted(r.message_id for r in res.all()),
+                             ['a', 'b'])
+
+
+class StreamWorkerTests(BaseListTests):
+
+    def make_client(self, entries):
+        client = MagicMock()
+        client.execute_command.side_effect = [
+            [[b'incoming', entries]], None]
+        return client
+
+    def test_process_batch_writes_and_acks(self):
+        client = self.make_client([[b'1000-0', [b'data', b'foo']],
+                                   [b'2000-0', [b'data', b'bar']]])
+        with list_api.app.app_context():
+            read = stream_worker.process_batch(client, 'incoming', 'g',
+                                               'c', 10, 0)
+            res = tasks.db.session.query(tasks.Records)
+            self.assertEqual(
+                sorted((r.timestamp, r.message_id, r.record)
+                       for r in res.all()),
+                [(1, '1000-0', 'foo'), (2, '2000-0', 'bar')])
+        self.assertEqual(read, 2)
+        client.execute_command.assert_called_with(
+            'XACK', 'incoming', 'g', '1000-0', '2000-0')
+
+    def test_redelivered_entries_are_not_duplicated(self):
+        entries = [[b'1000-0', [b'data', b'foo']]]
+        with list_api.app.app_context():
+            for i in range(2):
+                stream_worker.process_batch(self.make_client(entries),
+                                            'incoming', 'g', 'c', 10, 0)
+            self.assertEqual(tasks.db.session.query(tasks.Records).count(),
+                             1)
+
+    def test_failed_write_is_not_acked(self):
+        client = self.make_client([[b'1000-0', [b'data', b'foo']]])
+        with patch('stream_worker.write_records',
+                   side_effect=tasks.SQLAlchemyError):
+            with self.assertRaises(tasks.SQLAlchemyError):
+                stream_worker.process_batch(client, 'incoming', 'g', 'c',
+                                            10, 0)
+        self.assertEqual(client.execute_command.call_count, 1)
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.data = b''
+
+    def writelines(self, frames):
+        self.data += b''.join(frames)
+
+    async def drain(self):
+        pass
+
+
+class FakeWebsocket(object):
+
+    def __init__(self, address=('a', 1)):
+        self.remote_address = address
+        self.writer = FakeWriter()
+        self.open = True
+        self.close_code = None
+        self.received = None
+
+    async def recv(self):
+        if self.received is None:
+            self.received = asyncio.Queue()
+        return await self.received.get()
+
+    def receive(self, message):
+        if self.received is None:
+            self.received = asyncio.Queue()
+        self.received.put_nowait(message)
+
+    async def close(self, code=1000, reason=''):
+        self.open = False
+        self.close_code = code
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class FanoutTests(unittest.TestCase):
+
+    def test_encode_frame(self):
+        self.assertEqual(fanout.encode_frame('hi'), b'\x81\x02hi')
+        self.assertEqual(fanout.encode_frame(b'x' * 200)[:4],
+                         b'\x82\x7e\x00\xc8')
+        self.assertEqual(fanout.encode_frame('x' * 70000)[:10],
+                         b'\x81\x7f' + (70000).to_bytes(8, 'big'))
+
+    def test_ring_wraps(self):
+        ring = fanout.Ring(3)
+        for value in 'abcde':
+            ring.publish(value)
+        self.assertEqual(ring.first_seq, 2)
+        self.assertEqual(ring.get_values(2, 5), ['c', 'd', 'e'])
+        self.assertEqual(ring.get_values(3, 5), ['d', 'e'])
+        self.assertEqual(ring.get_values(5, 5), [])
+        self.assertEqual(ring.get_frames(4, 5), [b'\x81\x01e'])
+        self.assertEqual(ring.get_ids(2, 5), ['2', '3', '4'])
+        self.assertEqual(ring.get_id_frames(4, 5),
+                         [fanout.encode_frame('{"id":"4","data":e}')])
+        self.assertEqual(ring.positions, {'2': 2, '3': 3, '4': 4})
+
+    def test_wait(self):
+        ring = fanout.Ring(3)
+
+        async def run():
+            waiters = [asyncio.ensure_future(ring.wait(0)) for _ in range(3)]
+            await asyncio.sleep(0)
+            waiters[0].cancel()
+            ring.publish('a')
+            await asyncio.gather(*waiters[1:])
+            await ring.wait(0)
+
+        run_async(run())
+
+    def test_catch_up(self):
+        ring = fanout.Ring(4)
+        for value in 'abcdef':
+            ring.publish(value)
+        # Every frame is 3 bytes.
+        self.assertEqual(ring.lag_bytes(3), 9)
+        self.assertEqual(fanout.catch_up(ring, 3, 9), 3)
+        self.assertEqual(fanout.catch_up(ring, 3, 6), 4)
+        self.assertEqual(fanout.catch_up(ring, 0, 100), 2)
+        self.assertEqual(fanout.catch_up(ring, 0, 1), 5)
+        self.assertEqual(fanout.catch_up(ring, 3, 6, fanout.KEEP_LATEST), 5)
+        self.assertEqual(fanout.catch_up(ring, 2, 100, fanout.DISCONNECT), 2)
+        with self.assertRaises(fanout.SlowClient):
+            fanout.catch_up(ring, 1, 100, fanout.DISCONNECT)
+        with self.assertRaises(fanout.SlowClient):
+            fanout.catch_up(ring, 3, 6, fanout.DISCONNECT)
+        # Frames with IDs ({"id":"3","data":d} and so on) are 21 bytes.
+        self.assertEqual(ring.lag_bytes(3, True), 63)
+        self.assertEqual(fanout.catch_up(ring, 3, 9, with_ids=True), 5)
+        self.assertEqual(fanout.catch_up(ring, 3, 46, with_ids=True), 4)
+
+
+class SubscriptionTests(unittest.TestCase):
+
+    def test_compile_filter(self):
+        key, match = subscriptions.compile_filter(
+            {'equals': {'level': 'error', 'n': 1},
+             'prefix': {'host': 'web-'}})
+        self.assertTrue(match({'level': 'error', 'n': 1, 'host': 'web-1'}))
+        self.assertFalse(match({'level': 'error', 'n': 1, 'host': 'db-1'}))
+        self.assertFalse(match({'level': 'error', 'host': 'web-1'}))
+        self.assertFalse(match({'level': 'error', 'n': 1, 'host': 1}))
+        self.assertFalse(match(['level']))
+        self.assertEqual(key, subscriptions.compile_filter(
+            {'prefix': {'host': 'web-'},
+             'equals': {'n': 1, 'level': 'error'}})[0])
+        self.assertEqual(subscriptions.compile_filter({}), (None, None))
+        for spec in ([], {'regex': {}}, {'prefix': {'a': 1}},
+                     {'equals': []}):
+            with self.assertRaises(ValueError):
+                subscriptions.compile_filter(spec)
+
+    def test_index_shares_filters(self):
+        index = subscriptions.FilterIndex(3)
+        key, match = subscriptions.compile_filter({'equals': {'a': 1}})
+        ring = index.subscribe(key, match)
+        self.assertIs(index.subscribe(key, match), ring)
+        frames = fanout.Ring(1).publish('{"a": 1}', 'x')
+        index.publish('{"a": 1}', 'x', frames)
+        index.publish('{"a": 2}', 'y', (b'', b''))
+        self.assertIs(ring.get_frames(0, ring.next_seq)[0], frames[0])
+        self.assertEqual(ring.get_ids(0, ring.next_seq), ['x'])
+        index.unsubscribe(key)
+        self.assertIn(key, index.filters)
+        index.unsubscribe(key)
+        self.assertEqual(index.filters, {})
+
+
+class WSServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_ring = patch('wsserver.ring', fanout.Ring(3))
+        self.patch_ring.start()
+        self.patch_filters = patch('wsserver.filters',
+                                   subscriptions.FilterIndex(3))
+        self.patch_filters.start()
+
+    def tearDown(self):
+        self.patch_ring.stop()
+        self.patch_filters.stop()
+        wsserver.clients.clear()
+
+    def test_frames_sent_in_batches(self):
+        websocket = FakeWebsocket()
+
+        async def run():
+            task = asyncio.ensure_future(wsserver.server(websocket, '/'))
+            await asyncio.sleep(0)
+            wsserver.broadcast('x')
+            wsserver.broadcast('y')
+            await settle()
+            self.assertEqual(websocket.writer.data, b'\x81\x01x\x81\x01y')
+            self.assertEqual(wsserver.clients[websocket].seq, 2)
+            websocket.open = False
+            wsserver.broadcast('z')
+            await task
+            self.assertEqual(wsserver.clients, {})
+
+        run_async(run())
+
+    def test_slow_client_skips_overwritten(self):
+        websocket = FakeWebsocket()
+
+        async def run():
+            task = asyncio.ensure_future(wsserver.server(websocket, '/'))
+            await asyncio.sleep(0)
+            for value in 'abcde':
+                wsserver.broadcast(value)
+            await settle()
+            self.assertEqual(websocket.writer.data,
+                             b'\x81\x01c\x81\x01d\x81\x01e')
+            self.assertEqual(wsserver.stats['dropped'], 2)
+            task.cancel()
+
+        with patch.dict(wsserver.stats, clear=True):
+            run_async(run())
+
+    def test_disconnect_policy(self):
+        websocket = FakeWebsocket()
+
+        async def run():
+            task = asyncio.ensure_future(wsserver.server(websocket, '/'))
+            await asyncio.sleep(0)
+            for value in 'abcd':
+                wsserver.broadcast(value)
+            await task
+            self.assertEqual(websocket.close_code, 1008)
+            self.assertEqual(websocket.writer.data, b'')
+            self.assertEqual(wsserver.clients, {})
+
+        with patch('wsserver.SLOW_CLIENT_POLICY', fanout.DISCONNECT):
+            run_async(run())
+
+    def test_connection_cap(self):
+        first, second = FakeWebsocket(), FakeWebsocket()
+
+        async def run():
+            task = asyncio.ensure_future(wsserver.server(first, '/'))
+            await asyncio.sleep(0)
+            await wsserver.server(second, '/')
+            self.assertEqual(second.close_code, 4013)
+            self.assertEqual(list(wsserver.clients), [first])
+            self.assertEqual(wsserver.stats['rejected'], 1)
+            task.cancel()
+
+        with patch('wsserver.MAX_CONNECTIONS', 1), \
+                patch.dict(wsserver.stats, clear=True):
+            run_async(run())
+
+    def test_subscriptions(self):
+        first, second, third = [FakeWebsocket() for _ in range(3)]
+        subscription = json.dumps({'filter': {'equals': {'a': 1}}})
+
+        async def run():
+            tasks = [asyncio.ensure_future(wsserver.server(websocket, '/'))
+                     for websocket in (first, second, third)]
+            first.receive(subscription)
+            second.receive(subscription)
+            await settle()
+            self.assertEqual(len(wsserver.filters.filters), 1)
+            for value in ('{"a": 1}', '{"a": 2}', '[1]'):
+                wsserver.broadcast(value)
+            await settle()
+            self.assertEqual(first.writer.data, b'\x81\x08{"a": 1}')
+            self.assertEqual(second.writer.data, first.writer.data)
+            self.assertEqual(len(third.writer.data), 25)
+            second.receive(json.dumps({'filter': {}}))
+            await settle()
+            wsserver.broadcast('{"a": 3}')
+            await settle()
+            self.assertEqual(second.writer.data[10:], b'\x81\x08{"a": 3}')
+            first.receive('nope')
+            await tasks[0]
+            self.assertEqual(first.close_code, 4400)
+            self.assertEqual(wsserver.filters.filters, {})
+            for task in tasks[1:]:
+                task.cancel()
+
+        run_async(run())
+
+    async def resume(self, last_seen, spec=None):
+        """
+        Connect, subscribe with last_seen and return what was sent.
+        """
+        websocket = FakeWebsocket()
+        subscription = {'last_seen': last_seen}
+        if spec is not None:
+            subscription['filter'] = spec
+        task = asyncio.ensure_future(wsserver.server(websocket, '/'))
+        websocket.receive(json.dumps(subscription))
+        await settle()
+        task.cancel()
+        return websocket.writer.data
+
+    def test_resume(self):
+        for i, value in enumerate(('{"a": 1}', '{"a": 2}', '{"a": 1}')):
+            wsserver.broadcast(value, 'm%d' % i)
+
+        async def run():
+            self.assertEqual(
+                await self.resume('m0'),
+                fanout.encode_frame('{"id":"m1","data":{"a": 2}}') +
+                fanout.encode_frame('{"id":"m2","data":{"a": 1}}'))
+            self.assertEqual(
+                await self.resume('m0', {'equals': {'a': 1}}),
+                fanout.encode_frame('{"id":"m2","data":{"a": 1}}'))
+            self.assertEqual(await self.resume('m2'), b'')
+            self.assertEqual(await self.resume(None), b'')
+            with patch('wsserver.REPLAY_LIMIT', 1):
+                gap = await self.resume('m0')
+            self.assertEqual(json.loads(gap[2:].decode('utf-8')),
+                             {'error': 'gap too large', 'last_seen': 'm0'})
+            wsserver.broadcast('{"a": 3}')
+            await settle()
+            self.assertEqual((await self.resume('m0'))[2:], gap[2:])
+
+        run_async(run())
+        self.assertEqual(wsserver.ring.ids[0], wsserver.EPOCH + '-3')
+
+    def test_throughput(self):
+        self.assertEqual(
+            wsserver.throughput(
+                collections.Counter(published=30, sent=90),
+                collections.Counter(published=10), 10),
+            {'published_per_second': 2.0, 'sent_per_second': 9.0})
+
+    def test_shutdown_drains(self):
+        ws_server, loop = MagicMock(), MagicMock()
+        closed = []
+
+        async def wait_closed():
+            await asyncio.sleep(0)
+            closed.append(True)
+
+        ws_server.wait_closed = wait_closed
+        run_async(wsserver.shutdown(ws_server, loop))
+        ws_server.close.assert_called_once_with()
+        self.assertEqual(closed, [True])
+        loop.stop.assert_called_once_with()
+
+        ws_server.wait_closed = lambda: asyncio.sleep(60)
+        with patch('wsserver.DRAIN_TIMEOUT', 0.01):
+            run_async(wsserver.shutdown(ws_server, loop))
+        self.assertEqual(loop.stop.call_count, 2)
+
+
 class TestCodeFormat(unittest.TestCase):
 
     def test_pep8_conformance(self):
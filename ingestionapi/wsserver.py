@@ -1,17 +1,66 @@
 #!/usr/bin/env python
 
 import asyncio
+import collections
+import json
 import os
+import signal
+import time
+import uuid
 
 import asyncio_redis
+import redis
 import websockets
+from websockets.exceptions import ConnectionClosed
+
+import fanout
+import streams
+import subscriptions
 
 from structlog import get_logger
 
 CHANNEL = 'incoming-messages'
-MAXSIZE = 1000
+HOST = '0.0.0.0'
+PORT = 8765
+# With PROCESSES > 1 a supervisor forks that many worker processes, which
+# share the port with SO_REUSEPORT. On SIGTERM workers stop accepting
+# connections and wait up to DRAIN_TIMEOUT seconds for theirs to close.
+PROCESSES = int(os.environ.get('PROCESSES') or 1)
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT') or 10)
+# How many recent messages are kept, for slow clients and for replay.
+MAXSIZE = int(os.environ.get('HISTORY_SIZE') or 1000)
+# Clients resuming more than REPLAY_LIMIT messages back are told the gap is
+# too large instead.
+REPLAY_LIMIT = int(os.environ.get('REPLAY_LIMIT') or MAXSIZE)
+
+# Refuse connections past MAX_CONNECTIONS (0 for no limit), closing them
+# with TOO_MANY_CONNECTIONS_CODE.
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS') or 0)
+TOO_MANY_CONNECTIONS_CODE = 4013
+# Clients sending anything but a valid subscription are closed with this.
+INVALID_SUBSCRIPTION_CODE = 4400
+# How many bytes of frames a client may be behind by before
+# SLOW_CLIENT_POLICY (drop-oldest, keep-latest or disconnect, see
+# fanout.py) kicks in. Disconnected clients get SLOW_CLIENT_CLOSE_CODE.
+CLIENT_MAX_BYTES = int(os.environ.get('CLIENT_MAX_BYTES') or 2 ** 20)
+SLOW_CLIENT_POLICY = os.environ.get('SLOW_CLIENT_POLICY') or fanout.DROP_OLDEST
+if SLOW_CLIENT_POLICY not in fanout.POLICIES:
+    raise ValueError("Unknown SLOW_CLIENT_POLICY %r, expected one of %s"
+                     % (SLOW_CLIENT_POLICY, ', '.join(fanout.POLICIES)))
+SLOW_CLIENT_CLOSE_CODE = int(os.environ.get('SLOW_CLIENT_CLOSE_CODE') or 1008)
+STATS_INTERVAL = float(os.environ.get('STATS_INTERVAL') or 60)
 
+# The last MAXSIZE messages, shared by every client without a filter.
+ring = fanout.Ring(MAXSIZE)
+# The same for the messages each filter in use matches.
+filters = subscriptions.FilterIndex(MAXSIZE)
+# The Client of each open connection.
 clients = {}
+stats = collections.Counter()
+# Message IDs are the stream entry IDs with INGEST_TRANSPORT=stream.
+# Otherwise they are counters prefixed with this, so IDs handed out before a
+# restart aren't mistaken for new ones.
+EPOCH = uuid.uuid4().hex[:8]
 
 logger = get_logger()
 
@@ -26,6 +75,28 @@ def get_host_details():
     return host, port, topic
 
 
+class Client(object):
+    """
+    A connection's ring, either the main one or its filter's, the
+    position in it of the next message to send and whether messages are
+    sent with their IDs.
+    """
+
+    def __init__(self):
+        self.filter_key = None
+        self.ring = ring
+        self.seq = ring.next_seq
+        self.with_ids = False
+
+
+def broadcast(value, message_id=None):
+    if message_id is None:
+        message_id = '%s-%d' % (EPOCH, ring.next_seq)
+    frames = ring.publish(value, message_id)
+    filters.publish(value, message_id, frames)
+    stats['published'] += 1
+
+
 async def read_from_pubsub():
     host, port, topic = get_host_details()
     connection = await asyncio_redis.Connection.create(host=host, port=port)
@@ -36,29 +107,296 @@ async def read_from_pubsub():
     while True:
         reply = await subscriber.next_published()
         logger.debug("Got message", num_clients=len(clients))
-        for (c_host, c_port), c in clients.items():
-            try:
-                c.put_nowait(reply)
-            except asyncio.QueueFull:
-                # The client is too slow in picking up the message most likely
-                # Drop it and log at warning level. Since delivery
-                # is best-effort, don't consider this to be an error.
-                logger.warning("Dropping log message. Possible slow client",
-                               host=c_host, port=c_port, dropped=1)
+        broadcast(reply.value)
 
     connection.close()
 
 
+async def read_from_stream():
+    """
+    Tail the ingest stream (INGEST_TRANSPORT=stream) instead of the pubsub
+    topic. redis-py blocks, so reads run in the default executor.
+    """
+    host, port, topic = get_host_details()
+    stream = os.environ.get('REDIS_STREAM', 'incoming')
+    client = redis.StrictRedis(host=host, port=port)
+    loop = asyncio.get_event_loop()
+    last_id = await loop.run_in_executor(None, streams.last_id, client,
+                                         stream)
+    logger.info("Initialized Redis. Entering stream loop", last_id=last_id)
+
+    while True:
+        entries = await loop.run_in_executor(
+            None, streams.read, client, stream, last_id, MAXSIZE, 1000)
+        logger.debug("Got messages", num_clients=len(clients),
+                     count=len(entries))
+        for entry_id, value in entries:
+            last_id = entry_id
+            broadcast(value, entry_id)
+
+
+async def send_messages(websocket, client, backlog=None):
+    """
+    Send a client the (frames, values) of a backlog if there is one, then
+    every message published to its ring from its position on, in batches
+    of whatever it is behind by.
+    """
+    c_host, c_port = websocket.remote_address[:2]
+    ring, seq = client.ring, client.seq
+    if backlog and not await fanout.send_encoded(websocket, *backlog):
+        return
+    while True:
+        await ring.wait(seq)
+        try:
+            start = fanout.catch_up(ring, seq, CLIENT_MAX_BYTES,
+                                    SLOW_CLIENT_POLICY, client.with_ids)
+        except fanout.SlowClient:
+            logger.warning("Disconnecting slow client", host=c_host,
+                           port=c_port, disconnected=1)
+            stats['disconnected'] += 1
+            await websocket.close(SLOW_CLIENT_CLOSE_CODE, 'Too slow')
+            return
+        if start > seq:
+            # The client is too slow in picking up messages most likely.
+            # Skip the ones it missed and log at warning level. Since
+            # delivery is best-effort, don't consider this to be an error.
+            logger.warning("Dropping log message. Possible slow client",
+                           host=c_host, port=c_port, dropped=start - seq)
+            stats['dropped'] += start - seq
+        end = ring.next_seq
+        if not await fanout.send(websocket, ring, start, end,
+                                 client.with_ids):
+            return
+        stats['sent'] += end - start
+        client.seq = seq = end
+
+
+def set_filter(client, key, match, with_ids=False):
+    """
+    Move a client to the ring of a filter (the main ring for None), from
+    the newest message on.
+    """
+    if client.filter_key is not None:
+        filters.unsubscribe(client.filter_key)
+    client.filter_key = key
+    client.ring = ring if key is None else filters.subscribe(key, match)
+    client.seq = client.ring.next_seq
+    client.with_ids = with_ids
+
+
+def replay(client, last_seen):
+    """
+    Set a client up to resume after message last_seen. A client without a
+    filter just continues from there in the main ring. For others, the
+    messages since then that match their filter are returned as the
+    (frames, values) to send before new ones. If last_seen is no longer in
+    the history, or more than REPLAY_LIMIT messages back, a "gap too large"
+    notice is returned instead and the client only gets new messages.
+    """
+    position = ring.positions.get(last_seen)
+    if position is None or ring.next_seq - position - 1 > REPLAY_LIMIT:
+        stats['gaps'] += 1
+        notice = json.dumps({'error': 'gap too large',
+                             'last_seen': last_seen})
+        return [fanout.encode_frame(notice)], [notice]
+    stats['resumed'] += 1
+    start, end = position + 1, ring.next_seq
+    if client.filter_key is None:
+        client.seq = start
+        return None
+    match = filters.filters[client.filter_key][0]
+    values = ring.get_values(start, end)
+    keep = [match(subscriptions.decode(value)) for value in values]
+    frames = [frame for frame, matched
+              in zip(ring.get_id_frames(start, end), keep) if matched]
+    values = [fanout.envelope(message_id, value) for message_id, value, matched
+              in zip(ring.get_ids(start, end), values, keep) if matched]
+    return frames, values
+
+
+def parse_subscription(message):
+    """
+    Parse a subscription: a JSON object with a "filter" (see
+    subscriptions.py) to get only the messages matching it, and/or
+    "last_seen" to get messages with their IDs, resuming after the message
+    with that ID (null for only new messages). Returns (key, match,
+    with_ids, last_seen). Raises ValueError for anything else.
+    """
+    subscription = json.loads(message)
+    if not isinstance(subscription, dict) or not subscription or \
+            set(subscription) - {'filter', 'last_seen'}:
+        raise ValueError("Unsupported subscription")
+    last_seen = subscription.get('last_seen')
+    if last_seen is not None and not isinstance(last_seen, str):
+        raise ValueError("Unsupported subscription")
+    key, match = subscriptions.compile_filter(subscription.get('filter', {}))
+    return key, match, 'last_seen' in subscription, last_seen
+
+
+async def serve_client(websocket, client):
+    """
+    Send a client its messages, switching filters and resuming whenever it
+    sends a subscription.
+    """
+    sender = asyncio.ensure_future(send_messages(websocket, client))
+    receiver = asyncio.ensure_future(websocket.recv())
+    try:
+        while True:
+            await asyncio.wait([sender, receiver],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if sender.done():
+                return sender.result()
+            try:
+                key, match, with_ids, last_seen = parse_subscription(
+                    receiver.result())
+            except ConnectionClosed:
+                return
+            except ValueError:
+                stats['invalid_subscriptions'] += 1
+                await websocket.close(INVALID_SUBSCRIPTION_CODE,
+                                      'Invalid subscription')
+                return
+            sender.cancel()
+            set_filter(client, key, match, with_ids)
+            backlog = replay(client, last_seen) if last_seen else None
+            sender = asyncio.ensure_future(
+                send_messages(websocket, client, backlog))
+            receiver = asyncio.ensure_future(websocket.recv())
+    finally:
+        sender.cancel()
+        receiver.cancel()
+
+
 async def server(websocket, path):
-    clients[websocket.remote_address] = asyncio.Queue(MAXSIZE)
-    q = clients[websocket.remote_address]
+    """
+    Register a connection for as long as it is open.
+    """
+    if MAX_CONNECTIONS and len(clients) >= MAX_CONNECTIONS:
+        logger.warning("Refusing connection", rejected=1,
+                       connections=len(clients))
+        stats['rejected'] += 1
+        await websocket.close(TOO_MANY_CONNECTIONS_CODE,
+                              'Too many connections')
+        return
+    clients[websocket] = client = Client()
+    stats['connected'] += 1
+    try:
+        await serve_client(websocket, client)
+    finally:
+        set_filter(client, None, None)
+        del clients[websocket]
+
+
+def throughput(current, last, interval):
+    """
+    The messages published and sent per second between two snapshots of
+    the stats.
+    """
+    return {'%s_per_second' % name:
+            round((current[name] - last[name]) / interval, 1)
+            for name in ('published', 'sent')}
+
+
+async def report_stats():
+    """
+    Log the number of connections, the message counters and the throughput
+    of this process every STATS_INTERVAL seconds.
+    """
+    last = collections.Counter()
     while True:
-        item = await q.get()
-        await websocket.send(item.value)
+        await asyncio.sleep(STATS_INTERVAL)
+        rates = throughput(stats, last, STATS_INTERVAL)
+        last = stats.copy()
+        logger.info("Websocket stats", pid=os.getpid(),
+                    connections=len(clients), filters=len(filters.filters),
+                    **dict(stats, **rates))
+
+
+async def shutdown(ws_server, loop):
+    """
+    Stop accepting connections, close the open ones (with 1001, going away,
+    so clients reconnect elsewhere) and stop the loop once they are closed
+    or DRAIN_TIMEOUT has passed.
+    """
+    logger.info("Draining connections", pid=os.getpid(),
+                connections=len(clients))
+    ws_server.close()
+    try:
+        await asyncio.wait_for(ws_server.wait_closed(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Gave up draining connections", pid=os.getpid(),
+                       connections=len(clients))
+    loop.stop()
+
+
+def run(reuse_port=False):
+    """
+    Serve websocket clients from this process until SIGTERM or SIGINT.
+    """
+    loop = asyncio.get_event_loop()
+    ws_server = loop.run_until_complete(
+        websockets.serve(server, HOST, PORT, reuse_port=reuse_port))
+    if os.environ.get('INGEST_TRANSPORT') == 'stream':
+        reader = read_from_stream()
+    else:
+        reader = read_from_pubsub()
+    loop.create_task(reader)
+    loop.create_task(report_stats())
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(
+            signum, lambda: loop.create_task(shutdown(ws_server, loop)))
+    logger.info("Serving websocket clients", pid=os.getpid(), port=PORT)
+    loop.run_forever()
+
+
+def start_worker():
+    """
+    Fork a worker process, returning its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    global EPOCH
+    # Workers number messages independently, so their IDs mustn't clash.
+    EPOCH = uuid.uuid4().hex[:8]
+    status = 0
+    try:
+        run(reuse_port=True)
+    except Exception:
+        logger.exception("Worker failed", pid=os.getpid())
+        status = 1
+    os._exit(status)
+
+
+def supervise(processes):
+    """
+    Run processes workers, restarting any that exit. SIGTERM and SIGINT are
+    passed on to the workers, and return once they have drained.
+    """
+    workers = set(start_worker() for _ in range(processes))
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        pid, status = os.wait()
+        workers.discard(pid)
+        if not stopping:
+            logger.warning("Worker exited, restarting", pid=pid,
+                           status=status)
+            time.sleep(1)
+            workers.add(start_worker())
 
 
 if __name__ == '__main__':
-    start_server = websockets.serve(server, '0.0.0.0', 8765)
-    asyncio.get_event_loop().create_task(read_from_pubsub())
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    if PROCESSES > 1:
+        supervise(PROCESSES)
+    else:
+        run()